@@ -2,6 +2,8 @@
 
 ###############################################################################
 from __future__ import absolute_import, division, unicode_literals
+from time import time
+STARTED = time()
 import logging
 from sys import argv
 from urlparse import parse_qsl
@@ -10,18 +12,44 @@ import xbmc
 import xbmcgui
 import xbmcplugin
 
-from resources.lib import entrypoint, utils, transfer, variables as v, loghandler
+from resources.lib import transfer, variables as v, loghandler
+from resources.lib.lazy_import import LazyModule
 from resources.lib.tools import unicode_paths
 
 ###############################################################################
 
 loghandler.config()
 LOG = logging.getLogger('PLEX.default')
+# Heavy - only import if the mode needs it
+entrypoint = LazyModule('resources.lib.entrypoint')
+utils = LazyModule('resources.lib.utils')
 
 ###############################################################################
 
 HANDLE = int(argv[1])
 
+# Modes that simply pass a command on to PKC's service:
+# mode: (log message or None, command)
+PLEX_COMMANDS = {
+    'enterPMS': ('Request to manually enter new PMS address',
+                 'enter_new_pms_address'),
+    'reset': (None, 'RESET-PKC'),
+    'togglePlexTV': ('Toggle of Plex.tv sign-in requested',
+                     'toggle_plex_tv_sign_in'),
+    'switchuser': ('Plex home user switch requested', 'switch_plex_user'),
+    'repair': ('Requesting repair lib sync', 'repair-scan'),
+    'manualsync': ('Requesting full library scan', 'full-scan'),
+    'texturecache': ('Requesting texture caching of all textures',
+                     'textures-scan'),
+    'chooseServer': ('Choosing PMS server requested, starting',
+                     'choose_pms_server'),
+    'fanart': ('User requested fanarttv refresh', 'fanart-scan'),
+    'select-libraries': ('User requested to select Plex libraries',
+                         'select-libraries'),
+    'refreshplaylist': ('User requested to refresh Kodi playlists and nodes',
+                        'refreshplaylist')
+}
+
 
 class Main():
     # MAIN ENTRY POINT
@@ -39,7 +67,13 @@ class Main():
         mode = params.get('mode', '')
         itemid = params.get('id', '')
 
-        if mode == 'play':
+        if mode in PLEX_COMMANDS:
+            msg, command = PLEX_COMMANDS[mode]
+            if msg:
+                LOG.info(msg)
+            transfer.plex_command(command)
+
+        elif mode == 'play':
             self.play()
 
         elif mode == 'plex_node':
@@ -86,48 +120,13 @@ class Main():
         elif mode == 'settings':
             xbmc.executebuiltin('Addon.OpenSettings(%s)' % v.ADDON_ID)
 
-        elif mode == 'enterPMS':
-            LOG.info('Request to manually enter new PMS address')
-            transfer.plex_command('enter_new_pms_address')
-
-        elif mode == 'reset':
-            transfer.plex_command('RESET-PKC')
-
-        elif mode == 'togglePlexTV':
-            LOG.info('Toggle of Plex.tv sign-in requested')
-            transfer.plex_command('toggle_plex_tv_sign_in')
-
         elif mode == 'passwords':
             from resources.lib.windows import direct_path_sources
             direct_path_sources.start()
 
-        elif mode == 'switchuser':
-            LOG.info('Plex home user switch requested')
-            transfer.plex_command('switch_plex_user')
-
-        elif mode in ('manualsync', 'repair'):
-            if mode == 'repair':
-                LOG.info('Requesting repair lib sync')
-                transfer.plex_command('repair-scan')
-            elif mode == 'manualsync':
-                LOG.info('Requesting full library scan')
-                transfer.plex_command('full-scan')
-
-        elif mode == 'texturecache':
-            LOG.info('Requesting texture caching of all textures')
-            transfer.plex_command('textures-scan')
-
-        elif mode == 'chooseServer':
-            LOG.info("Choosing PMS server requested, starting")
-            transfer.plex_command('choose_pms_server')
-
         elif mode == 'deviceid':
             self.deviceid()
 
-        elif mode == 'fanart':
-            LOG.info('User requested fanarttv refresh')
-            transfer.plex_command('fanart-scan')
-
         elif '/extrafanart' in path:
             plexpath = arguments[1:]
             plexid = itemid
@@ -146,16 +145,10 @@ class Main():
         elif mode == 'hub':
             entrypoint.hub(params.get('content_type'))
 
-        elif mode == 'select-libraries':
-            LOG.info('User requested to select Plex libraries')
-            transfer.plex_command('select-libraries')
-
-        elif mode == 'refreshplaylist':
-            LOG.info('User requested to refresh Kodi playlists and nodes')
-            transfer.plex_command('refreshplaylist')
-
         else:
             entrypoint.show_main_menu(content_type=params.get('content_type'))
+        LOG.debug('Mode "%s" took %.3f seconds including all imports',
+                  mode, time() - STARTED)
 
     @staticmethod
     def play():
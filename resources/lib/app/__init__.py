@@ -29,6 +29,7 @@ def init(entrypoint=False):
     ACCOUNT = Account(entrypoint)
     SYNC = Sync(entrypoint)
     if not entrypoint:
+        SYNC.wakeup = APP.sync_wakeup
         PLAYSTATE = PlayState()
 
 def reload():
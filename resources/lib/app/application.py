@@ -3,7 +3,7 @@
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
 import Queue
-from threading import Lock, RLock
+from threading import Condition, Lock, RLock
 
 import xbmc
 
@@ -12,6 +12,50 @@ from .. import utils
 LOG = getLogger('PLEX.app')
 
 
+class Wakeup(object):
+    """
+    Wakeup signal for one consumer thread. Producers call set() after having
+    handed over work (a queued message, a command, a requested library scan,
+    etc.). The consumer blocks in wait() until then or until its next own
+    deadline passes. Unlike threading.Event, calling set() while the
+    consumer is busy is never lost: the next wait() will return immediately
+    """
+    def __init__(self):
+        self._condition = Condition(Lock())
+        self._is_set = False
+
+    def set(self):
+        with self._condition:
+            self._is_set = True
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until set() is called or for timeout [float, seconds]. Returns
+        True if we have been woken up, False if the timeout expired
+        """
+        with self._condition:
+            if not self._is_set:
+                self._condition.wait(timeout)
+            is_set = self._is_set
+            self._is_set = False
+        return is_set
+
+
+class WakeupQueue(Queue.Queue):
+    """
+    Queue.Queue that sets wakeup [Wakeup] whenever an item is put
+    """
+    def __init__(self, wakeup, maxsize=0):
+        # Can't use super as Queue.Queue is an old style class
+        Queue.Queue.__init__(self, maxsize)
+        self.wakeup = wakeup
+
+    def _put(self, item):
+        Queue.Queue._put(self, item)
+        self.wakeup.set()
+
+
 class App(object):
     """
     This class is used to store variables across PKC modules
@@ -23,6 +67,11 @@ class App(object):
             self.load_entrypoint()
         else:
             self.reload()
+            # Wakeup signals for the threads waiting for work
+            self.service_wakeup = Wakeup()
+            self.sync_wakeup = Wakeup()
+            self.companion_wakeup = Wakeup()
+            self.playqueue_wakeup = Wakeup()
             # Quit PKC?
             self.stop_pkc = False
             # This will suspend the main thread also
@@ -38,9 +87,10 @@ class App(object):
             self.lock_playlists = Lock()
 
             # Plex Companion Queue()
-            self.companion_queue = Queue.Queue(maxsize=100)
+            self.companion_queue = WakeupQueue(self.companion_wakeup,
+                                               maxsize=100)
             # Websocket_client queue to communicate with librarysync
-            self.websocket_queue = Queue.Queue()
+            self.websocket_queue = WakeupQueue(self.sync_wakeup)
             # xbmc.Monitor() instance from kodimonitor.py
             self.monitor = None
             # xbmc.Player() instance
@@ -52,6 +102,24 @@ class App(object):
             # Instance of ImageCachingThread()
             self.caching_thread = None
 
+    @property
+    def stop_pkc(self):
+        return self._stop_pkc
+
+    @stop_pkc.setter
+    def stop_pkc(self, value):
+        self._stop_pkc = value
+        if value:
+            # Make sure that threads waiting for work exit right away
+            self.wake_up_all()
+
+    def wake_up_all(self):
+        for wakeup in (self.service_wakeup,
+                       self.sync_wakeup,
+                       self.companion_wakeup,
+                       self.playqueue_wakeup):
+            wakeup.set()
+
     @property
     def is_playing(self):
         return self.player.isPlaying() == 1
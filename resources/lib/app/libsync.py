@@ -69,6 +69,8 @@ class Sync(object):
         # to sync)
         self.image_sync_notifications = None
 
+        # Wakeup signal of the sync thread, see app.APP.sync_wakeup
+        self.wakeup = None
         # Do we need to run a special library scan?
         self.run_lib_scan = None
         # Set if user decided to cancel sync
@@ -95,6 +97,17 @@ class Sync(object):
         # Sets are faster when using "in" test than lists
         self.section_ids = set([x.section_id for x in sections if x.sync_to_kodi])
 
+    @property
+    def run_lib_scan(self):
+        return self._run_lib_scan
+
+    @run_lib_scan.setter
+    def run_lib_scan(self, run_lib_scan):
+        self._run_lib_scan = run_lib_scan
+        if run_lib_scan is not None and self.wakeup is not None:
+            # Let the sync thread know right away
+            self.wakeup.set()
+
     def load(self):
         self.direct_paths = utils.settings('useDirectPaths') == '1'
         self.enable_music = utils.settings('enableMusic') == 'true'
@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
+from threading import Thread, Lock
+from time import time
+import Queue
 import requests
 
 from .kodi_db import KodiVideoDB, KodiMusicDB, KodiTextureDB
@@ -16,6 +19,16 @@ requests.packages.urllib3.disable_warnings()
 # download is successful
 TIMEOUT = (35.1, 35.1)
 BATCH_SIZE = 500
+# Number of images we ask Kodi to cache at the same time
+CACHING_THREADS = 4
+# Seconds we pause all requests if Kodi refuses connections. Doubles with
+# every ConnectionError up to MAX_BACKOFF, halves with every success
+MIN_BACKOFF = 1
+MAX_BACKOFF = 32
+# Attempts per image before we give up on it
+MAX_ATTEMPTS = 5
+# Log the caching progress every x seconds
+PROGRESS_INTERVAL = 60
 
 
 def double_urlencode(text):
@@ -39,27 +52,23 @@ class ImageCachingThread(backgroundthread.KillableThread):
     @staticmethod
     def _url_generator(kind, kodi_type):
         """
+        Yields all urls not yet cached, looked up BATCH_SIZE urls at a time.
         Main goal is to close DB connection between calls
         """
-        offset = 0
-        i = 0
+        art_id = 0
         while True:
-            batch = []
             with kind(texture_db=True) as kodidb:
+                rows = kodidb.artwork_urls(kodi_type, art_id, BATCH_SIZE)
+                if not rows:
+                    break
+                art_id = rows[-1][0]
                 texture_db = KodiTextureDB(kodiconn=kodidb.kodiconn,
                                            artconn=kodidb.artconn,
                                            lock=False)
-                for i, url in enumerate(kodidb.artwork_generator(kodi_type,
-                                                                 BATCH_SIZE,
-                                                                 offset)):
-                    if texture_db.url_not_yet_cached(url):
-                        batch.append(url)
-                        if len(batch) == BATCH_SIZE:
-                            break
-            offset += i
+                batch = texture_db.uncached_urls([x[1] for x in rows])
             for url in batch:
                 yield url
-            if i + 1 < BATCH_SIZE:
+            if len(rows) < BATCH_SIZE:
                 break
 
     def run(self):
@@ -73,16 +82,22 @@ class ImageCachingThread(backgroundthread.KillableThread):
             app.APP.deregister_caching_thread(self)
             LOG.info("---===### Stopped ImageCachingThread ###===---")
 
+    def _stop(self):
+        return self.should_suspend() or self.should_cancel()
+
     def _loop(self):
         kinds = [KodiVideoDB]
         if app.SYNC.enable_music:
             kinds.append(KodiMusicDB)
-        for kind in kinds:
-            for kodi_type in ('poster', 'fanart'):
-                for url in self._url_generator(kind, kodi_type):
-                    if self.should_suspend() or self.should_cancel():
-                        return False
-                    cache_url(url, self.should_suspend)
+        cacher = TextureCacher(self._stop)
+        try:
+            for kind in kinds:
+                for kodi_type in ('poster', 'fanart'):
+                    for url in self._url_generator(kind, kodi_type):
+                        if not cacher.put(url):
+                            return False
+        finally:
+            cacher.finish()
         # Toggles Image caching completed to Yes
         utils.settings('plex_status_image_caching', value=utils.lang(107))
         return True
@@ -95,6 +110,130 @@ class ImageCachingThread(backgroundthread.KillableThread):
                 break
 
 
+class TextureCacher(object):
+    """
+    Asks Kodi's webserver to cache images with up to CACHING_THREADS requests
+    in flight at once, using one persistent HTTP session. If Kodi refuses
+    connections, all threads back off together. should_stop() is called
+    regularly; return True to abort
+    """
+    def __init__(self, should_stop, threads=CACHING_THREADS):
+        self.should_stop = should_stop
+        self.queue = Queue.Queue(maxsize=2 * threads)
+        self.session = requests.Session()
+        self.session.mount('http://',
+                           requests.adapters.HTTPAdapter(pool_maxsize=threads))
+        self.session.auth = (app.CONN.webserver_username,
+                             app.CONN.webserver_password)
+        self.base_url = 'http://%s:%s/image/image://' % (
+            app.CONN.webserver_host, app.CONN.webserver_port)
+        self.lock = Lock()
+        self.backoff = 0
+        self.resume_at = 0
+        self.cached = 0
+        self.failed = 0
+        self.started = time()
+        self.last_report = self.started
+        self.threads = [Thread(target=self._work,
+                               name='PKC-TextureCacher-%s' % i)
+                        for i in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, url):
+        """
+        Queues url for caching, blocking while all threads are busy. Returns
+        False if we need to stop
+        """
+        while not self.should_stop():
+            try:
+                self.queue.put(url, timeout=1)
+            except Queue.Full:
+                continue
+            return True
+        return False
+
+    def finish(self):
+        """
+        Waits until all queued urls have been processed (or skipped if we
+        need to stop), then closes the session
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.session.close()
+        self._report()
+
+    def _work(self):
+        while True:
+            url = self.queue.get()
+            if url is None:
+                break
+            if not self.should_stop():
+                self._cache(url)
+
+    def _wait_for_backoff(self):
+        """
+        Returns False if we need to stop while waiting
+        """
+        while True:
+            with self.lock:
+                remaining = self.resume_at - time()
+            if remaining <= 0:
+                return True
+            if app.APP.monitor.waitForAbort(min(remaining, 1)) or \
+                    self.should_stop():
+                return False
+
+    def _cache(self, url):
+        for _ in range(MAX_ATTEMPTS):
+            if not self._wait_for_backoff():
+                return
+            try:
+                self.session.head(url=self.base_url + double_urlencode(url),
+                                  timeout=TIMEOUT)
+            except requests.Timeout:
+                # We don't need the result, only trigger Kodi to start the
+                # download. All is well
+                pass
+            except requests.ConnectionError:
+                # Server thinks its a DOS attack, ('error 10053')
+                # OR: Kodi refuses Webserver connection (no password set)
+                with self.lock:
+                    self.backoff = min(max(2 * self.backoff, MIN_BACKOFF),
+                                       MAX_BACKOFF)
+                    self.resume_at = time() + self.backoff
+                LOG.debug('Were trying too hard to download art, server '
+                          'over-loaded. Pausing for %s seconds', self.backoff)
+                continue
+            except Exception as err:
+                LOG.error('Unknown exception for url %s: %s', url, err)
+                import traceback
+                LOG.error("Traceback:\n%s", traceback.format_exc())
+                break
+            with self.lock:
+                self.backoff = self.backoff // 2
+                self.cached += 1
+                report = time() - self.last_report >= PROGRESS_INTERVAL
+            if report:
+                self._report()
+            return
+        else:
+            LOG.error('Repeatedly got ConnectionError for url %s', url)
+        with self.lock:
+            self.failed += 1
+
+    def _report(self):
+        with self.lock:
+            now = time()
+            self.last_report = now
+            LOG.info('Image caching: %s images cached, %s failed, %.1f '
+                     'images per second', self.cached, self.failed,
+                     self.cached / max(now - self.started, 1))
+
+
 def cache_url(url, should_suspend=None):
     url = double_urlencode(url)
     sleeptime = 0
@@ -130,7 +269,7 @@ def cache_url(url, should_suspend=None):
             sleeptime += 1
             continue
         except Exception as err:
-            LOG.error('Unknown exception for url %s: %s'.
+            LOG.error('Unknown exception for url %s: %s',
                       double_urldecode(url), err)
             import traceback
             LOG.error("Traceback:\n%s", traceback.format_exc())
@@ -10,9 +10,24 @@ from collections import deque
 
 from . import utils, app, variables as v
 
-WORKER_COUNT = 3
+WORKER_COUNT = 5
 LOG = getLogger('PLEX.threads')
 
+# Lanes of our BGThreader: user-triggered tasks, library sync downloads and
+# background enrichment like fanart
+LANE_INTERACTIVE = 'interactive'
+LANE_SYNC = 'sync-io'
+LANE_BACKGROUND = 'background'
+# Lane: (weight for fair scheduling, max. number of tasks running at once)
+# Leave at least one worker for interactive tasks
+LANES = {
+    LANE_INTERACTIVE: (10, WORKER_COUNT),
+    LANE_SYNC: (3, WORKER_COUNT - 2),
+    LANE_BACKGROUND: (1, 1)
+}
+# Seconds after which a waiting task is run next, no matter its lane's weight
+STARVATION_TIMEOUT = 10.0
+
 
 class KillableThread(threading.Thread):
     def __init__(self, group=None, target=None, name=None, args=(), kwargs={}):
@@ -24,6 +39,8 @@ class KillableThread(threading.Thread):
         self._is_not_asleep = threading.Event()
         self._is_not_asleep.set()
         self.suspension_timeout = None
+        # Optional app.Wakeup used by producers to signal work for this thread
+        self.wakeup = None
         super(KillableThread, self).__init__(group, target, name, args, kwargs)
 
     def should_cancel(self):
@@ -40,6 +57,8 @@ class KillableThread(threading.Thread):
         # Make sure thread is running in order to exit quickly
         self._is_not_asleep.set()
         self._is_not_suspended.set()
+        if self.wakeup is not None:
+            self.wakeup.set()
 
     def should_suspend(self):
         """
@@ -59,6 +78,8 @@ class KillableThread(threading.Thread):
         self._is_not_suspended.clear()
         # Make sure thread wakes up in order to suspend
         self._is_not_asleep.set()
+        if self.wakeup is not None:
+            self.wakeup.set()
         if block:
             self._suspension_reached.wait()
 
@@ -99,6 +120,18 @@ class KillableThread(threading.Thread):
         self._is_not_asleep.wait(timeout)
         self._is_not_asleep.set()
 
+    def wait_for_work(self, timeout):
+        """
+        Only call from the current thread. Blocks until a producer signals
+        self.wakeup, the thread should cancel or suspend, or for a period of
+        timeout [float, seconds] - whatever comes first. Returns True if we
+        have been woken up. Simply sleeps if self.wakeup has not been set
+        """
+        if self.wakeup is None:
+            self.sleep(timeout)
+            return False
+        return self.wakeup.wait(timeout)
+
     def is_asleep(self):
         """
         Check from another thread whether the current thread is asleep
@@ -142,21 +175,22 @@ class ProcessingQueue(Queue.Queue, object):
         """
         PKC customization of Queue.put. item needs to be the tuple
             (count [int], {'section': [Section], 'xml': [etree xml]})
+        The item the consumer needs next never blocks, see _is_full()
         """
         self.not_full.acquire()
         try:
             if self.maxsize > 0:
                 if not block:
-                    if self._total_qsize() == self.maxsize:
+                    if self._is_full(item):
                         raise Queue.Full
                 elif timeout is None:
-                    while self._total_qsize() == self.maxsize:
+                    while self._is_full(item):
                         self.not_full.wait()
                 elif timeout < 0:
                     raise ValueError("'timeout' must be a non-negative number")
                 else:
                     endtime = _time() + timeout
-                    while self._total_qsize() == self.maxsize:
+                    while self._is_full(item):
                         remaining = endtime - _time()
                         if remaining <= 0.0:
                             raise Queue.Full
@@ -167,6 +201,21 @@ class ProcessingQueue(Queue.Queue, object):
         finally:
             self.not_full.release()
 
+    def _is_full(self, item):
+        """
+        True if put() needs to wait before adding item. We always accept the
+        item the consumer is waiting for - otherwise several producers could
+        dead-lock each other, e.g. if items of later sections fill the queue
+        """
+        if self._total_qsize() < self.maxsize:
+            return False
+        if (self._current_section is None or
+                item[1]['section'] != self._current_section):
+            return True
+        if isinstance(self._current_queue, OrderedQueue):
+            return item[0] != self._current_queue.next_index
+        return self._current_queue._qsize() > 0
+
     def _put(self, item):
         for i, section in enumerate(self._sections):
             if item[1]['section'] == section:
@@ -208,6 +257,25 @@ class ProcessingQueue(Queue.Queue, object):
         finally:
             self.mutex.release()
 
+    def finish_section(self, section, number_of_items):
+        """
+        Call once all items of section have been put into this queue (or will
+        be put by other threads) in order to set the final number_of_items,
+        e.g. if we put less items than anticipated. Moves on to the next
+        section if all these items have already been processed
+        """
+        self.mutex.acquire()
+        try:
+            section.number_of_items = number_of_items
+            if (self._current_section is not None and
+                    section == self._current_section and
+                    self._counter >= number_of_items):
+                self._init_next_section()
+                self.not_empty.notify()
+                self.not_full.notify_all()
+        finally:
+            self.mutex.release()
+
     def _add_section(self, section):
         self._sections.append(section)
         self._queues.append(
@@ -234,6 +302,8 @@ class ProcessingQueue(Queue.Queue, object):
         self._counter += 1
         if self._counter == self._current_section.number_of_items:
             self._init_next_section()
+        # Producers wait for different things, see _is_full()
+        self.not_full.notify_all()
         return item[1]
 
 
@@ -281,6 +351,9 @@ class Tasks(list):
 
 
 class Task(object):
+    # The lane of our BGThreader this task will run in, see LANES
+    lane = LANE_INTERACTIVE
+
     def __init__(self, priority=None):
         self.priority = priority
         self._canceled = False
@@ -328,16 +401,87 @@ class FunctionAsTask(Task):
             self._callback(result)
 
 
-class MutablePriorityQueue(Queue.PriorityQueue):
-    def _get(self, heappop=heapq.heappop):
-            self.queue.sort()
-            return heappop(self.queue)
+class LaneQueue(Queue.Queue, object):
+    """
+    Queue for Tasks with one lane per kind of work, see LANES. Each lane runs
+    at most its max. number of tasks at once. Lanes take turns according to
+    their weights, but a task waiting for longer than STARVATION_TIMEOUT will
+    be run next. Within a lane, tasks are run in the order of their priority.
+
+    Call finished(task) once a task that you got from this queue is done.
+    """
+    def _init(self, maxsize):
+        # Lane: list of (counter, time queued, task) in the order of arrival
+        self.queue = dict((lane, []) for lane in LANES)
+        self.running = dict((lane, 0) for lane in LANES)
+        # Virtual time for weighted fair scheduling between lanes
+        self.vtime = dict((lane, 0.0) for lane in LANES)
+        self.counter = 0
+        # Metrics
+        self.dispatched = dict((lane, 0) for lane in LANES)
+        self.total_wait = dict((lane, 0.0) for lane in LANES)
+        self.max_wait = dict((lane, 0.0) for lane in LANES)
+
+    def _eligible(self):
+        return [lane for lane, tasks in self.queue.iteritems()
+                if tasks and self.running[lane] < LANES[lane][1]]
+
+    def _qsize(self, len=len):
+        # Only count the tasks that could be run right now
+        return sum(len(self.queue[lane]) for lane in self._eligible())
+
+    def _total_qsize(self):
+        return sum(len(tasks) for tasks in self.queue.itervalues())
+
+    def empty(self):
+        with self.mutex:
+            return not self._total_qsize()
+
+    def _put(self, task):
+        lane = task.lane
+        if not self.queue[lane] and not self.running[lane]:
+            # An idle lane may not accumulate credit
+            active = [self.vtime[x] for x in LANES
+                      if self.queue[x] or self.running[x]]
+            if active:
+                self.vtime[lane] = max(self.vtime[lane], min(active))
+        self.counter += 1
+        self.queue[lane].append((self.counter, _time(), task))
+
+    def _get(self):
+        now = _time()
+        eligible = self._eligible()
+        # Starvation protection - the oldest task of a lane comes first
+        lane = min(eligible, key=lambda x: self.queue[x][0][1])
+        if now - self.queue[lane][0][1] > STARVATION_TIMEOUT:
+            entry = self.queue[lane][0]
+        else:
+            lane = min(eligible, key=lambda x: self.vtime[x])
+            entry = min(self.queue[lane],
+                        key=lambda x: (x[2].priority, x[0]))
+        self.queue[lane].remove(entry)
+        self.vtime[lane] += 1.0 / LANES[lane][0]
+        self.running[lane] += 1
+        wait = now - entry[1]
+        self.dispatched[lane] += 1
+        self.total_wait[lane] += wait
+        self.max_wait[lane] = max(self.max_wait[lane], wait)
+        return entry[2]
+
+    def finished(self, task):
+        """
+        Call once task is done in order to free its slot in its lane
+        """
+        with self.mutex:
+            self.running[task.lane] -= 1
+            self.not_empty.notify()
 
     def lowest(self):
         """Return the lowest priority item in the queue (not reliable!)."""
         self.mutex.acquire()
         try:
-            lowest = self.queue and min(self.queue) or None
+            tasks = [x[2] for lane in self.queue.itervalues() for x in lane]
+            lowest = tasks and min(tasks) or None
         except Exception:
             lowest = None
             utils.ERROR(notify=True)
@@ -345,6 +489,21 @@ class MutablePriorityQueue(Queue.PriorityQueue):
             self.mutex.release()
         return lowest
 
+    def stats(self):
+        """
+        Returns a dict lane: dict with the lane's queue depth, number of
+        running and dispatched tasks and average and max. wait time in seconds
+        """
+        with self.mutex:
+            return dict((lane, {
+                'queued': len(self.queue[lane]),
+                'running': self.running[lane],
+                'dispatched': self.dispatched[lane],
+                'avg_wait': (self.total_wait[lane] / self.dispatched[lane]
+                             if self.dispatched[lane] else 0.0),
+                'max_wait': self.max_wait[lane]
+            }) for lane in LANES)
+
 
 class BackgroundWorker(object):
     def __init__(self, queue, name=None):
@@ -386,6 +545,7 @@ class BackgroundWorker(object):
             while not self.aborted():
                 self._task = self._queue.get_nowait()
                 self._runTask(self._task)
+                self._queue.finished(self._task)
                 self._queue.task_done()
                 self._task = None
         except Queue.Empty:
@@ -420,6 +580,7 @@ class NonstoppingBackgroundWorker(BackgroundWorker):
             self._working = True
             self._runTask(self._task)
             self._working = False
+            self._queue.finished(self._task)
             self._queue.task_done()
             self._task = None
         LOG.debug('Exiting Worker %s', self.name)
@@ -431,7 +592,7 @@ class NonstoppingBackgroundWorker(BackgroundWorker):
 class BackgroundThreader:
     def __init__(self, name=None, worker=BackgroundWorker, worker_count=6):
         self.name = name
-        self._queue = MutablePriorityQueue()
+        self._queue = LaneQueue()
         self._abort = False
         self.priority = -1
         self.workers = [
@@ -454,10 +615,17 @@ class BackgroundThreader:
 
     def shutdown(self, block=True):
         self.abort()
+        LOG.info('Task lanes of queue %s: %s', self.name, self.stats())
         self.addTasksToFront([ShutdownSentinel() for _ in self.workers])
         for w in self.workers:
             w.shutdown(block)
 
+    def stats(self):
+        """
+        Returns queue depth and wait time metrics per lane, see LaneQueue
+        """
+        return self._queue.stats()
+
     def addTask(self, task):
         task.priority = self._nextPriority()
         self._queue.put(task)
@@ -515,6 +683,7 @@ class ThreaderManager:
         self.index = 0
         self.abandoned = []
         self._workerhandler = worker
+        self._worker_count = worker_count
         self.threader = BackgroundThreader(name=str(self.index),
                                            worker=worker,
                                            worker_count=worker_count)
@@ -529,7 +698,8 @@ class ThreaderManager:
         self.index += 1
         self.abandoned.append(self.threader.abort())
         self.threader = BackgroundThreader(name=str(self.index),
-                                           worker=self._workerhandler)
+                                           worker=self._workerhandler,
+                                           worker_count=self._worker_count)
 
     def shutdown(self, block=True):
         self.threader.shutdown(block)
@@ -1,12 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from logging import getLogger
+import threading
 import sqlite3
 from functools import wraps
+from contextlib import contextmanager
 
 from . import variables as v, app
 
+LOG = getLogger('PLEX.db')
+
 DB_WRITE_ATTEMPTS = 100
 DB_CONNECTION_TIMEOUT = 10
+# Connections to these DBs are kept open for re-use by the same thread. The
+# plex-copy.db file is overwritten on every full sync - never keep it open
+PERSISTENT_MEDIA_TYPES = ('plex', 'video', 'music', 'texture')
+
+
+class _IdleConnections(threading.local):
+    """
+    Per thread: dict media_type: sqlite connection that is currently not in
+    use
+    """
+    def __init__(self):
+        self.connections = {}
+
+
+_IDLE = _IdleConnections()
 
 
 class LockedDatabase(Exception):
@@ -64,22 +84,25 @@ def _initial_db_connection_setup(conn):
     conn.execute('BEGIN')
 
 
-def connect(media_type=None):
-    """
-    Open a connection to the Kodi database.
-        media_type: 'video' (standard if not passed), 'plex', 'music', 'texture'
-    """
+def _db_path(media_type):
     if media_type == "plex":
-        db_path = v.DB_PLEX_PATH
+        return v.DB_PLEX_PATH
     elif media_type == 'plex-copy':
-        db_path = v.DB_PLEX_COPY_PATH
+        return v.DB_PLEX_COPY_PATH
     elif media_type == "music":
-        db_path = v.DB_MUSIC_PATH
+        return v.DB_MUSIC_PATH
     elif media_type == "texture":
-        db_path = v.DB_TEXTURE_PATH
+        return v.DB_TEXTURE_PATH
     else:
-        db_path = v.DB_VIDEO_PATH
-    conn = sqlite3.connect(db_path,
+        return v.DB_VIDEO_PATH
+
+
+def connect(media_type=None):
+    """
+    Open a connection to the Kodi database.
+        media_type: 'video' (standard if not passed), 'plex', 'music', 'texture'
+    """
+    conn = sqlite3.connect(_db_path(media_type),
                            timeout=DB_CONNECTION_TIMEOUT,
                            isolation_level=None)
     attempts = DB_WRITE_ATTEMPTS
@@ -100,3 +123,114 @@ def connect(media_type=None):
         else:
             break
     return conn
+
+
+def checkpoint(media_type=None):
+    """
+    Writes all changes that are still in the WAL file back to the main DB
+    file and truncates the WAL. As we keep connections open, closing the
+    last connection won't do this for us anymore. Returns False if other
+    connections prevented a complete checkpoint
+    """
+    conn = sqlite3.connect(_db_path(media_type),
+                           timeout=DB_CONNECTION_TIMEOUT,
+                           isolation_level=None)
+    try:
+        busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    finally:
+        conn.close()
+    return not busy
+
+
+def checkout(media_type=None):
+    """
+    Returns a connection to the database media_type (see connect()) with a
+    new transaction. Re-uses the warm connection that the current thread
+    returned with checkin() before - if it is still healthy. Thus we can skip
+    the connection set-up and keep the page cache.
+    Nested checkouts will receive a new connection.
+    """
+    conn = _IDLE.connections.pop(media_type, None)
+    if conn is not None:
+        try:
+            conn.execute('BEGIN')
+        except sqlite3.Error as err:
+            LOG.warn('Discarding unhealthy connection to %s db: %s',
+                     media_type, err)
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            conn = None
+    return conn or connect(media_type)
+
+
+def checkin(conn, media_type=None, commit=True):
+    """
+    Commits the transaction of a connection obtained by checkout() - or
+    rolls it back if commit=False. Keeps the connection open for the next
+    checkout() of the current thread.
+    """
+    try:
+        if commit:
+            conn.commit()
+        else:
+            conn.rollback()
+    except Exception:
+        conn.close()
+        raise
+    if (media_type in PERSISTENT_MEDIA_TYPES and
+            media_type not in _IDLE.connections):
+        _IDLE.connections[media_type] = conn
+    else:
+        conn.close()
+
+
+@contextmanager
+def savepoint(*connections):
+    """
+    Wraps the DB changes of the with-block in a SAVEPOINT on every connection
+    passed (None is skipped). On an exception, only these changes are rolled
+    back - the surrounding transaction is kept - and the exception re-raised
+    """
+    connections = [x for x in connections if x is not None]
+    for conn in connections:
+        conn.execute('SAVEPOINT pkc')
+    try:
+        yield
+    except Exception:
+        for conn in connections:
+            _end_savepoint(conn, rollback=True)
+        raise
+    for conn in connections:
+        _end_savepoint(conn)
+
+
+def _end_savepoint(conn, rollback=False):
+    try:
+        if rollback:
+            conn.execute('ROLLBACK TO pkc')
+        conn.execute('RELEASE pkc')
+    except sqlite3.OperationalError as err:
+        if 'no such savepoint' not in str(err):
+            raise
+        # catch_operationalerrors committed the transaction in the meantime
+        LOG.warn('Savepoint is gone, could not %s it',
+                 'roll back' if rollback else 'release')
+
+
+def checkin_all(connections, commit=True):
+    """
+    Calls checkin() for every (conn, media_type) tuple in connections, even
+    if one of them fails. Re-raises the first exception encountered
+    """
+    error = None
+    for conn, media_type in connections:
+        if conn is None:
+            continue
+        try:
+            checkin(conn, media_type, commit)
+        except Exception as err:
+            error = error or err
+    if error:
+        raise error
@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
+import threading
 import requests
 import requests.exceptions as exceptions
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, \
+    HTTPSConnectionPool
 
-from . import utils, clientinfo, app
+from . import utils, clientinfo, app, backgroundthread
 
 ###############################################################################
 
@@ -15,9 +18,144 @@ requests.packages.urllib3.disable_warnings()
 
 LOG = getLogger('PLEX.download')
 
+# Connections kept alive for browsing, playback, websockets etc.
+INTERACTIVE_CONNECTIONS = 4
+
+# Threads that should use the dedicated library sync session (if enabled)
+_THREAD_FLAGS = threading.local()
+
 ###############################################################################
 
 
+def use_sync_session(value=True):
+    """
+    Call from a library sync thread in order to use the dedicated library
+    sync connection pool for all subsequent downloads of this thread
+    """
+    _THREAD_FLAGS.sync = value
+
+
+def _is_sync_thread():
+    return getattr(_THREAD_FLAGS, 'sync', False)
+
+
+class _CountingPoolMixin(object):
+    """
+    Counts the connections a urllib3 connection pool discarded because the
+    pool was already full. urllib3 itself counts the connections created
+    (num_connections) and requests sent (num_requests)
+    """
+    num_discarded = 0
+
+    def _put_conn(self, conn):
+        if conn is not None and self.pool is not None and self.pool.full():
+            self.num_discarded += 1
+        super(_CountingPoolMixin, self)._put_conn(conn)
+
+
+class CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class PKCHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter that keeps statistics on how its connections are used
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super(PKCHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+    def pool_stats(self):
+        """
+        Returns a dict with the number of connections created, reused and
+        discarded (because the pool was full) for all hosts
+        """
+        stats = {'created': 0, 'reused': 0, 'discarded': 0}
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['created'] += pool.num_connections
+            stats['reused'] += max(0, pool.num_requests - pool.num_connections)
+            stats['discarded'] += getattr(pool, 'num_discarded', 0)
+        return stats
+
+
+class StreamingXML(object):
+    """
+    PMS xml answer that is parsed incrementally while it is being received.
+    Mimicks an etree xml: use xml.attrib or xml.get() to access the root
+    element's attributes. Iterate over this object ONCE to get the root's
+    children one by one, as soon as every child has been received entirely.
+    Children are detached from the root once they have been yielded, so the
+    complete answer is never held in memory - neither as raw bytes nor as
+    a tree.
+
+    successful will be set to False if the answer could not be received or
+    parsed completely.
+    """
+    def __init__(self, response):
+        self._response = response
+        response.raw.decode_content = True
+        self._parser = utils.defused_etree.iterparse(response.raw,
+                                                     events=('start', 'end'))
+        self.successful = True
+        # Parse until we have the root element's tag and attributes
+        _, self.root = next(self._parser)
+        self.tag = self.root.tag
+        self.attrib = self.root.attrib
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def close(self):
+        """
+        Closes the connection to the PMS right away. Call if you stop
+        iterating before the end
+        """
+        self._response.close()
+
+    def __iter__(self):
+        depth = 0
+        try:
+            for event, element in self._parser:
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 0:
+                    # A direct child of the root element is complete
+                    del self.root[:]
+                    yield element
+        except Exception as err:
+            LOG.error('Could not receive or parse xml from %s: %s',
+                      self._response.url, err)
+            self.successful = False
+        finally:
+            self._response.close()
+
+
+def _new_session(pool_size):
+    """
+    Returns a new requests session with a connection pool holding up to
+    pool_size connections per host
+    """
+    session = requests.Session()
+    # Retry connections to the server
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, PKCHTTPAdapter(pool_maxsize=pool_size,
+                                             max_retries=1))
+    return session
+
+
 class DownloadUtils():
     """
     Manages any up/downloads with PKC. Careful to initiate correctly
@@ -47,23 +185,43 @@ class DownloadUtils():
         verifySSL = app.CONN.verify_ssl_cert
         certificate = app.CONN.ssl_cert_path
         # Set the session's parameters
-        self.s.verify = verifySSL
-        if certificate:
-            self.s.cert = certificate
+        for session in self._sessions():
+            session.verify = verifySSL
+            if certificate:
+                session.cert = certificate
         LOG.debug("Verify SSL certificates set to: %s", verifySSL)
         LOG.debug("SSL client side certificate set to: %s", certificate)
 
+    def _sessions(self):
+        """
+        Returns a list of all currently active requests sessions
+        """
+        return [x for x in (getattr(self, 's', None),
+                            getattr(self, 'sync_s', None)) if x is not None]
+
     def startSession(self, reset=False):
         """
         User should be authenticated when this method is called
         """
+        # Size the connection pools so that every thread downloading
+        # simultaneously can keep its connection alive
+        sync_threads = (int(utils.settings('syncThreadNumber')) +
+                        backgroundthread.WORKER_COUNT)
+        pool_size = INTERACTIVE_CONNECTIONS + backgroundthread.WORKER_COUNT
+        if utils.settings('syncDedicatedConnectionPool') == 'true':
+            # Library sync won't starve browsing and playback
+            self.sync_s = _new_session(sync_threads)
+        else:
+            self.sync_s = None
+            pool_size += sync_threads
         # Start session
-        self.s = requests.Session()
+        self.s = _new_session(pool_size)
 
         self.deviceId = clientinfo.getDeviceId()
-        # Attach authenticated header to the session
-        self.s.headers = clientinfo.getXArgsDeviceInfo()
-        self.s.encoding = 'utf-8'
+        for session in self._sessions():
+            # Attach authenticated header to the session
+            session.headers = clientinfo.getXArgsDeviceInfo()
+            session.encoding = 'utf-8'
         # Set SSL settings
         self.setSSL()
 
@@ -72,23 +230,43 @@ class DownloadUtils():
             self.count_error = 0
             self.count_unauthorized = 0
 
-        # Retry connections to the server
-        self.s.mount("http://", requests.adapters.HTTPAdapter(max_retries=1))
-        self.s.mount("https://", requests.adapters.HTTPAdapter(max_retries=1))
-
-        LOG.debug("Requests session started on: %s", app.CONN.server)
+        LOG.debug("Requests session started on: %s with a pool size of %s, "
+                  "dedicated sync pool: %s",
+                  app.CONN.server, pool_size, self.sync_s is not None)
 
     def stopSession(self):
-        try:
-            self.s.close()
-        except Exception:
-            LOG.info("Requests session already closed")
+        LOG.debug('Connection pool stats: %s', self.pool_stats())
+        for session in self._sessions():
+            try:
+                session.close()
+            except Exception:
+                LOG.info("Requests session already closed")
         try:
             del self.s
         except AttributeError:
             pass
+        self.sync_s = None
         LOG.info('Request session stopped')
 
+    def pool_stats(self):
+        """
+        Returns a dict with the number of connections created, reused and
+        discarded (because the pool was full), for the standard session
+        'default' and the library sync session 'sync' (if it exists)
+        """
+        stats = {}
+        for name, session in (('default', getattr(self, 's', None)),
+                              ('sync', getattr(self, 'sync_s', None))):
+            if session is None:
+                continue
+            stats[name] = {'created': 0, 'reused': 0, 'discarded': 0}
+            for adapter in session.adapters.values():
+                if not isinstance(adapter, PKCHTTPAdapter):
+                    continue
+                for key, value in adapter.pool_stats().iteritems():
+                    stats[name][key] += value
+        return stats
+
     @staticmethod
     def getHeader(options=None):
         header = clientinfo.getXArgsDeviceInfo()
@@ -113,10 +291,13 @@ class DownloadUtils():
     def downloadUrl(self, url, action_type="GET", postBody=None,
                     parameters=None, authenticate=True, headerOptions=None,
                     verifySSL=True, timeout=None, return_response=False,
-                    headerOverride=None, reraise=False):
+                    headerOverride=None, reraise=False, stream=False):
         """
         Override SSL check with verifySSL=False
 
+        Set stream=True in order to receive a StreamingXML instead of an
+        etree xml; the xml will then be parsed while it is being received
+
         If authenticate=True, existing request session will be used/started
         Otherwise, 'empty' request will be made
 
@@ -125,7 +306,10 @@ class DownloadUtils():
             True               If connection worked but no body was received
             401, ...           integer if PMS answered with HTTP error 401
                                (unauthorized) or other http error codes
+            304                if we sent If-None-Match and the PMS answer
+                               did not change
             xml                xml etree root object, if applicable
+            StreamingXML       if stream=True is set (200, 201 only)
             json               json() object, if applicable
             <response-object>  if return_response=True is set (200, 201 only)
         """
@@ -138,6 +322,8 @@ class DownloadUtils():
                 LOG.info("Request session does not exist: start one")
                 self.startSession()
                 s = self.s
+            if _is_sync_thread() and getattr(self, 'sync_s', None):
+                s = self.sync_s
             # Replace for the real values
             url = url.replace("{server}", app.CONN.server)
         else:
@@ -165,6 +351,8 @@ class DownloadUtils():
             kwargs['params'] = parameters
         if timeout is not None:
             kwargs['timeout'] = timeout
+        if stream:
+            kwargs['stream'] = True
 
         # ACTUAL DOWNLOAD HAPPENING HERE
         success = False
@@ -231,6 +419,11 @@ class DownloadUtils():
                 r.content
                 return True
 
+            elif r.status_code == 304:
+                # Not Modified - our cached version is still valid
+                r.content
+                return 304
+
             elif r.status_code == 401:
                 if authenticate is False:
                     # Called when checking a connect - no need for rash action
@@ -261,6 +454,14 @@ class DownloadUtils():
                 if return_response is True:
                     # return the entire response object
                     return r
+                if stream:
+                    try:
+                        return StreamingXML(r)
+                    except Exception as err:
+                        LOG.warn('Unable to parse streamed xml from %s: %s',
+                                 url, err)
+                        r.close()
+                        return
                 try:
                     # xml response
                     r = utils.defused_etree.fromstring(r.content)
@@ -7,6 +7,7 @@ e.g. plugin://... calls. Hence be careful to only rely on window variables.
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
 import sys
+import hashlib
 
 import xbmc
 import xbmcplugin
@@ -14,18 +15,27 @@ from xbmcgui import ListItem
 
 from . import utils
 from . import path_ops
-from .downloadutils import DownloadUtils as DU
-from .plex_api import API, mass_api
-from . import plex_functions as PF
 from . import variables as v
 # Be careful - your using app in another Python instance!
-from . import app, widgets
-from .library_sync.nodes import NODE_TYPES
+from . import app, widget_cache, transfer
+from .lazy_import import LazyModule
+
+# Only import these once a mode needs them - e.g. cached widgets and the main
+# menu don't need requests nor the Plex DB
+downloadutils = LazyModule('.downloadutils', __package__)
+plex_api = LazyModule('.plex_api', __package__)
+PF = LazyModule('.plex_functions', __package__)
+widgets = LazyModule('.widgets', __package__)
+nodes = LazyModule('.library_sync.nodes', __package__)
 
 
 LOG = getLogger('PLEX.entrypoint')
 
 
+def DU():
+    return downloadutils.DownloadUtils()
+
+
 def guess_video_or_audio():
     """
     Returns either 'video', 'audio' or 'image', based how the user navigated to
@@ -179,18 +189,77 @@ def show_section(section_index):
     content = utils.window('%s.type' % node)
     plex_type = v.PLEX_TYPE_MOVIE if content == v.CONTENT_TYPE_MOVIE \
         else v.PLEX_TYPE_SHOW
-    for node_type, _, _, _, _ in NODE_TYPES[plex_type]:
+    for node_type, _, _, _, _ in nodes.NODE_TYPES[plex_type]:
         label = utils.window('%s.%s.title' % (node, node_type))
         path = utils.window('%s.%s.index' % (node, node_type))
         directory_item(label, path)
     xbmcplugin.endOfDirectory(int(sys.argv[1]))
 
 
-def show_listing(xml, plex_type=None, section_id=None, synched=True, key=None):
+def _download_listing(url, listing):
+    """
+    Downloads the PMS listing at url, asking the PMS whether our cached
+    widget_cache.Listing listing is still up-to-date. Uses PKC's service to
+    talk to the PMS, if possible. Returns the tuple
+        (xml, etag, digest)
+    xml is None if the download failed and True if listing is unchanged
+    """
+    headers = {'If-None-Match': listing.etag} if listing.etag else None
+    answ = transfer.pms_request(url, listing.etag)
+    if answ is None:
+        # Service not available, e.g. while PKC is starting up
+        answ = DU().downloadUrl(url,
+                                headerOptions=headers,
+                                return_response=True)
+        try:
+            answ = (200, answ.headers.get('ETag'), answ.content)
+        except AttributeError:
+            answ = (answ, None, None)
+    status, etag, content = answ
+    if status == 304 and listing.unchanged(listing.etag, None):
+        return True, None, None
+    if status != 200:
+        return None, None, None
+    digest = hashlib.md5(content).hexdigest()
+    if listing.unchanged(etag, digest):
+        return True, etag, digest
+    try:
+        xml = utils.defused_etree.fromstring(content)
+    except Exception as err:
+        LOG.error('Could not parse PMS answer for %s: %s', url, err)
+        xml = None
+    return xml, etag, digest
+
+
+def show_cached_listing(listing):
+    """
+    Shows the items of the widget_cache.Listing listing - no need to contact
+    the PMS or to process any items
+    """
+    LOG.debug('Showing cached listing %s', listing)
+    xbmcplugin.setContent(int(sys.argv[1]), listing.content_type)
+    _add_listitems(listing.items)
+
+
+def _add_listitems(all_items):
+    # fill that listing...
+    all_items = utils.process_method_on_list(widgets.create_listitem,
+                                             all_items)
+    xbmcplugin.addDirectoryItems(int(sys.argv[1]), all_items, len(all_items))
+    # end directory listing
+    xbmcplugin.addSortMethod(int(sys.argv[1]), xbmcplugin.SORT_METHOD_UNSORTED)
+    xbmcplugin.endOfDirectory(handle=int(sys.argv[1]))
+
+
+def show_listing(xml, plex_type=None, section_id=None, synched=True, key=None,
+                 listing=None, etag=None, digest=None):
     """
     Pass synched=False if the items have not been synched to the Kodi DB
 
     Kodi content type will be set using the very first item returned by the PMS
+
+    Pass a widget_cache.Listing as listing to cache the finished items, along
+    with the PMS' etag and the digest of its answer
     """
     try:
         xml[0]
@@ -199,7 +268,7 @@ def show_listing(xml, plex_type=None, section_id=None, synched=True, key=None):
                  xml.tag, xml.attrib)
         xbmcplugin.endOfDirectory(int(sys.argv[1]))
         return
-    api = API(xml[0])
+    api = plex_api.API(xml[0])
     # Determine content type for Kodi's Container.content
     if key == '/hubs/home/continueWatching':
         # Mix of movies and episodes
@@ -236,7 +305,7 @@ def show_listing(xml, plex_type=None, section_id=None, synched=True, key=None):
         content = guess_video_or_audio()
         if content:
             for entry in reversed(xml):
-                tmp_api = API(entry)
+                tmp_api = plex_api.API(entry)
                 if tmp_api.playlist_type() != content:
                     xml.remove(entry)
     if xml.get('librarySectionID'):
@@ -247,17 +316,15 @@ def show_listing(xml, plex_type=None, section_id=None, synched=True, key=None):
         # Need to chain keys for navigation
         widgets.KEY = key
     # Process all items to show
-    all_items = mass_api(xml)
+    all_items = plex_api.mass_api(xml)
+    widgets.get_kodi_details(all_items)
     all_items = utils.process_method_on_list(widgets.generate_item, all_items)
     all_items = utils.process_method_on_list(widgets.prepare_listitem,
                                              all_items)
-    # fill that listing...
-    all_items = utils.process_method_on_list(widgets.create_listitem,
-                                             all_items)
-    xbmcplugin.addDirectoryItems(int(sys.argv[1]), all_items, len(all_items))
-    # end directory listing
-    xbmcplugin.addSortMethod(int(sys.argv[1]), xbmcplugin.SORT_METHOD_UNSORTED)
-    xbmcplugin.endOfDirectory(handle=int(sys.argv[1]))
+    if listing and api.tag != 'Playlist':
+        # Playlists have been filtered depending on the active Kodi window
+        listing.store(content_type, all_items, etag, digest)
+    _add_listitems(all_items)
 
 
 def get_video_files(plex_id, params):
@@ -352,7 +419,7 @@ def extra_fanart(plex_id, plex_path):
             LOG.error('Could not download metadata for %s', plex_id)
             return xbmcplugin.endOfDirectory(int(sys.argv[1]))
 
-        api = API(xml[0])
+        api = plex_api.API(xml[0])
         backdrops = api.artwork()['Backdrop']
         for count, backdrop in enumerate(backdrops):
             # Same ordering as in artwork
@@ -397,7 +464,7 @@ def playlists(content_type):
         # This will be skipped if user selects a widget
         # Buggy xml.remove(child) requires reversed()
         for entry in reversed(xml):
-            api = API(entry)
+            api = plex_api.API(entry)
             if not api.playlist_type() == content_type:
                 xml.remove(entry)
     show_listing(xml)
@@ -414,7 +481,12 @@ def hub(content_type):
     if not _wait_for_auth():
         return xbmcplugin.endOfDirectory(int(sys.argv[1]), False)
     app.init(entrypoint=True)
-    xml = PF.get_plex_hub()
+    listing = widget_cache.Listing('/hubs', content_type=content_type)
+    if listing.fresh:
+        return show_cached_listing(listing)
+    xml, etag, digest = _download_listing('{server}/hubs', listing)
+    if xml is True:
+        return show_cached_listing(listing)
     try:
         xml.attrib
     except AttributeError:
@@ -424,7 +496,7 @@ def hub(content_type):
     # WARNING: using xml.remove(child) in for-loop requires traversing from
     # the end!
     for entry in reversed(xml):
-        api = API(entry)
+        api = plex_api.API(entry)
         append = False
         if content_type == 'video' and api.plex_type in v.PLEX_VIDEOTYPES:
             append = True
@@ -439,7 +511,7 @@ def hub(content_type):
             append = True
         if not append:
             xml.remove(entry)
-    show_listing(xml)
+    show_listing(xml, listing=listing, etag=etag, digest=digest)
 
 
 def watchlater():
@@ -490,7 +562,22 @@ def browse_plex(key=None, plex_type=None, section_id=None, synched=True,
             return
         prompt = prompt.strip().decode('utf-8')
         args['query'] = prompt
-    xml = DU().downloadUrl(utils.extend_url('{server}%s' % key, args))
+    url = utils.extend_url('{server}%s' % key, args)
+    if 'query' in args:
+        # Don't clutter our cache with searches
+        listing, etag, digest = None, None, None
+        xml = DU().downloadUrl(url)
+    else:
+        listing = widget_cache.Listing(key,
+                                       args,
+                                       section_id,
+                                       plex_type=plex_type,
+                                       synched=synched)
+        if listing.fresh:
+            return show_cached_listing(listing)
+        xml, etag, digest = _download_listing(url, listing)
+        if xml is True:
+            return show_cached_listing(listing)
     try:
         xml[0].attrib
     except (TypeError, IndexError, AttributeError):
@@ -505,7 +592,7 @@ def browse_plex(key=None, plex_type=None, section_id=None, synched=True,
                 # Empty category
                 continue
             for entry in hub:
-                api = API(entry)
+                api = plex_api.API(entry)
                 if api.plex_type == v.PLEX_TYPE_TAG:
                     # Append the type before the actual element for all "tags"
                     # like genres, actors, etc.
@@ -513,7 +600,8 @@ def browse_plex(key=None, plex_type=None, section_id=None, synched=True,
                                                       api.tag_label())
                 answ.append(entry)
         xml = answ
-    show_listing(xml, plex_type, section_id, synched, key)
+    show_listing(xml, plex_type, section_id, synched, key,
+                 listing=listing, etag=etag, digest=digest)
 
 
 def extras(plex_id):
@@ -529,7 +617,7 @@ def extras(plex_id):
     except (TypeError, IndexError, KeyError):
         xbmcplugin.endOfDirectory(int(sys.argv[1]))
         return
-    extras = API(xml[0]).extras()
+    extras = plex_api.API(xml[0]).extras()
     if extras is None:
         return
     for child in xml:
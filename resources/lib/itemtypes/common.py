@@ -57,11 +57,11 @@ class ItemBase(object):
         if self.lock:
             PLEXDB_LOCK.acquire()
             KODIDB_LOCK.acquire()
-        self.plexconn = db.connect('plex')
+        self.plexconn = db.checkout('plex')
         self.plexcursor = self.plexconn.cursor()
-        self.kodiconn = db.connect('video')
+        self.kodiconn = db.checkout('video')
         self.kodicursor = self.kodiconn.cursor()
-        self.artconn = db.connect('texture')
+        self.artconn = db.checkout('texture')
         self.artcursor = self.artconn.cursor()
         self.plexdb = PlexDB(plexconn=self.plexconn, lock=False)
         self.kodidb = KodiVideoDB(texture_db=True,
@@ -72,28 +72,32 @@ class ItemBase(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
-        Make sure DB changes are committed and connection to DB is closed.
+        Make sure DB changes are committed (or rolled back on an exception) and
+        the connections are returned for later re-use
         """
         try:
-            if exc_type:
-                # re-raise any exception
-                return False
-            self.plexconn.commit()
-            self.kodiconn.commit()
-            if self.artconn:
-                self.artconn.commit()
-            return self
+            db.checkin_all(((self.plexconn, 'plex'),
+                            (self.kodiconn, self.kodidb.db_kind),
+                            (self.artconn, 'texture')),
+                           commit=exc_type is None)
+            self.plexdb.invalidate_touched()
+            # re-raise any exception
+            return False if exc_type else self
         finally:
-            self.plexconn.close()
-            self.kodiconn.close()
-            if self.artconn:
-                self.artconn.close()
             if self.lock:
                 PLEXDB_LOCK.release()
                 KODIDB_LOCK.release()
 
+    def savepoint(self):
+        """
+        Use "with self.savepoint():" to roll back all DB changes within the
+        with-block on an exception, keeping the rest of the transaction
+        """
+        return db.savepoint(self.plexconn, self.kodiconn, self.artconn)
+
     def commit(self):
         self.plexconn.commit()
+        self.plexdb.invalidate_touched()
         self.plexconn.execute('BEGIN')
         self.kodiconn.commit()
         self.kodiconn.execute('BEGIN')
@@ -20,11 +20,11 @@ class MusicMixin(object):
         if self.lock:
             PLEXDB_LOCK.acquire()
             KODIDB_LOCK.acquire()
-        self.plexconn = db.connect('plex')
+        self.plexconn = db.checkout('plex')
         self.plexcursor = self.plexconn.cursor()
-        self.kodiconn = db.connect('music')
+        self.kodiconn = db.checkout('music')
         self.kodicursor = self.kodiconn.cursor()
-        self.artconn = db.connect('texture')
+        self.artconn = db.checkout('texture')
         self.artcursor = self.artconn.cursor()
         self.plexdb = PlexDB(plexconn=self.plexconn, lock=False)
         self.kodidb = KodiMusicDB(texture_db=True,
@@ -28,6 +28,8 @@ JSON_FROM_KODITYPE = {
     v.KODI_TYPE_SET: ('VideoLibrary.GetMovieSetDetails',
                       []),
 }
+# Maximum number of calls we send to Kodi with one JSON-RPC batch
+BATCH_SIZE = 100
 
 
 class JsonRPC(object):
@@ -63,6 +65,31 @@ class JsonRPC(object):
         self.params = params
         return loads(executeJSONRPC(self._query()))
 
+    @classmethod
+    def batch(cls, calls):
+        """
+        Sends several calls to Kodi in one go using a JSON-RPC 2.0 batch. Pass
+        in a list of (method, params) tuples. Returns Kodi's answers as a list
+        of dicts in the same order - None if Kodi did not answer a call
+        """
+        query = []
+        for id_, (method, params) in enumerate(calls):
+            call = {'jsonrpc': cls.version, 'id': id_, 'method': method}
+            if params is not None:
+                call['params'] = params
+            query.append(call)
+        answ = loads(executeJSONRPC(dumps(query)))
+        ret = [None] * len(calls)
+        if not isinstance(answ, list):
+            # E.g. {'error': ...} if Kodi could not parse our batch
+            return ret
+        for reply in answ:
+            try:
+                ret[reply['id']] = reply
+            except (KeyError, IndexError, TypeError):
+                pass
+        return ret
+
 
 def get_players():
     """
@@ -126,6 +153,16 @@ def get_volume():
         {"properties": ['volume']})['result']['volume']
 
 
+def get_volume_muted():
+    """
+    Returns the tuple (volume, muted) using a single call to Kodi. volume is
+    an int between 0 (min) and 100 (max), muted is True if Kodi is muted
+    """
+    answ = JsonRPC('Application.GetProperties').execute(
+        {"properties": ['volume', 'muted']})['result']
+    return answ['volume'], answ['muted']
+
+
 def set_volume(volume):
     """
     Set's the volume (for Kodi overall, not only a player).
@@ -589,3 +626,24 @@ def item_details(kodi_id, kodi_type):
         return ret['result']['%sdetails' % kodi_type]
     except (KeyError, TypeError):
         return {}
+
+
+def items_details(items):
+    '''
+    Pass in a list of (kodi_id, kodi_type) tuples. Returns a list of Kodi item
+    dicts in the same order, fetched with as few JSON-RPC calls as possible
+    '''
+    ret = []
+    for i in range(0, len(items), BATCH_SIZE):
+        calls = []
+        for kodi_id, kodi_type in items[i:i + BATCH_SIZE]:
+            json, fields = JSON_FROM_KODITYPE[kodi_type]
+            calls.append((json, {'%sid' % kodi_type: kodi_id,
+                                 'properties': fields}))
+        answ = JsonRPC.batch(calls)
+        for (_, kodi_type), reply in zip(items[i:i + BATCH_SIZE], answ):
+            try:
+                ret.append(reply['result']['%sdetails' % kodi_type])
+            except (KeyError, TypeError):
+                ret.append({})
+    return ret
@@ -29,25 +29,22 @@ class KodiDBBase(object):
     def __enter__(self):
         if self.lock:
             KODIDB_LOCK.acquire()
-        self.kodiconn = db.connect(self.db_kind)
+        self.kodiconn = db.checkout(self.db_kind)
         self.cursor = self.kodiconn.cursor()
-        self.artconn = db.connect('texture') if self._texture_db \
+        self.artconn = db.checkout('texture') if self._texture_db \
             else None
         self.artcursor = self.artconn.cursor() if self._texture_db else None
         return self
 
     def __exit__(self, e_typ, e_val, trcbak):
         try:
+            db.checkin_all(((self.kodiconn, self.db_kind),
+                            (self.artconn, 'texture')),
+                           commit=e_typ is None)
             if e_typ:
                 # re-raise any exception
                 return False
-            self.kodiconn.commit()
-            if self.artconn:
-                self.artconn.commit()
         finally:
-            self.kodiconn.close()
-            if self.artconn:
-                self.artconn.close()
             if self.lock:
                 KODIDB_LOCK.release()
 
@@ -56,10 +53,18 @@ class KodiDBBase(object):
                 self.cursor.execute('SELECT url FROM art WHERE media_id = ? AND media_type = ?',
                                     (kodi_id, kodi_type)))
 
-    def artwork_generator(self, kodi_type, limit, offset):
-        query = 'SELECT url FROM art WHERE type == ? LIMIT ? OFFSET ?'
-        return (x[0] for x in
-                self.cursor.execute(query, (kodi_type, limit, offset)))
+    def artwork_urls(self, kodi_type, art_id, limit):
+        """
+        Returns a list of up to limit tuples (art_id, url) for the artwork of
+        kind kodi_type, sorted by art_id and starting after art_id
+        """
+        self.cursor.execute('''
+            SELECT art_id, url FROM art
+            WHERE type = ? AND art_id > ?
+            ORDER BY art_id
+            LIMIT ?
+        ''', (kodi_type, art_id, limit))
+        return self.cursor.fetchall()
 
     def add_artwork(self, artworks, kodi_id, kodi_type):
         """
@@ -15,3 +15,16 @@ class KodiTextureDB(common.KodiDBBase):
         self.artcursor.execute('SELECT url FROM texture WHERE url = ? LIMIT 1',
                                (url, ))
         return self.artcursor.fetchone() is None
+
+    def uncached_urls(self, urls):
+        """
+        Returns the list of all urls that have not yet been cached to the Kodi
+        texture cache, in their original order. Uses one single SELECT, so
+        pass in at most 999 urls
+        """
+        if not urls:
+            return []
+        self.artcursor.execute('SELECT url FROM texture WHERE url IN (%s)'
+                               % ','.join('?' * len(urls)), urls)
+        cached = set(x[0] for x in self.artcursor)
+        return [x for x in urls if x not in cached]
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
+from collections import Counter
 from sqlite3 import IntegrityError
 
 from . import common
@@ -9,10 +10,53 @@ from .. import db, path_ops, timing, variables as v
 
 LOG = getLogger('PLEX.kodi_db.video')
 
+# SQLite allows at most 999 host parameters per statement
+MAX_SQL_VARIABLES = 500
+# SQLite's NOCASE collation only folds the 26 ASCII letters
+_ASCII_LOWER = {i: i + 32 for i in range(ord('A'), ord('Z') + 1)}
+
 MOVIE_PATH = 'plugin://%s.movies/' % v.ADDON_ID
 SHOW_PATH = 'plugin://%s.tvshows/' % v.ADDON_ID
 
 
+def _nocase(name):
+    return unicode(name).translate(_ASCII_LOWER)
+
+
+def _unique(items, key=None):
+    """
+    Returns a list of items without duplicates, preserving their order
+    """
+    seen = set()
+    result = []
+    for item in items:
+        marker = key(item) if key else item
+        if marker not in seen:
+            seen.add(marker)
+            result.append(item)
+    return result
+
+
+def _take(counter, item):
+    """
+    Decrements counter[item] and returns True if the count was positive
+    """
+    if counter[item] > 0:
+        counter[item] -= 1
+        return True
+    return False
+
+
+def _chunks(items, size=MAX_SQL_VARIABLES):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _placeholders(items):
+    return ','.join('?' * len(items))
+
+
 class KodiVideoDB(common.KodiDBBase):
     db_kind = 'video'
 
@@ -220,49 +264,88 @@ class KodiVideoDB(common.KodiDBBase):
     @db.catch_operationalerrors
     def _modify_link_and_table(self, kodi_id, kodi_type, entries, link_table,
                                table, key, first_id=None):
-        first_id = first_id if first_id is not None else 1
-        entry_ids = []
-        for entry in entries:
-            self.cursor.execute('''
-                SELECT %s FROM %s WHERE name = ? COLLATE NOCASE LIMIT 1
-            ''' % (key, table), (entry, ))
-            try:
-                entry_id = self.cursor.fetchone()[0]
-            except TypeError:
-                self.cursor.execute('INSERT INTO %s(name) VALUES(?)' % table,
-                                    (entry, ))
-                entry_id = self.cursor.lastrowid
-            finally:
-                entry_ids.append(entry_id)
-        # Now process the ids obtained from the names
-        # Get the existing, old entries
-        outdated_entries = []
-        for entry_id in self.cursor.execute('SELECT %s FROM %s WHERE media_id = ? AND media_type = ?'
-                                            % (key, link_table), (kodi_id, kodi_type)):
-            try:
-                entry_ids.remove(entry_id[0])
-            except ValueError:
-                outdated_entries.append(entry_id[0])
+        # Resolve all names at once, adding the ones that are still missing
+        entry_ids, _ = self._get_or_add_ids(entries, table, key, nocase=True)
+        entry_ids = _unique(entry_ids[_nocase(x)] for x in entries)
+        # Get the existing, old entries and diff them against the new ones
+        self.cursor.execute('SELECT %s FROM %s WHERE media_id = ? AND media_type = ?'
+                            % (key, link_table), (kodi_id, kodi_type))
+        old_ids = set(x[0] for x in self.cursor.fetchall())
+        outdated_entries = old_ids.difference(entry_ids)
         # Add all new entries that haven't already been added
-        for entry_id in entry_ids:
-            try:
-                self.cursor.execute('INSERT INTO %s VALUES (?, ?, ?)' % link_table,
-                                    (entry_id, kodi_id, kodi_type))
-            except IntegrityError:
-                LOG.info('IntegrityError: skipping entry %s for table %s',
-                         entry_id, link_table)
-        # Delete all outdated references in the link table. Also check whether
-        # we need to delete orphaned entries in the master table
-        for entry_id in outdated_entries:
+        self._insert_links('INSERT INTO %s VALUES (?, ?, ?)' % link_table,
+                           [(x, kodi_id, kodi_type) for x in entry_ids
+                            if x not in old_ids],
+                           link_table=link_table)
+        # Delete all outdated references in the link table. Then delete the
+        # entries in the master table that are orphaned now
+        for chunk in _chunks(outdated_entries):
             self.cursor.execute('''
-                DELETE FROM %s WHERE %s = ? AND media_id = ? AND media_type = ?
-            ''' % (link_table, key), (entry_id, kodi_id, kodi_type))
-            self.cursor.execute('SELECT %s FROM %s WHERE %s = ?' % (key, link_table, key),
-                                (entry_id, ))
-            if self.cursor.fetchone() is None:
-                # Delete in the original table because entry is now orphaned
-                self.cursor.execute('DELETE FROM %s WHERE %s = ?' % (table, key),
-                                    (entry_id, ))
+                DELETE FROM %s
+                WHERE media_id = ? AND media_type = ? AND %s IN (%s)
+            ''' % (link_table, key, _placeholders(chunk)),
+                [kodi_id, kodi_type] + chunk)
+            self.cursor.execute('''
+                DELETE FROM {0}
+                WHERE {1} IN ({2}) AND NOT EXISTS(
+                    SELECT 1 FROM {3} WHERE {3}.{1} = {0}.{1})
+            '''.format(table, key, _placeholders(chunk), link_table), chunk)
+
+    def _ids_by_name(self, names, table, key, nocase):
+        """
+        Returns a dict {name: id} for all names [unicode] found in table,
+        using one SELECT per MAX_SQL_VARIABLES names. With nocase, names are
+        matched like SQLite's NOCASE collation and the dict is keyed by
+        _nocase(name). If several rows match, the first one wins just like
+        with SELECT ... LIMIT 1
+        """
+        ids = {}
+        collate = ' COLLATE NOCASE' if nocase else ''
+        for chunk in _chunks(names):
+            self.cursor.execute('SELECT %s, name FROM %s WHERE name%s IN (%s)'
+                                % (key, table, collate, _placeholders(chunk)),
+                                chunk)
+            for entry_id, name in self.cursor.fetchall():
+                ids.setdefault(_nocase(name) if nocase else name, entry_id)
+        return ids
+
+    def _get_or_add_ids(self, names, table, key, nocase):
+        """
+        Returns the tuple
+            (ids [dict], new_ids [set])
+        with ids as returned by _ids_by_name for all names [unicode]. Names
+        not yet in table are added using one executemany; their ids are
+        returned in new_ids
+        """
+        fold = _nocase if nocase else lambda x: x
+        names = _unique(names, key=fold)
+        ids = self._ids_by_name(names, table, key, nocase)
+        missing = [(x, ) for x in names if fold(x) not in ids]
+        if not missing:
+            return ids, set()
+        self.cursor.executemany('INSERT INTO %s(name) VALUES(?)' % table,
+                                missing)
+        new_ids = self._ids_by_name([x[0] for x in missing], table, key, nocase)
+        ids.update(new_ids)
+        return ids, set(new_ids.itervalues())
+
+    def _insert_links(self, query, rows, link_table=None):
+        """
+        Inserts all rows using one executemany. Should a row violate a
+        constraint, rolls back the rows executemany inserted already and
+        falls back to inserting row by row, skipping the offending rows
+        """
+        try:
+            with db.savepoint(self.kodiconn):
+                self.cursor.executemany(query, rows)
+        except IntegrityError:
+            for row in rows:
+                try:
+                    self.cursor.execute(query, row)
+                except IntegrityError:
+                    if link_table:
+                        LOG.info('IntegrityError: skipping entry %s for table %s',
+                                 row[0], link_table)
 
     def modify_countries(self, kodi_id, kodi_type, countries=None):
         """
@@ -323,36 +406,24 @@ class KodiVideoDB(common.KodiDBBase):
 
     @db.catch_operationalerrors
     def _add_people_kind(self, kodi_id, kodi_type, kind, people_list):
-        # Save new people to Kodi DB by iterating over the remaining entries
+        if not people_list:
+            return
+        # Make sure the person entries in table actor exist
+        actor_ids, new_ids = self._get_or_add_ids([x[0] for x in people_list],
+                                                  'actor',
+                                                  'actor_id',
+                                                  nocase=False)
         if kind == 'actor':
-            for person in people_list:
-                # Make sure the person entry in table actor exists
-                actor_id, new = self._get_actor_id(person[0],
-                                                   art_url=person[1])
-                if not new and person[1]:
-                    # Person might have shown up as a director or writer first
-                    # WITHOUT an art url from the Plex side!
-                    # Check here if we need to set the actor's art url
-                    self._check_actor_art(actor_id, person[1])
-                # Link the person with the media element
-                try:
-                    self.cursor.execute('INSERT INTO actor_link VALUES (?, ?, ?, ?, ?)',
-                                        (actor_id, kodi_id, kodi_type,
-                                         person[2], person[3]))
-                except IntegrityError:
-                    # With Kodi, an actor may have only one role, unlike Plex
-                    pass
+            self._add_actor_art(actor_ids, new_ids, people_list)
+            query = 'INSERT INTO actor_link VALUES (?, ?, ?, ?, ?)'
+            rows = [(actor_ids[x[0]], kodi_id, kodi_type, x[2], x[3])
+                    for x in people_list]
         else:
-            for person in people_list:
-                # Make sure the person entry in table actor exists:
-                actor_id, _ = self._get_actor_id(person[0])
-                # Link the person with the media element
-                try:
-                    self.cursor.execute('INSERT INTO %s_link VALUES (?, ?, ?)' % kind,
-                                        (actor_id, kodi_id, kodi_type))
-                except IntegrityError:
-                    # Again, Kodi may have only one person assigned to a role
-                    pass
+            query = 'INSERT INTO %s_link VALUES (?, ?, ?)' % kind
+            rows = [(actor_ids[x[0]], kodi_id, kodi_type) for x in people_list]
+        # With Kodi, a person may have only one role, unlike Plex. Such rows
+        # will be skipped
+        self._insert_links(query, _unique(rows, key=lambda x: x[:3]))
 
     def modify_people(self, kodi_id, kodi_type, people=None):
         """
@@ -387,78 +458,63 @@ class KodiVideoDB(common.KodiDBBase):
                 WHERE {0}_link.media_id = ? AND {0}_link.media_type = ?
             '''.format(kind)
         self.cursor.execute(query, (kodi_id, kodi_type))
-        old_people = self.cursor.fetchall()
         # Determine which people we need to save or delete
-        outdated_people = []
-        for person in old_people:
-            try:
-                people_list.remove(person[1:])
-            except ValueError:
-                outdated_people.append(person)
-        # Get rid of old entries
-        query = '''
-            DELETE FROM %s_link
-            WHERE actor_id = ? AND media_id = ? AND media_type = ?
-        ''' % kind
-        query_actor_check = 'SELECT actor_id FROM %s_link WHERE actor_id = ?'
-        query_actor_delete = 'DELETE FROM actor WHERE actor_id = ?'
-        for person in outdated_people:
-            # Delete the outdated entry
-            self.cursor.execute(query, (person[0], kodi_id, kodi_type))
-            # Do we now have orphaned entries?
-            for person_kind in ('actor', 'writer', 'director'):
-                self.cursor.execute(query_actor_check % person_kind,
-                                    (person[0],))
-                if self.cursor.fetchone() is not None:
-                    break
-            else:
-                # person entry in actor table is now orphaned
-                # Delete the person from actor table
-                self.cursor.execute(query_actor_delete, (person[0],))
-                if kind == 'actor':
-                    # Delete any associated artwork
-                    self.delete_artwork(person[0], 'actor')
+        wanted = Counter(people_list)
+        outdated_people = set()
+        for person in self.cursor.fetchall():
+            if not _take(wanted, person[1:]):
+                outdated_people.add(person[0])
+        people_list = [x for x in people_list if _take(wanted, x)]
+        # Get rid of old entries, then of the people that are orphaned now
+        for chunk in _chunks(outdated_people):
+            self.cursor.execute('''
+                DELETE FROM %s_link
+                WHERE media_id = ? AND media_type = ? AND actor_id IN (%s)
+            ''' % (kind, _placeholders(chunk)), [kodi_id, kodi_type] + chunk)
+            self.cursor.execute('''
+                SELECT actor_id FROM actor
+                WHERE actor_id IN (%s)
+                    AND NOT EXISTS(SELECT 1 FROM actor_link
+                                   WHERE actor_link.actor_id = actor.actor_id)
+                    AND NOT EXISTS(SELECT 1 FROM writer_link
+                                   WHERE writer_link.actor_id = actor.actor_id)
+                    AND NOT EXISTS(SELECT 1 FROM director_link
+                                   WHERE director_link.actor_id = actor.actor_id)
+            ''' % _placeholders(chunk), chunk)
+            orphans = [x[0] for x in self.cursor.fetchall()]
+            if not orphans:
+                continue
+            # Delete the people from actor table
+            self.cursor.execute('DELETE FROM actor WHERE actor_id IN (%s)'
+                                % _placeholders(orphans), orphans)
+            if kind == 'actor':
+                # Delete any associated artwork
+                for actor_id in orphans:
+                    self.delete_artwork(actor_id, 'actor')
         # Save new people to Kodi DB by iterating over the remaining entries
         self._add_people_kind(kodi_id, kodi_type, kind, people_list)
 
-    @db.catch_operationalerrors
-    def _new_actor_id(self, name, art_url):
-        # Not yet in actor DB, add person
-        self.cursor.execute('INSERT INTO actor(name) VALUES (?)', (name, ))
-        actor_id = self.cursor.lastrowid
-        if art_url:
-            self.add_art(art_url, actor_id, 'actor', 'thumb')
-        return actor_id
-
-    def _get_actor_id(self, name, art_url=None):
+    def _add_actor_art(self, actor_ids, new_ids, people_list):
         """
-        Returns the tuple
-            (actor_id [int], new_entry [bool])
-        for name [unicode] in table actor (without ensuring that the name
-        matches)."new_entry" will be True if a new DB entry has just been
-        created.
-        If not, will create a new record with actor_id, name, art_url
-
-        Uses Plex ids and thus assumes that Plex person id is unique!
+        Sets the art url of all actors in people_list that do not have any
+        art yet. A person might have shown up as a director or writer first
+        WITHOUT an art url from the Plex side!
         """
-        self.cursor.execute('SELECT actor_id FROM actor WHERE name=? LIMIT 1',
-                            (name,))
-        try:
-            return (self.cursor.fetchone()[0], False)
-        except TypeError:
-            return (self._new_actor_id(name, art_url), True)
-
-    def _check_actor_art(self, actor_id, url):
-        """
-        Sets the actor's art url [unicode] for actor_id [int]
-        """
-        self.cursor.execute('''
-            SELECT EXISTS(SELECT 1 FROM art
-                          WHERE media_id = ? AND media_type = 'actor'
-                          LIMIT 1)''', (actor_id, ))
-        if not self.cursor.fetchone()[0]:
-            # We got a new artwork url for this actor!
-            self.add_art(url, actor_id, 'actor', 'thumb')
+        urls = {}
+        for person in people_list:
+            if person[1]:
+                urls.setdefault(actor_ids[person[0]], person[1])
+        for chunk in _chunks(x for x in urls if x not in new_ids):
+            self.cursor.execute('''
+                SELECT DISTINCT media_id FROM art
+                WHERE media_type = 'actor' AND media_id IN (%s)
+            ''' % _placeholders(chunk), chunk)
+            for row in self.cursor.fetchall():
+                del urls[row[0]]
+        self.cursor.executemany('''
+            INSERT INTO art(media_id, media_type, type, url)
+            VALUES (?, 'actor', 'thumb', ?)
+        ''', urls.items())
 
     def get_art(self, kodi_id, kodi_type):
         """
@@ -18,10 +18,13 @@ from . import kodi_db
 from .downloadutils import DownloadUtils as DU
 from . import utils, timing, plex_functions as PF
 from . import json_rpc as js, playqueue as PQ, playlist_func as PL
-from . import backgroundthread, app, variables as v
+from . import backgroundthread, widget_cache, app, variables as v
 
 LOG = getLogger('PLEX.kodimonitor')
 
+# Kodi notifications (besides Playlist.*) hinting at a changed Kodi playqueue
+PLAYQUEUE_METHODS = ('Player.OnPlay', 'Player.OnAVStart', 'Player.OnStop')
+
 
 class KodiMonitor(xbmc.Monitor):
     """
@@ -101,6 +104,13 @@ class KodiMonitor(xbmc.Monitor):
             app.APP.stop_pkc = True
         elif method == 'Other.plugin.video.plexkodiconnect_play_action':
             self._start_next_episode(data)
+        elif method == 'Other.plexkodiconnect.command':
+            # Another PKC Python instance sent a command via the window
+            # property plexkodiconnect.command
+            app.APP.service_wakeup.set()
+        if method.startswith('Playlist.') or method in PLAYQUEUE_METHODS:
+            # Let the PlayqueueMonitor compare the Kodi playqueues right away
+            app.APP.playqueue_wakeup.set()
 
     def _playlist_onadd(self, data):
         """
@@ -462,12 +472,15 @@ def _record_playstate(status, ended):
                               totaltime,
                               playcount,
                               last_played)
+    # Resume points and watched states have changed
+    widget_cache.invalidate(db_item['section_id'])
     # Hack to force "in progress" widget to appear if it wasn't visible before
     if (app.APP.force_reload_skin and
             xbmc.getCondVisibility('Window.IsVisible(Home.xml)')):
         LOG.debug('Refreshing skin to update widgets')
         xbmc.executebuiltin('ReloadSkin()')
     task = backgroundthread.FunctionAsTask(_clean_file_table, None)
+    task.lane = backgroundthread.LANE_BACKGROUND
     backgroundthread.BGThreader.addTasksToFront([task])
 
 
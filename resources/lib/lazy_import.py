@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Every plugin:// call (menu click, widget refresh) starts a new Python
+instance that needs to import PKC again. Use LazyModule for heavy modules,
+e.g. those pulling in requests or the Plex DB, so we only pay for the modules
+a mode actually uses.
+"""
+from __future__ import absolute_import, division, unicode_literals
+from logging import getLogger
+from importlib import import_module
+from time import time
+
+LOG = getLogger('PLEX.lazy_import')
+
+
+class LazyModule(object):
+    """
+    Stands in for the module name (relative to package, if passed) and
+    imports it only once one of its attributes is accessed. Logs how long the
+    import took
+    """
+    def __init__(self, name, package=None):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_package', package)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self):
+        if self._module is None:
+            start = time()
+            module = import_module(self._name, self._package)
+            object.__setattr__(self, '_module', module)
+            LOG.debug('Importing %s took %.3f seconds',
+                      module.__name__, time() - start)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return '<LazyModule %s, loaded: %s>' % (self._name,
+                                                self._module is not None)
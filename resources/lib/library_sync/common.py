@@ -4,7 +4,7 @@ from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
 import xbmc
 
-from .. import utils, app, variables as v
+from .. import utils, app, downloadutils, variables as v
 
 LOG = getLogger('PLEX.sync')
 
@@ -28,12 +28,14 @@ class LibrarySyncMixin(object):
     def run(self):
         app.APP.register_thread(self)
         LOG.debug('##===--- Starting %s ---===##', self.__class__.__name__)
+        downloadutils.use_sync_session(True)
         try:
             self._run()
         except Exception as err:
             LOG.error('Exception encountered: %s', err)
             utils.ERROR(notify=True)
         finally:
+            downloadutils.use_sync_session(False)
             app.APP.deregister_thread(self)
             LOG.debug('##===--- %s Stopped ---===##', self.__class__.__name__)
 
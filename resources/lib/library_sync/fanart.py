@@ -78,6 +78,8 @@ class FanartTask(backgroundthread.Task):
     """
     This task will also be executed while library sync is suspended!
     """
+    lane = backgroundthread.LANE_BACKGROUND
+
     def setup(self, plex_id, plex_type, refresh=False):
         self.plex_id = plex_id
         self.plex_type = plex_type
@@ -1,78 +1,332 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
-from Queue import Full
+from collections import deque
+from Queue import Full, Empty
+import Queue
 
 from . import common, sections
 from ..plex_db import PlexDB
-from .. import backgroundthread
+from .. import backgroundthread, utils, variables as v
 
 LOG = getLogger('PLEX.sync.fill_metadata_queue')
 
 QUEUE_TIMEOUT = 60  # seconds
+# Sections with less items from the PMS will use one SELECT per item
+CHECKSUM_POINT_LOOKUP_LIMIT = 100
+# Max. number of (plex_id, checksum) pairs held in memory for one section.
+# Bigger sections are compared using a merge-join on the sorted plex_ids
+CHECKSUM_PRELOAD_LIMIT = 50000
+# Number of sections we download and compare with the plex.db at once
+PARALLEL_SECTIONS = 3
+# Max. number of compared items we hold in memory per section while we're
+# still busy queueing an earlier section
+SECTION_BUFFER_SIZE = 2000
+
+
+class PointChecksums(object):
+    """
+    Looks up the checksum for every single plex_id with a dedicated SELECT
+    """
+    def __init__(self, plexdb, plex_type):
+        self.plexdb = plexdb
+        self.plex_type = plex_type
+
+    def get(self, plex_id):
+        return self.plexdb.checksum(plex_id, self.plex_type)
+
+
+class MergeJoinChecksums(PointChecksums):
+    """
+    Walks the plex.db entries of a section, sorted by plex_id, in lockstep
+    with the PMS items that the PMS sends sorted by id as well. Will fall back
+    to a SELECT for items that arrive out of order
+    """
+    def __init__(self, plexdb, plex_type, section_id):
+        super(MergeJoinChecksums, self).__init__(plexdb, plex_type)
+        self._rows = plexdb.checksums_by_sectionid(section_id, plex_type)
+        self._head = next(self._rows, None)
+        self._last_plex_id = -1
+
+    def get(self, plex_id):
+        if plex_id < self._last_plex_id:
+            return super(MergeJoinChecksums, self).get(plex_id)
+        self._last_plex_id = plex_id
+        while self._head is not None and self._head[0] < plex_id:
+            self._head = next(self._rows, None)
+        if self._head is not None and self._head[0] == plex_id:
+            return self._head[1]
+
+
+class SectionMergeJoin(object):
+    """
+    Walks all plex.db entries of a section, sorted by plex_id, in lockstep
+    with ALL the PMS items of the same section (also sorted by id). plex.db
+    entries that the PMS did not send are remembered - the PMS deleted these
+    items. Items arriving out of order are still matched correctly, at the
+    cost of holding more entries in memory
+    """
+    def __init__(self, plexdb, plex_type, section_id):
+        self._rows = plexdb.checksums_by_sectionid(section_id, plex_type)
+        self._head = next(self._rows, None)
+        self._last_plex_id = -1
+        # Dict plex_id: checksum for the entries the PMS did not (yet) send
+        self._missing = {}
+
+    def get(self, plex_id):
+        """
+        Returns the plex.db checksum for plex_id or None if the item is not in
+        the plex.db
+        """
+        if plex_id < self._last_plex_id:
+            return self._missing.pop(plex_id, None)
+        self._last_plex_id = plex_id
+        while self._head is not None and self._head[0] < plex_id:
+            self._missing[self._head[0]] = self._head[1]
+            self._head = next(self._rows, None)
+        if self._head is not None and self._head[0] == plex_id:
+            checksum = self._head[1]
+            self._head = next(self._rows, None)
+            return checksum
+
+    def missing(self):
+        """
+        Call once the PMS items are exhausted. Returns a list of all plex_ids
+        that are in the plex.db, but that the PMS did not send
+        """
+        while self._head is not None:
+            self._missing[self._head[0]] = self._head[1]
+            self._head = next(self._rows, None)
+        return self._missing.keys()
+
+
+def item_checksum(plex_id, xml):
+    """
+    Returns the checksum [int] for the PMS item xml with plex_id
+    """
+    return int('{}{}'.format(
+        plex_id,
+        xml.get('updatedAt',
+                xml.get('addedAt', '1541572987')).replace('-', '')))
+
+
+def checksum_lookup(plexdb, section):
+    """
+    Returns an object with a get(plex_id) method that returns the checksum
+    stored in the Plex DB for plex_id (or None). Picks the cheapest way to get
+    the checksums for all PMS items of section
+    """
+    if section.number_of_items < CHECKSUM_POINT_LOOKUP_LIMIT:
+        return PointChecksums(plexdb, section.plex_type)
+    count = plexdb.count_by_sectionid(section.section_id, section.plex_type)
+    if count <= CHECKSUM_PRELOAD_LIMIT:
+        LOG.debug('Preloading %s checksums for section %s', count, section)
+        return dict(plexdb.checksums_by_sectionid(section.section_id,
+                                                  section.plex_type))
+    if section.plex_type == v.PLEX_TYPE_ALBUM:
+        # Albums are not sorted by plex_id but by addedAt
+        return PointChecksums(plexdb, section.plex_type)
+    LOG.debug('Merge-joining %s checksums for section %s', count, section)
+    return MergeJoinChecksums(plexdb, section.plex_type, section.section_id)
+
+
+class SectionDiff(common.LibrarySyncMixin, backgroundthread.KillableThread):
+    """
+    Downloads all PMS items of one section and compares them with the plex.db
+    while other sections are being processed. Puts the tuples
+        (plex_id, userdata)
+    into self.queue in the order the PMS sent them, followed by None.
+    userdata is None if we need to download the item's metadata or the PMS
+    xml if we only need to update the userdata (merge_join=True).
+    Will use a COPIED plex.db file (plex-copy.db)
+    """
+    def __init__(self, section, repair, merge_join, to_delete):
+        self.section = section
+        self.repair = repair
+        self.merge_join = merge_join
+        self.to_delete = to_delete
+        # Bounded in order to limit memory usage if we're ahead of the
+        # section currently being processed
+        self.queue = Queue.Queue(maxsize=SECTION_BUFFER_SIZE)
+        super(SectionDiff, self).__init__()
+
+    def _changed_items(self):
+        section = self.section
+        with PlexDB(lock=False, copy=True) as plexdb:
+            checksums = None if self.repair else checksum_lookup(plexdb,
+                                                                 section)
+            for xml in section.iterator:
+                if self.should_cancel():
+                    break
+                plex_id = int(xml.get('ratingKey'))
+                checksum = item_checksum(plex_id, xml)
+                if checksums is not None and checksums.get(plex_id) == checksum:
+                    continue
+                yield plex_id, None
+
+    def _all_items(self):
+        """
+        Compares ALL PMS items of section with the plex.db in one single pass.
+        New and changed items need a metadata download, unchanged ones only a
+        userdata update
+        """
+        section = self.section
+        complete = False
+        with PlexDB(lock=False, copy=True) as plexdb:
+            join = SectionMergeJoin(plexdb,
+                                    section.plex_type,
+                                    section.section_id)
+            for xml in section.iterator:
+                if self.should_cancel():
+                    break
+                plex_id = int(xml.get('ratingKey'))
+                checksum = join.get(plex_id)
+                # Songs are synced together with their album
+                if (section.plex_type != v.PLEX_TYPE_SONG and
+                        (self.repair or checksum is None or
+                         checksum != item_checksum(plex_id, xml))):
+                    yield plex_id, None
+                else:
+                    yield plex_id, xml
+            else:
+                complete = True
+            if complete and not self.should_cancel():
+                to_delete = self.to_delete.setdefault(section.plex_type, {})
+                for plex_id in join.missing():
+                    to_delete[plex_id] = section.section_id
+
+    def _run(self):
+        try:
+            items = self._all_items() if self.merge_join \
+                else self._changed_items()
+            for item in items:
+                self.queue.put(item)
+        except RuntimeError:
+            LOG.error('Could not get all PMS items for section %s',
+                      self.section)
+            self.section.sync_successful = False
+        except Exception:
+            utils.ERROR('Could not compare the items of section %s'
+                        % self.section)
+            self.section.sync_successful = False
+        finally:
+            self.queue.put(None)
 
 
 class FillMetadataQueue(common.LibrarySyncMixin,
                         backgroundthread.KillableThread):
     """
     Determines which plex_ids we need to sync and puts these ids in a separate
-    queue. Will use a COPIED plex.db file (plex-copy.db) in order to read much
-    faster without the writing thread stalling
+    queue. Up to PARALLEL_SECTIONS sections are downloaded and compared with
+    the plex.db at once, but sections are queued for processing strictly in
+    the order we received them - e.g. shows before seasons before episodes
     """
     def __init__(self, repair, section_queue, get_metadata_queue,
-                 processing_queue):
+                 processing_queue, merge_join=False):
         self.repair = repair
         self.section_queue = section_queue
         self.get_metadata_queue = get_metadata_queue
         self.processing_queue = processing_queue
+        # merge_join=True: section_queue delivers ALL PMS items. Unchanged
+        # items are passed on for a userdata-only update, items that the PMS
+        # did not send are recorded in to_delete
+        self.merge_join = merge_join
+        # Dict plex_type: {plex_id: section_id} of items to delete
+        self.to_delete = {}
+        # SectionDiff threads in the order of their sections
+        self.diffs = deque()
+        self.no_more_sections = False
         super(FillMetadataQueue, self).__init__()
 
-    def _process_section(self, section):
-        # Initialize only once to avoid loosing the last value before we're
-        # breaking the for loop
+    def _start_diffs(self, block):
+        """
+        Starts comparing the next sections, up to PARALLEL_SECTIONS at once.
+        With block=True, waits for the next section if we have nothing else
+        to do
+        """
+        while not self.no_more_sections and len(self.diffs) < PARALLEL_SECTIONS:
+            try:
+                section = self.section_queue.get(block=block and not self.diffs)
+            except Empty:
+                break
+            self.section_queue.task_done()
+            if section is None:
+                self.no_more_sections = True
+                break
+            diff = SectionDiff(section,
+                               self.repair,
+                               self.merge_join,
+                               self.to_delete)
+            diff.start()
+            self.diffs.append(diff)
+
+    @staticmethod
+    def _drain(diff):
+        """
+        Stops diff, waits until it's done and closes its section's iterator
+        """
+        diff.cancel()
+        while diff.queue.get() is not None:
+            pass
+        diff.section.iterator.close()
+
+    def _process_section(self, diff):
+        section = diff.section
         LOG.debug('Process section %s with %s items',
                   section, section.number_of_items)
         count = 0
-        do_process_section = False
-        with PlexDB(lock=False, copy=True) as plexdb:
-            for xml in section.iterator:
-                if self.should_cancel():
-                    break
-                plex_id = int(xml.get('ratingKey'))
-                checksum = int('{}{}'.format(
-                    plex_id,
-                    xml.get('updatedAt',
-                            xml.get('addedAt', '1541572987')).replace('-', '')))
-                if (not self.repair and
-                        plexdb.checksum(plex_id, section.plex_type) == checksum):
-                    continue
-                try:
+        while True:
+            item = diff.queue.get()
+            if item is None:
+                break
+            if self.should_cancel():
+                self._drain(diff)
+                break
+            plex_id, userdata = item
+            if count == 0:
+                self.processing_queue.add_section(section)
+                LOG.debug('Put section in queue with %s items: %s',
+                          section.number_of_items, section)
+            try:
+                if userdata is None:
                     self.get_metadata_queue.put((count, plex_id, section),
                                                 timeout=QUEUE_TIMEOUT)
-                except Full:
-                    LOG.error('Putting %s in get_metadata_queue timed out - '
-                              'aborting sync now', plex_id)
-                    section.sync_successful = False
-                    break
-                count += 1
-                if not do_process_section:
-                    do_process_section = True
-                    self.processing_queue.add_section(section)
-                    LOG.debug('Put section in queue with %s items: %s',
-                              section.number_of_items, section)
+                else:
+                    self.processing_queue.put(
+                        (count, {'section': section,
+                                 'xml': None,
+                                 'children': None,
+                                 'userdata': userdata}),
+                        timeout=QUEUE_TIMEOUT)
+            except Full:
+                LOG.error('Queueing %s timed out - aborting sync now',
+                          plex_id)
+                section.sync_successful = False
+                self._drain(diff)
+                break
+            count += 1
+            if count % SECTION_BUFFER_SIZE == 0:
+                # Let more sections catch up in the meantime
+                self._start_diffs(block=False)
         # We might have received LESS items from the PMS than anticipated.
         # Ensures that our queues finish
         LOG.debug('%s items to process for section %s', count, section)
-        section.number_of_items = count
+        self.processing_queue.finish_section(section, count)
 
     def _run(self):
-        while not self.should_cancel():
-            section = self.section_queue.get()
-            self.section_queue.task_done()
-            if section is None:
-                break
-            self._process_section(section)
-        # Signal the download metadata threads to stop with a sentinel
-        self.get_metadata_queue.put(None)
-        # Sentinel for the process_thread once we added everything else
-        self.processing_queue.add_sentinel(sections.Section())
+        try:
+            while not self.should_cancel():
+                self._start_diffs(block=True)
+                if not self.diffs:
+                    break
+                self._process_section(self.diffs.popleft())
+        finally:
+            for diff in self.diffs:
+                self._drain(diff)
+            if not self.no_more_sections:
+                # We've been cancelled
+                sections.close_iterators(self.section_queue)
+            # Signal the download metadata threads to stop with a sentinel
+            self.get_metadata_queue.put(None)
+            # Sentinel for the process_thread once we added everything else
+            self.processing_queue.add_sentinel(sections.Section())
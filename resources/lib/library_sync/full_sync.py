@@ -11,7 +11,10 @@ from .fill_metadata_queue import FillMetadataQueue
 from .process_metadata import ProcessMetadataThread
 from . import common, sections
 from .. import utils, timing, backgroundthread as bg, variables as v, app
-from .. import plex_functions as PF, itemtypes, path_ops
+from .. import widget_cache
+from .. import plex_functions as PF, itemtypes, path_ops, db
+from ..plex_db import PLEXDB_LOCK
+from ..downloadutils import DownloadUtils as DU
 
 if common.PLAYLIST_SYNC_ENABLED:
     from .. import playlists
@@ -41,6 +44,8 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
         # For progress dialog
         self.show_dialog = show_dialog
         self.show_dialog_userdata = utils.settings('playstate_sync_indicator') == 'true'
+        # Compare all PMS items with the plex.db in one single pass?
+        self.merge_join = utils.settings('fullSyncMergeJoin') == 'true'
         if self.show_dialog:
             self.dialog = xbmcgui.DialogProgressBG()
             self.dialog.create(utils.lang(39714))
@@ -75,19 +80,31 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
         updating items, increasing sync speed tremendously.
         Using the same DB with e.g. WAL mode did not really work out...
         """
-        path_ops.copyfile(v.DB_PLEX_PATH, v.DB_PLEX_COPY_PATH)
+        # Make sure the main plex.db file contains all changes and nobody
+        # writes to it while we're copying
+        with PLEXDB_LOCK:
+            if not db.checkpoint('plex'):
+                LOG.warn('Could not checkpoint plex.db completely')
+            path_ops.copyfile(v.DB_PLEX_PATH, v.DB_PLEX_COPY_PATH)
 
     @utils.log_time
-    def process_new_and_changed_items(self, section_queue, processing_queue):
+    def process_new_and_changed_items(self, section_queue, processing_queue,
+                                      merge_join=False):
+        """
+        Returns a dict plex_type: {plex_id: section_id} with the items that
+        the PMS did not send (only filled if merge_join=True)
+        """
         LOG.debug('Start working')
         get_metadata_queue = Queue.Queue(maxsize=BACKLOG_QUEUE_SIZE)
         scanner_thread = FillMetadataQueue(self.repair,
                                            section_queue,
                                            get_metadata_queue,
-                                           processing_queue)
+                                           processing_queue,
+                                           merge_join=merge_join)
         scanner_thread.start()
+        batch_size = int(utils.settings('syncMetadataBatchSize'))
         metadata_threads = [
-            GetMetadataThread(get_metadata_queue, processing_queue)
+            GetMetadataThread(get_metadata_queue, processing_queue, batch_size)
             for _ in range(int(utils.settings('syncThreadNumber')))
         ]
         for t in metadata_threads:
@@ -105,6 +122,7 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
         process_thread.join()
         self.successful = process_thread.successful
         LOG.debug('threads finished work. successful: %s', self.successful)
+        return scanner_thread.to_delete
 
     @utils.log_time
     def processing_loop_playstates(self, section_queue):
@@ -114,6 +132,8 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
             if section is None:
                 break
             self.playstate_per_section(section)
+        else:
+            sections.close_iterators(section_queue)
 
     def playstate_per_section(self, section):
         LOG.debug('Processing %s playstates for library section %s',
@@ -121,6 +141,9 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
         try:
             with section.context(self.current_time) as context:
                 for xml in section.iterator:
+                    if self.should_cancel():
+                        section.iterator.close()
+                        break
                     section.count += 1
                     if not context.update_userdata(xml, section.plex_type):
                         # Somehow did not sync this item yet
@@ -136,6 +159,9 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
         except RuntimeError:
             LOG.error('Could not entirely process section %s', section)
             self.successful = False
+        finally:
+            # Watched states and resume points might have changed
+            widget_cache.invalidate(section.section_id)
 
     def threaded_get_generators(self, kinds, section_queue, all_items):
         """
@@ -170,7 +196,9 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
                         LOG.error('Error getting section iterator %s', section)
                     else:
                         section.number_of_items = section.iterator.total
-                        if section.number_of_items > 0:
+                        # Also get empty sections for all items in order to
+                        # detect deleted items
+                        if section.number_of_items > 0 or all_items:
                             section_queue.put(section)
                             LOG.debug('Put section in queue with %s items: %s',
                                       section.number_of_items, section)
@@ -181,6 +209,47 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
             section_queue.put(None)
             LOG.debug('Exiting threaded_get_generators')
 
+    def delete_missing_items(self, to_delete):
+        """
+        Deletes all items in to_delete, a dict plex_type: {plex_id:
+        section_id}, unless the item has been re-added to another section in
+        the meantime
+        """
+        LOG.debug('Deleting items that are not on the PMS anymore')
+        deleted = False
+        try:
+            for plex_type, context in self.deletion_kinds():
+                plex_ids = to_delete.get(plex_type, {}).items()
+                for pos in range(0, len(plex_ids), DELETION_BATCH_SIZE):
+                    with context(self.current_time) as ctx:
+                        for plex_id, section_id in plex_ids[pos:pos + DELETION_BATCH_SIZE]:
+                            if self.should_cancel():
+                                return
+                            item = ctx.plexdb.item_by_id(plex_id, plex_type)
+                            if item and item['section_id'] == section_id:
+                                ctx.remove(plex_id, plex_type)
+                                deleted = True
+        finally:
+            if deleted:
+                widget_cache.invalidate()
+        LOG.debug('Done deleting items')
+
+    @staticmethod
+    def deletion_kinds():
+        kinds = [
+            (v.PLEX_TYPE_MOVIE, itemtypes.Movie),
+            (v.PLEX_TYPE_SHOW, itemtypes.Show),
+            (v.PLEX_TYPE_SEASON, itemtypes.Season),
+            (v.PLEX_TYPE_EPISODE, itemtypes.Episode)
+        ]
+        if app.SYNC.enable_music:
+            kinds.extend([
+                (v.PLEX_TYPE_ARTIST, itemtypes.Artist),
+                (v.PLEX_TYPE_ALBUM, itemtypes.Album),
+                (v.PLEX_TYPE_SONG, itemtypes.Song)
+            ])
+        return kinds
+
     def full_library_sync(self):
         section_queue = Queue.Queue()
         processing_queue = bg.ProcessingQueue(maxsize=XML_QUEUE_SIZE)
@@ -195,13 +264,20 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
                 (v.PLEX_TYPE_ARTIST, v.PLEX_TYPE_ARTIST),
                 (v.PLEX_TYPE_ALBUM, v.PLEX_TYPE_ARTIST),
             ])
+        if self.merge_join and app.SYNC.enable_music:
+            # In order to not delete all your songs again
+            kinds.append((v.PLEX_TYPE_SONG, v.PLEX_TYPE_ARTIST))
         # ADD NEW ITEMS
         # We need to enforce syncing e.g. show before season before episode
+        # Stay in the interactive lane: this task merely waits for the
+        # ThreadedDownloadChunk tasks and may not take away their sync-io slots
         bg.FunctionAsTask(self.threaded_get_generators,
                           None,
-                          kinds, section_queue, False).start()
+                          kinds, section_queue, self.merge_join).start()
         # Do the heavy lifting
-        self.process_new_and_changed_items(section_queue, processing_queue)
+        to_delete = self.process_new_and_changed_items(section_queue,
+                                                       processing_queue,
+                                                       merge_join=self.merge_join)
         common.update_kodi_library(video=True, music=True)
         if self.should_cancel() or not self.successful:
             return
@@ -217,6 +293,11 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
             if not playlists.full_sync() or self.should_cancel():
                 return
 
+        if self.merge_join:
+            # Playstates have been synced and deleted items detected already
+            self.delete_missing_items(to_delete)
+            return
+
         # SYNC PLAYSTATE of ALL items (otherwise we won't pick up on items that
         # were set to unwatched). Also mark all items on the PMS to be able
         # to delete the ones still in Kodi
@@ -240,32 +321,26 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
 
         # Delete movies that are not on Plex anymore
         LOG.debug('Looking for items to delete')
-        kinds = [
-            (v.PLEX_TYPE_MOVIE, itemtypes.Movie),
-            (v.PLEX_TYPE_SHOW, itemtypes.Show),
-            (v.PLEX_TYPE_SEASON, itemtypes.Season),
-            (v.PLEX_TYPE_EPISODE, itemtypes.Episode)
-        ]
-        if app.SYNC.enable_music:
-            kinds.extend([
-                (v.PLEX_TYPE_ARTIST, itemtypes.Artist),
-                (v.PLEX_TYPE_ALBUM, itemtypes.Album),
-                (v.PLEX_TYPE_SONG, itemtypes.Song)
-            ])
-        for plex_type, context in kinds:
-            # Delete movies that are not on Plex anymore
-            while True:
-                with context(self.current_time) as ctx:
-                    plex_ids = list(
-                        ctx.plexdb.plex_id_by_last_sync(plex_type,
-                                                        self.current_time,
-                                                        DELETION_BATCH_SIZE))
-                    for plex_id in plex_ids:
-                        if self.should_cancel():
-                            return
-                        ctx.remove(plex_id, plex_type)
-                if len(plex_ids) < DELETION_BATCH_SIZE:
-                    break
+        deleted = False
+        try:
+            for plex_type, context in self.deletion_kinds():
+                # Delete movies that are not on Plex anymore
+                while True:
+                    with context(self.current_time) as ctx:
+                        plex_ids = list(
+                            ctx.plexdb.plex_id_by_last_sync(plex_type,
+                                                            self.current_time,
+                                                            DELETION_BATCH_SIZE))
+                        for plex_id in plex_ids:
+                            if self.should_cancel():
+                                return
+                            ctx.remove(plex_id, plex_type)
+                            deleted = True
+                    if len(plex_ids) < DELETION_BATCH_SIZE:
+                        break
+        finally:
+            if deleted:
+                widget_cache.invalidate()
         LOG.debug('Done looking for items to delete')
 
     @utils.log_time
@@ -278,6 +353,7 @@ class FullSync(common.LibrarySyncMixin, bg.KillableThread):
             self.full_library_sync()
         finally:
             common.update_kodi_library(video=True, music=True)
+            LOG.debug('Connection pool stats: %s', DU().pool_stats())
             if self.dialog:
                 self.dialog.close()
             if not self.successful and not self.should_cancel():
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
+from Queue import Empty
 
 from . import common
 from ..plex_api import API
@@ -13,12 +14,15 @@ LOCK = backgroundthread.threading.Lock()
 class GetMetadataThread(common.LibrarySyncMixin,
                         backgroundthread.KillableThread):
     """
-    Threaded download of Plex XML metadata for a certain library item.
+    Threaded download of Plex XML metadata for library items, getting the
+    metadata for up to batch_size items with one single PMS request.
     Fills the queue with the downloaded etree XML objects
     """
-    def __init__(self, get_metadata_queue, processing_queue):
+    def __init__(self, get_metadata_queue, processing_queue, batch_size=1):
         self.get_metadata_queue = get_metadata_queue
         self.processing_queue = processing_queue
+        # Max. number of items to get metadata for with one PMS request
+        self.batch_size = batch_size
         super(GetMetadataThread, self).__init__()
 
     def _collections(self, item):
@@ -57,67 +61,97 @@ class GetMetadataThread(common.LibrarySyncMixin,
                     continue
             item['children'][plex_set_id] = collection_xmls[plex_set_id]
 
-    def _process_abort(self, count, section):
-        # Make sure other threads will also receive sentinel
-        self.get_metadata_queue.put(None)
-        if count is not None:
-            self._process_skipped_item(count, section)
-
     def _process_skipped_item(self, count, section):
         section.sync_successful = False
         # Add a "dummy" item so we're not skipping a beat
         self.processing_queue.put((count, {'section': section, 'xml': None}))
 
+    def _get_batch(self):
+        """
+        Returns a list of up to batch_size (count, plex_id, section) tuples
+        from get_metadata_queue without waiting for more items than are
+        readily available. The list ends with None if we received the
+        sentinel
+        """
+        batch = [self.get_metadata_queue.get()]
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self.get_metadata_queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _process_batch(self, items):
+        """
+        Downloads the metadata for all items with one single PMS request.
+        Returns False if we need to abort the sync
+        """
+        xmls = PF.get_metadata_batch([x[1] for x in items])  # This will block
+        if xmls == 401:
+            LOG.error('HTTP 401 returned by PMS. Too much strain? '
+                      'Cancelling sync for now')
+            utils.window('plex_scancrashed', value='401')
+            for count, _, section in items:
+                self._process_skipped_item(count, section)
+            return False
+        for count, plex_id, section in items:
+            if self.should_cancel():
+                self._process_skipped_item(count, section)
+                continue
+            xml = xmls.get(plex_id) if xmls else None
+            if xml is None:
+                # Did not receive a valid XML - skip that item for now
+                LOG.error("Could not get metadata for %s. Skipping item "
+                          "for now", plex_id)
+                self._process_skipped_item(count, section)
+                continue
+            self._process_item(count, plex_id, section, xml)
+        return True
+
+    def _process_item(self, count, plex_id, section, xml):
+        item = {
+            'xml': xml,
+            'children': None,
+            'section': section
+        }
+        if section.plex_type == v.PLEX_TYPE_MOVIE:
+            # Check for collections/sets
+            collections = False
+            for child in item['xml'][0]:
+                if child.tag == 'Collection':
+                    collections = True
+                    break
+            if collections:
+                with LOCK:
+                    self._collections(item)
+        if section.get_children:
+            children_xml = PF.GetAllPlexChildren(plex_id)  # Will block
+            try:
+                children_xml[0].attrib
+            except (TypeError, IndexError, AttributeError):
+                LOG.error('Could not get children for Plex id %s',
+                          plex_id)
+                self._process_skipped_item(count, section)
+                return
+            else:
+                item['children'] = children_xml
+        self.processing_queue.put((count, item))
+
     def _run(self):
         while True:
-            item = self.get_metadata_queue.get()
+            batch = self._get_batch()
             try:
-                if item is None or self.should_cancel():
-                    self._process_abort(item[0] if item else None,
-                                        item[2] if item else None)
+                items = [x for x in batch if x is not None]
+                if self.should_cancel():
+                    for count, _, section in items:
+                        self._process_skipped_item(count, section)
                     break
-                count, plex_id, section = item
-                item = {
-                    'xml': PF.GetPlexMetadata(plex_id),  # This will block
-                    'children': None,
-                    'section': section
-                }
-                if item['xml'] is None:
-                    # Did not receive a valid XML - skip that item for now
-                    LOG.error("Could not get metadata for %s. Skipping item "
-                              "for now", plex_id)
-                    self._process_skipped_item(count, section)
-                    continue
-                elif item['xml'] == 401:
-                    LOG.error('HTTP 401 returned by PMS. Too much strain? '
-                              'Cancelling sync for now')
-                    utils.window('plex_scancrashed', value='401')
-                    self._process_abort(count, section)
+                if items and not self._process_batch(items):
+                    break
+                if batch[-1] is None:
                     break
-                if section.plex_type == v.PLEX_TYPE_MOVIE:
-                    # Check for collections/sets
-                    collections = False
-                    for child in item['xml'][0]:
-                        if child.tag == 'Collection':
-                            collections = True
-                            break
-                    if collections:
-                        with LOCK:
-                            self._collections(item)
-                if section.get_children:
-                    if self.should_cancel():
-                        self._process_abort(count, section)
-                        break
-                    children_xml = PF.GetAllPlexChildren(plex_id)  # Will block
-                    try:
-                        children_xml[0].attrib
-                    except (TypeError, IndexError, AttributeError):
-                        LOG.error('Could not get children for Plex id %s',
-                                  plex_id)
-                        self._process_skipped_item(count, section)
-                        continue
-                    else:
-                        item['children'] = children_xml
-                self.processing_queue.put((count, item))
             finally:
-                self.get_metadata_queue.task_done()
+                for _ in batch:
+                    self.get_metadata_queue.task_done()
+        # Make sure other threads will also receive sentinel
+        self.get_metadata_queue.put(None)
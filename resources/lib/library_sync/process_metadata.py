@@ -4,7 +4,7 @@ from logging import getLogger
 
 from . import common, sections
 from ..plex_db import PlexDB
-from .. import backgroundthread, app
+from .. import backgroundthread, widget_cache, app
 
 LOG = getLogger('PLEX.sync.process_metadata')
 
@@ -36,6 +36,8 @@ class ProcessMetadataThread(common.LibrarySyncMixin,
             LOG.debug('Resume processing section %s', section)
 
     def finish_last_section(self):
+        if self.last_section:
+            widget_cache.invalidate(self.last_section.section_id)
         if (not self.should_cancel() and self.last_section and
                 self.last_section.sync_successful):
             # Check for should_cancel() because we cannot be sure that we
@@ -52,7 +54,7 @@ class ProcessMetadataThread(common.LibrarySyncMixin,
 
     def _get(self):
         item = {'xml': None}
-        while item and item['xml'] is None:
+        while item and item['xml'] is None and item.get('userdata') is None:
             item = self.processing_queue.get()
             self.processing_queue.task_done()
         return item
@@ -76,13 +78,25 @@ class ProcessMetadataThread(common.LibrarySyncMixin,
                 while not self.should_cancel():
                     if item is None or item['section'] != section:
                         break
-                    self.update_progressbar(section,
-                                            item['xml'][0].get('title'),
-                                            section.count)
-                    context.add_update(item['xml'][0],
-                                       section_name=section.name,
-                                       section_id=section.section_id,
-                                       children=item['children'])
+                    if item.get('userdata') is not None:
+                        # Item unchanged on the PMS (merge-join full sync)
+                        self.update_progressbar(section,
+                                                item['userdata'].get('title'),
+                                                section.count)
+                        if not context.update_userdata(item['userdata'],
+                                                       section.plex_type):
+                            # Somehow did not sync this item yet
+                            context.add_update(item['userdata'],
+                                               section_name=section.name,
+                                               section_id=section.section_id)
+                    else:
+                        self.update_progressbar(section,
+                                                item['xml'][0].get('title'),
+                                                section.count)
+                        context.add_update(item['xml'][0],
+                                           section_name=section.name,
+                                           section_id=section.section_id,
+                                           children=item['children'])
                     processed += 1
                     section.count += 1
                     if processed == COMMIT_TO_DB_EVERY_X_ITEMS:
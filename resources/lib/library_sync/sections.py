@@ -476,6 +476,21 @@ def get_sync_section(section, plex_type):
     return section
 
 
+def close_iterators(section_queue):
+    """
+    Call if you stop consuming section_queue before its sentinel None, e.g.
+    because the sync has been cancelled. Closes the iterators of all sections
+    still waiting in section_queue so we don't keep their PMS connections
+    and prefetched chunks around
+    """
+    while True:
+        section = section_queue.get()
+        section_queue.task_done()
+        if section is None:
+            break
+        section.iterator.close()
+
+
 def force_full_sync():
     """
     Resets the sync timestamp for all sections to 0, thus forcing a subsequent
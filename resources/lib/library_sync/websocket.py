@@ -2,14 +2,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
+from collections import OrderedDict
+from itertools import count
+import heapq
+from sqlite3 import OperationalError
 
 from .common import update_kodi_library, PLAYLIST_SYNC_ENABLED
 from .fanart import SYNC_FANART, FanartTask
 from ..plex_api import API
-from ..plex_db import PlexDB
+from ..plex_db import PlexDB, kodi_item_by_id
 from .. import kodi_db
-from .. import backgroundthread, plex_functions as PF, itemtypes
-from .. import artwork, utils, timing, variables as v, app
+from .. import backgroundthread, plex_functions as PF, itemtypes, db
+from .. import artwork, utils, timing, widget_cache, variables as v, app
 
 if PLAYLIST_SYNC_ENABLED:
     from .. import playlists
@@ -18,19 +22,104 @@ LOG = getLogger('PLEX.sync.websocket')
 
 CACHING_ENALBED = utils.settings('enableTextureCache') == "true"
 
-WEBSOCKET_MESSAGES = []
+class WebsocketMessages(object):
+    """
+    Stores the PMS timeline and activity messages that still need to be
+    processed, at most one message per plex_id. A heap sorted by the
+    messages' timestamps tells us which messages have waited long enough for
+    the PMS to finish processing the item. Deletions are due immediately.
+    """
+    def __init__(self):
+        self._messages = OrderedDict()
+        self._heap = []
+        self._counter = count()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __contains__(self, plex_id):
+        return plex_id in self._messages
+
+    def add(self, plex_id, plex_type, state):
+        """
+        Stores a new message unless we already got one for plex_id. Deletions
+        replace any message still waiting for plex_id
+        """
+        if plex_id in self._messages and state != 9:
+            return
+        self._push({
+            'state': state,
+            'plex_type': plex_type,
+            'plex_id': plex_id,
+            'timestamp': timing.unix_timestamp(),
+            'attempt': 0
+        })
+
+    def _push(self, message):
+        self._messages[message['plex_id']] = message
+        due = 0 if message['state'] == 9 else message['timestamp']
+        heapq.heappush(self._heap, (due, next(self._counter), message))
+
+    def pop_due(self, timestamp):
+        """
+        Removes and returns a list of all deletions plus all other messages
+        that we received before timestamp [unix time]
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= timestamp:
+            message = heapq.heappop(self._heap)[2]
+            # Skip messages that have been replaced in the meantime
+            if self._messages.get(message['plex_id']) is message:
+                del self._messages[message['plex_id']]
+                due.append(message)
+        return due
+
+    def next_due(self):
+        """
+        Returns the timestamp [unix time] of the oldest stored message (0 for
+        deletions) or None if there are no messages
+        """
+        if not self._messages:
+            # Only replaced messages left
+            self._heap = []
+            return None
+        return self._heap[0][0]
+
+    def retry(self, message):
+        """
+        Stores message again after we could not process it. Safety net if we
+        can't process an item: gives up after the 3rd attempt
+        """
+        message['attempt'] += 1
+        if message['attempt'] > 3:
+            LOG.error('Repeatedly could not process message %s, abort',
+                      message)
+        elif message['plex_id'] not in self._messages:
+            self._push(message)
+
+
+WEBSOCKET_MESSAGES = WebsocketMessages()
 # Dict to save info for Plex items currently being played somewhere
 PLAYSTATE_SESSIONS = {}
+# Snapshot of the PMS' current sessions, see pms_sessions()
+PMS_SESSIONS = {}
+PMS_SESSIONS_TIMESTAMP = 0
+# Refresh the PMS_SESSIONS snapshot at most every x seconds
+SESSIONS_REFRESH_INTERVAL = 5
+# Write the playstate of a session to the Kodi DB at most every x seconds
+# (unless e.g. playback got paused or the item has been played completely)
+PLAYSTATE_WRITE_INTERVAL = 10
 
 
-def multi_delete(input_list, delete_list):
+def group_by(items, key):
     """
-    Deletes the list items of input_list at the positions in delete_list
-    (which can be in any arbitrary order)
+    Returns an OrderedDict key(item): [list of items], preserving the order
+    of items
     """
-    for index in sorted(delete_list, reverse=True):
-        del input_list[index]
-    return input_list
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return groups
 
 
 def store_websocket_message(message):
@@ -72,69 +161,128 @@ def process_websocket_messages():
         6: 'analyzing',
         9: 'deleted'
     """
-    global WEBSOCKET_MESSAGES
-    now = timing.unix_timestamp()
-    update_kodi_video_library, update_kodi_music_library = False, False
-    delete_list = []
-    for i, message in enumerate(WEBSOCKET_MESSAGES):
-        if message['state'] == 9:
-            successful, video, music = process_delete_message(message)
-        elif now - message['timestamp'] < app.SYNC.backgroundsync_saftymargin:
-            # We haven't waited long enough for the PMS to finish processing the
-            # item. Do it later (excepting deletions)
-            continue
-        else:
-            successful, video, music = process_new_item_message(message)
-            if (successful and SYNC_FANART and
-                    message['plex_type'] in (v.PLEX_TYPE_MOVIE, v.PLEX_TYPE_SHOW)):
-                task = FanartTask()
-                task.setup(message['plex_id'],
-                           message['plex_type'],
-                           refresh=False)
-                backgroundthread.BGThreader.addTask(task)
-        if successful is True:
-            delete_list.append(i)
-            update_kodi_video_library = True if video else update_kodi_video_library
-            update_kodi_music_library = True if music else update_kodi_music_library
-        else:
-            # Safety net if we can't process an item
-            message['attempt'] += 1
-            if message['attempt'] > 3:
-                LOG.error('Repeatedly could not process message %s, abort',
-                          message)
-                delete_list.append(i)
-
-    # Get rid of the items we just processed
-    if delete_list:
-        WEBSOCKET_MESSAGES = multi_delete(WEBSOCKET_MESSAGES, delete_list)
+    # We need to wait for the PMS to finish processing the item (excepting
+    # deletions)
+    messages = WEBSOCKET_MESSAGES.pop_due(
+        timing.unix_timestamp() - app.SYNC.backgroundsync_saftymargin)
+    if not messages:
+        return
+    update_kodi_video_library, update_kodi_music_library = \
+        process_delete_messages([x for x in messages if x['state'] == 9])
+    video, music = \
+        process_new_item_messages([x for x in messages if x['state'] != 9])
+    update_kodi_video_library = update_kodi_video_library or video
+    update_kodi_music_library = update_kodi_music_library or music
     # Let Kodi know of the change
     if update_kodi_video_library or update_kodi_music_library:
         update_kodi_library(video=update_kodi_video_library,
                             music=update_kodi_music_library)
 
 
-def process_new_item_message(message):
-    LOG.debug('Message: %s', message)
-    xml = PF.GetPlexMetadata(message['plex_id'])
-    try:
-        plex_type = xml[0].attrib['type']
-    except (IndexError, KeyError, TypeError):
-        LOG.error('Could not download metadata for %s', message['plex_id'])
-        return False, False, False
-    LOG.debug("Processing new/updated PMS item: %s", message['plex_id'])
-    with itemtypes.ITEMTYPE_FROM_PLEXTYPE[plex_type](timing.unix_timestamp()) as typus:
-        typus.add_update(xml[0],
-                         section_name=xml.get('librarySectionTitle'),
-                         section_id=utils.cast(int, xml.get('librarySectionID')))
-    cache_artwork(message['plex_id'], plex_type)
-    return True, plex_type in v.PLEX_VIDEOTYPES, plex_type in v.PLEX_AUDIOTYPES
+def process_new_item_messages(messages):
+    """
+    Downloads the metadata for all messages in batches, then adds or updates
+    the items using one DB transaction per plex_type. Returns the tuple
+        (video [bool], music [bool])
+    telling whether the Kodi video or music library changed
+    """
+    video, music = False, False
+    if not messages:
+        return video, music
+    plex_ids = [x['plex_id'] for x in messages]
+    batch_size = int(utils.settings('syncMetadataBatchSize'))
+    xmls = {}
+    for i in range(0, len(plex_ids), batch_size):
+        answ = PF.get_metadata_batch(plex_ids[i:i + batch_size])
+        if answ is not None and answ != 401:
+            xmls.update(answ)
+    ready = []
+    section_ids = set()
+    for message in messages:
+        LOG.debug('Message: %s', message)
+        xml = xmls.get(message['plex_id'])
+        try:
+            plex_type = xml[0].attrib['type']
+        except (IndexError, KeyError, TypeError):
+            LOG.error('Could not download metadata for %s', message['plex_id'])
+            WEBSOCKET_MESSAGES.retry(message)
+            continue
+        ready.append((plex_type, message, xml))
+    for plex_type, items in group_by(ready, key=lambda x: x[0]).iteritems():
+        processed = []
+        with itemtypes.ITEMTYPE_FROM_PLEXTYPE[plex_type](timing.unix_timestamp()) as typus:
+            for _, message, xml in items:
+                LOG.debug("Processing new/updated PMS item: %s",
+                          message['plex_id'])
+                # Items fetched together might stem from different sections
+                section_id = utils.cast(int, xml[0].get(
+                    'librarySectionID', xml.get('librarySectionID')))
+                try:
+                    with typus.savepoint():
+                        typus.add_update(
+                            xml[0],
+                            section_name=xml[0].get(
+                                'librarySectionTitle',
+                                xml.get('librarySectionTitle')),
+                            section_id=section_id)
+                except (db.LockedDatabase, OperationalError):
+                    raise
+                except Exception:
+                    # Don't lose the entire batch because of a single item
+                    utils.ERROR('Could not process message %s' % message)
+                    WEBSOCKET_MESSAGES.retry(message)
+                    continue
+                section_ids.add(section_id)
+                processed.append(message['plex_id'])
+        if not processed:
+            continue
+        for plex_id in processed:
+            cache_artwork(plex_id, plex_type)
+            if SYNC_FANART and plex_type in (v.PLEX_TYPE_MOVIE,
+                                             v.PLEX_TYPE_SHOW):
+                task = FanartTask()
+                task.setup(plex_id, plex_type, refresh=False)
+                backgroundthread.BGThreader.addTask(task)
+        video = video or plex_type in v.PLEX_VIDEOTYPES
+        music = music or plex_type in v.PLEX_AUDIOTYPES
+    for section_id in section_ids:
+        widget_cache.invalidate(section_id)
+    return video, music
 
 
-def process_delete_message(message):
-    plex_type = message['plex_type']
-    with itemtypes.ITEMTYPE_FROM_PLEXTYPE[plex_type](None) as typus:
-        typus.remove(message['plex_id'], plex_type=plex_type)
-    return True, plex_type in v.PLEX_VIDEOTYPES, plex_type in v.PLEX_AUDIOTYPES
+def process_delete_messages(messages):
+    """
+    Deletes the items of all messages using one DB transaction per
+    plex_type. Returns the tuple
+        (video [bool], music [bool])
+    telling whether the Kodi video or music library changed
+    """
+    video, music, deleted = False, False, False
+    for plex_type, items in group_by(messages,
+                                     key=lambda x: x['plex_type']).iteritems():
+        removed = False
+        with itemtypes.ITEMTYPE_FROM_PLEXTYPE[plex_type](None) as typus:
+            for message in items:
+                try:
+                    with typus.savepoint():
+                        typus.remove(message['plex_id'], plex_type=plex_type)
+                except (db.LockedDatabase, OperationalError):
+                    raise
+                except Exception:
+                    # Don't lose the entire batch because of a single item
+                    utils.ERROR('Could not process message %s' % message)
+                    WEBSOCKET_MESSAGES.retry(message)
+                    continue
+                removed = True
+        if not removed:
+            continue
+        deleted = True
+        video = video or plex_type in v.PLEX_VIDEOTYPES
+        music = music or plex_type in v.PLEX_AUDIOTYPES
+    if deleted:
+        # We don't know the sections of deleted items anymore
+        widget_cache.invalidate()
+    return video, music
 
 
 def store_timeline_message(data):
@@ -142,7 +290,6 @@ def store_timeline_message(data):
     PMS is messing with the library items, e.g. new or changed. Put in our
     "processing queue" for later
     """
-    global WEBSOCKET_MESSAGES
     for message in data:
         if 'tv.plex' in message.get('identifier', ''):
             # Ommit Plex DVR messages - the Plex IDs are not corresponding
@@ -165,30 +312,14 @@ def store_timeline_message(data):
         elif status == 9:
             # Immediately and always process deletions (as the PMS will
             # send additional message with other codes)
-            WEBSOCKET_MESSAGES.append({
-                'state': status,
-                'plex_type': typus,
-                'plex_id': utils.cast(int, message['itemID']),
-                'timestamp': timing.unix_timestamp(),
-                'attempt': 0
-            })
+            WEBSOCKET_MESSAGES.add(utils.cast(int, message['itemID']),
+                                   typus,
+                                   status)
         elif typus in (v.PLEX_TYPE_MOVIE,
                        v.PLEX_TYPE_EPISODE,
                        v.PLEX_TYPE_SONG) and status == 5:
-            plex_id = int(message['itemID'])
-            # Have we already added this element for processing?
-            for existing_message in WEBSOCKET_MESSAGES:
-                if existing_message['plex_id'] == plex_id:
-                    break
-            else:
-                # Haven't added this element to the queue yet
-                WEBSOCKET_MESSAGES.append({
-                    'state': status,
-                    'plex_type': typus,
-                    'plex_id': plex_id,
-                    'timestamp': timing.unix_timestamp(),
-                    'attempt': 0
-                })
+            # Will be ignored if we already added this element
+            WEBSOCKET_MESSAGES.add(int(message['itemID']), typus, status)
 
 
 def store_activity_message(data):
@@ -196,7 +327,6 @@ def store_activity_message(data):
     PMS is re-scanning an item, e.g. after having changed a movie poster.
     WATCH OUT for this if it's triggered by our PKC library scan!
     """
-    global WEBSOCKET_MESSAGES
     for message in data:
         if message['event'] != 'ended':
             # Scan still going on, so skip for now
@@ -211,25 +341,43 @@ def store_activity_message(data):
         if not plex_id:
             # Likely a Plex id like /library/metadata/3/children
             continue
+        elif plex_id in WEBSOCKET_MESSAGES:
+            # We've already added this element
+            continue
         # We're only looking at existing elements - have we synced yet?
-        with PlexDB(lock=False) as plexdb:
-            typus = plexdb.item_by_id(plex_id, plex_type=None)
+        typus = kodi_item_by_id(plex_id)
         if not typus:
             LOG.debug('plex_id %s not synced yet - skipping', plex_id)
             continue
-        # Have we already added this element?
-        for existing_message in WEBSOCKET_MESSAGES:
-            if existing_message['plex_id'] == plex_id:
-                break
-        else:
-            # Haven't added this element to the queue yet
-            WEBSOCKET_MESSAGES.append({
-                'state': None,  # Don't need a state here
-                'plex_type': typus['plex_type'],
-                'plex_id': plex_id,
-                'timestamp': timing.unix_timestamp(),
-                'attempt': 0
-            })
+        # Don't need a state here
+        WEBSOCKET_MESSAGES.add(plex_id, typus['plex_type'], None)
+
+
+def pms_sessions():
+    """
+    Returns the current sessions of our PMS as returned by PF.GetPMSStatus.
+    Uses a snapshot that is refreshed at most every SESSIONS_REFRESH_INTERVAL
+    seconds
+    """
+    global PMS_SESSIONS, PMS_SESSIONS_TIMESTAMP
+    now = timing.unix_timestamp()
+    if now - PMS_SESSIONS_TIMESTAMP >= SESSIONS_REFRESH_INTERVAL:
+        PMS_SESSIONS = PF.GetPMSStatus(app.ACCOUNT.plex_token)
+        PMS_SESSIONS_TIMESTAMP = now
+    return PMS_SESSIONS
+
+
+def write_playstate(session):
+    """
+    Writes the playstate that we've been holding back for session to the Kodi
+    DB
+    """
+    playstate, session['playstate'] = session['playstate'], None
+    session['last_write'] = timing.unix_timestamp()
+    func = itemtypes.ITEMTYPE_FROM_KODITYPE[session['kodi_type']]
+    with func(None) as fkt:
+        fkt.update_playstate(*(playstate + (timing.unix_timestamp(), )))
+    widget_cache.invalidate(session['section_id'])
 
 
 def process_playing(data):
@@ -240,8 +388,14 @@ def process_playing(data):
     global PLAYSTATE_SESSIONS
     for message in data:
         status = message['state']
-        if status == 'buffering' or status == 'stopped':
-            # Drop buffering and stop messages immediately - no value
+        if status == 'buffering':
+            # Drop buffering messages immediately - no value
+            continue
+        elif status == 'stopped':
+            # No value either, but don't lose the last playstate of a session
+            session = PLAYSTATE_SESSIONS.get(message.get('sessionKey'))
+            if session and session.get('playstate'):
+                write_playstate(session)
             continue
         plex_id = utils.cast(int, message['ratingKey'])
         skip = False
@@ -257,8 +411,7 @@ def process_playing(data):
         session_key = message['sessionKey']
         # Do we already have a sessionKey stored?
         if session_key not in PLAYSTATE_SESSIONS:
-            with PlexDB(lock=False) as plexdb:
-                typus = plexdb.item_by_id(plex_id, plex_type=None)
+            typus = kodi_item_by_id(plex_id)
             if not typus or 'kodi_fileid' not in typus:
                 # Item not (yet) in Kodi library or not affiliated with a file
                 continue
@@ -268,12 +421,12 @@ def process_playing(data):
                 PLAYSTATE_SESSIONS[session_key] = {}
             else:
                 # PMS is ours - get all current sessions
-                pms_sessions = PF.GetPMSStatus(app.ACCOUNT.plex_token)
-                if session_key not in pms_sessions:
+                sessions = pms_sessions()
+                if session_key not in sessions:
                     LOG.info('Session key %s still unknown! Skip '
                              'playstate update', session_key)
                     continue
-                PLAYSTATE_SESSIONS[session_key] = pms_sessions[session_key]
+                PLAYSTATE_SESSIONS[session_key] = dict(sessions[session_key])
                 LOG.debug('Updated current sessions. They are: %s',
                           PLAYSTATE_SESSIONS)
             # Attach Kodi info to the session
@@ -284,6 +437,7 @@ def process_playing(data):
                 PLAYSTATE_SESSIONS[session_key]['kodi_fileid_2'] = None
             PLAYSTATE_SESSIONS[session_key]['kodi_id'] = typus['kodi_id']
             PLAYSTATE_SESSIONS[session_key]['kodi_type'] = typus['kodi_type']
+            PLAYSTATE_SESSIONS[session_key]['section_id'] = typus['section_id']
         session = PLAYSTATE_SESSIONS[session_key]
         if utils.settings('plex_serverowned') != 'false':
             # Identify the user - same one as signed on with PKC? Skip
@@ -339,19 +493,24 @@ def process_playing(data):
                 continue
         else:
             mark_played = False
+        state_changed = status != session.get('state')
+        session['state'] = status
+        session['playstate'] = (mark_played,
+                                session['viewCount'],
+                                resume,
+                                session['duration'],
+                                session['kodi_fileid'],
+                                session['kodi_fileid_2'])
+        if (not mark_played and not state_changed and
+                timing.unix_timestamp() - session.get('last_write', 0) <
+                PLAYSTATE_WRITE_INTERVAL):
+            # Hold back the playstate; we'll write it later
+            continue
         LOG.debug('Update playstate for user %s for %s with plex id %s to '
                   'viewCount %s, resume %s, mark_played %s for item %s',
                   app.ACCOUNT.plex_username, session['kodi_type'], plex_id,
                   session['viewCount'], resume, mark_played, PLAYSTATE_SESSIONS[session_key])
-        func = itemtypes.ITEMTYPE_FROM_KODITYPE[session['kodi_type']]
-        with func(None) as fkt:
-            fkt.update_playstate(mark_played,
-                                 session['viewCount'],
-                                 resume,
-                                 session['duration'],
-                                 session['kodi_fileid'],
-                                 session['kodi_fileid_2'],
-                                 timing.unix_timestamp())
+        write_playstate(session)
 
 
 def cache_artwork(plex_id, plex_type, kodi_id=None, kodi_type=None):
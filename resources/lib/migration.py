@@ -99,4 +99,13 @@ def check_migration():
         utils.settings('accessToken', value='')
         utils.settings('plexAvatar', value='')
 
+    if not utils.compare_version(last_migration, '2.12.11'):
+        LOG.info('Migrating to version 2.12.11')
+        # New indices on section_id and parent ids for the Plex DB
+        # New table items with the plex_type of every synced item
+        from . import plex_db
+        plex_db.initialize()
+        plex_db.fill_items()
+        plex_db.analyze()
+
     utils.settings('last_migrated_PKC_version', value=v.ADDON_VERSION)
@@ -110,6 +110,14 @@ def remove(path):
     return os.remove(encode_path(path))
 
 
+def rename(src, dst):
+    """
+    Rename the file or directory src to dst. On Windows, OSError is raised if
+    dst already exists
+    """
+    return os.rename(encode_path(src), encode_path(dst))
+
+
 def walk(top, topdown=True, onerror=None, followlinks=False):
     """
     Directory tree generator.
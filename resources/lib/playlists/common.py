@@ -11,7 +11,7 @@ from ..watchdog import events
 from ..watchdog.observers import Observer
 from ..watchdog.utils.bricks import OrderedSetQueue
 
-from .. import path_ops, variables as v, app
+from .. import path_ops, variables as v
 ###############################################################################
 LOG = getLogger('PLEX.playlists.common')
 
@@ -185,11 +185,16 @@ class PlaylistObserver(Observer):
         event, watch = event_queue.get(block=True, timeout=timeout)
         event_queue.task_done()
         start = time.time()
-        while time.time() - start < timeout:
+        while True:
+            remaining = timeout - (time.time() - start)
+            if remaining <= 0:
+                break
             try:
-                new_event, new_watch = event_queue.get(block=False)
+                # Block until the next event or until the timer runs out
+                new_event, new_watch = event_queue.get(block=True,
+                                                       timeout=remaining)
             except Queue.Empty:
-                app.APP.monitor.waitForAbort(0.2)
+                break
             else:
                 event_queue.task_done()
                 start = time.time()
@@ -17,6 +17,8 @@ from . import backgroundthread, utils, json_rpc as js, app, variables as v
 LOG = getLogger('PLEX.playqueue')
 
 PLUGIN = 'plugin://%s' % v.ADDON_ID
+# Max number of seconds between two comparisons of the Kodi playqueues
+POLL_TIMEOUT = 1
 
 # Our PKC playqueues (3 instances of Playqueue_Object())
 PLAYQUEUES = []
@@ -103,6 +105,11 @@ class PlayqueueMonitor(backgroundthread.KillableThread):
     (playlist) are swapped. This is what this monitor is for. Don't replace
     this mechanism till Kodi's implementation of playlists has improved
     """
+    def __init__(self):
+        super(PlayqueueMonitor, self).__init__()
+        # kodimonitor wakes us up if Kodi reports playqueue changes
+        self.wakeup = app.APP.playqueue_wakeup
+
     def _compare_playqueues(self, playqueue, new_kodi_playqueue):
         """
         Used to poll the Kodi playqueue and update the Plex playqueue if needed
@@ -229,4 +236,6 @@ class PlayqueueMonitor(backgroundthread.KillableThread):
                             # compare old and new playqueue
                             self._compare_playqueues(playqueue, kodi_pl)
                         playqueue.old_kodi_pl = list(kodi_pl)
-            self.sleep(0.2)
+            # Kodi tells us about most playqueue changes, but not if items
+            # have been swapped
+            self.wait_for_work(POLL_TIMEOUT)
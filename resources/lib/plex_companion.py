@@ -7,7 +7,7 @@ from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
 from threading import Thread
 from Queue import Empty
-from socket import SHUT_RDWR
+from time import time
 from xbmc import executebuiltin
 
 from .plexbmchelper import listener, plexgdm, subscribers, httppersist
@@ -26,6 +26,11 @@ from . import app
 
 LOG = getLogger('PLEX.plex_companion')
 
+# Check every x seconds whether we're still registered as a Plex client
+REGISTRATION_CHECK_INTERVAL = 150
+# Update the list of Plex Media Servers every x seconds
+SERVERLIST_UPDATE_INTERVAL = 1.5
+
 ###############################################################################
 
 
@@ -89,6 +94,18 @@ class PlexCompanion(backgroundthread.KillableThread):
         self.httpd = False
         self.subscription_manager = None
         super(PlexCompanion, self).__init__()
+        # Woken up by new companion_queue items and handled http requests
+        self.wakeup = app.APP.companion_wakeup
+
+    def _handle_request(self, httpd):
+        """
+        Handles one request to our Plex Companion http server. Wakes up the
+        main loop afterwards in order to listen for the next request
+        """
+        try:
+            httpd.handle_request()
+        finally:
+            self.wakeup.set()
 
     @staticmethod
     def _process_alexa(data):
@@ -272,15 +289,9 @@ class PlexCompanion(backgroundthread.KillableThread):
         try:
             self._run()
         finally:
-            try:
-                self.httpd.socket.shutdown(SHUT_RDWR)
-            except AttributeError:
-                pass
-            finally:
-                try:
-                    self.httpd.socket.close()
-                except AttributeError:
-                    pass
+            if self.httpd:
+                # Also stops the threads answering requests
+                self.httpd.server_close()
             app.APP.deregister_thread(self)
             LOG.info("----===## Plex Companion stopped ##===----")
 
@@ -290,7 +301,8 @@ class PlexCompanion(backgroundthread.KillableThread):
         client = self.client
 
         # Start up instances
-        request_mgr = httppersist.RequestMgr()
+        request_mgr = httppersist.RequestMgr(
+            timeout=subscribers.TIMELINE_TIMEOUT)
         subscription_manager = subscribers.SubscriptionMgr(request_mgr,
                                                            app.APP.player)
         self.subscription_manager = subscription_manager
@@ -306,6 +318,7 @@ class PlexCompanion(backgroundthread.KillableThread):
                         ('', v.COMPANION_PORT),
                         listener.MyHandler)
                     httpd.timeout = 10.0
+                    self.httpd = httpd
                     break
                 except Exception:
                     LOG.error("Unable to start PlexCompanion. Traceback:")
@@ -320,9 +333,10 @@ class PlexCompanion(backgroundthread.KillableThread):
         else:
             LOG.info('User deactivated Plex Companion')
         client.start_all()
-        message_count = 0
         if httpd:
-            thread = Thread(target=httpd.handle_request)
+            thread = Thread(target=self._handle_request, args=(httpd, ))
+        next_registration_check = time() + REGISTRATION_CHECK_INTERVAL
+        next_serverlist_update = time() + SERVERLIST_UPDATE_INTERVAL
 
         while not self.should_cancel():
             # If we are not authorized, sleep
@@ -332,15 +346,16 @@ class PlexCompanion(backgroundthread.KillableThread):
                 if self.wait_while_suspended():
                     break
             try:
-                message_count += 1
+                now = time()
                 if httpd:
                     if not thread.isAlive():
                         # Use threads cause the method will stall
-                        thread = Thread(target=httpd.handle_request)
+                        thread = Thread(target=self._handle_request,
+                                        args=(httpd, ))
                         thread.start()
 
-                    if message_count == 3000:
-                        message_count = 0
+                    if now >= next_registration_check:
+                        next_registration_check = now + REGISTRATION_CHECK_INTERVAL
                         if client.check_client_registration():
                             LOG.debug('Client is still registered')
                         else:
@@ -349,11 +364,10 @@ class PlexCompanion(backgroundthread.KillableThread):
                                       v.COMPANION_PORT)
                             client.register_as_client()
                 # Get and set servers
-                if message_count % 30 == 0:
+                if now >= next_serverlist_update:
+                    next_serverlist_update = now + SERVERLIST_UPDATE_INTERVAL
                     subscription_manager.serverlist = client.getServerList()
                     subscription_manager.notify()
-                    if not httpd:
-                        message_count = 0
             except Exception:
                 LOG.warn("Error in loop, continuing anyway. Traceback:")
                 import traceback
@@ -369,6 +383,10 @@ class PlexCompanion(backgroundthread.KillableThread):
                 app.APP.companion_queue.task_done()
                 # Don't sleep
                 continue
-            self.sleep(0.05)
+            # Block until we get new work or the next check is due
+            deadline = next_serverlist_update
+            if httpd:
+                deadline = min(deadline, next_registration_check)
+            self.wait_for_work(max(deadline - time(), 0))
         subscription_manager.signal_stop()
         client.stop_all()
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, unicode_literals
 
-from .common import PlexDBBase, initialize, wipe, PLEXDB_LOCK
+from .common import PlexDBBase, initialize, fill_items, analyze, wipe, \
+    PLEXDB_LOCK, ITEM_CACHE
 from .tvshows import TVShows
 from .movies import Movies
 from .music import Music
@@ -10,5 +11,30 @@ from .playlists import Playlists
 from .sections import Sections
 
 
+# Keys of the items returned by kodi_item_by_id()
+KODI_ITEM_KEYS = ('plex_type', 'kodi_id', 'kodi_type', 'kodi_fileid',
+                  'kodi_fileid_2', 'section_id')
+
+
 class PlexDB(PlexDBBase, TVShows, Movies, Music, Playlists, Sections):
     pass
+
+
+def kodi_item_by_id(plex_id):
+    """
+    Returns a dict with the keys plex_type, kodi_id, kodi_type and - if
+    applicable - kodi_fileid and kodi_fileid_2 for plex_id or None if the item
+    has not been synced to Kodi. Results are cached in ITEM_CACHE, thus
+    sparing us the SLOW lookup in all tables of item_by_id(plex_type=None)
+    """
+    try:
+        return ITEM_CACHE.get(plex_id)
+    except KeyError:
+        pass
+    generation = ITEM_CACHE.generation
+    with PlexDB(lock=False) as plexdb:
+        item = plexdb.item_by_id(plex_id, plex_type=None)
+    if item:
+        item = {key: item[key] for key in KODI_ITEM_KEYS if key in item}
+    ITEM_CACHE.set(plex_id, item, generation)
+    return item
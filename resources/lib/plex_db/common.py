@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, unicode_literals
 from threading import Lock
+from collections import OrderedDict
 
 from .. import db, variables as v
 
 PLEXDB_LOCK = Lock()
+# Max number of items in ITEM_CACHE
+ITEM_CACHE_SIZE = 1000
 
 SUPPORTED_KODI_TYPES = (
     v.KODI_TYPE_MOVIE,
@@ -18,6 +21,57 @@ SUPPORTED_KODI_TYPES = (
 )
 
 
+class ItemCache(object):
+    """
+    Thread-safe, bounded LRU cache plex_id: item [dict or None]. Every write
+    to the Plex DB tables for a plex_id needs to invalidate its entry
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        # Incremented on every invalidation
+        self.generation = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, plex_id):
+        """
+        Returns the cached item for plex_id or raises KeyError
+        """
+        with self._lock:
+            item = self._items.pop(plex_id)
+            # Mark as most recently used
+            self._items[plex_id] = item
+            return item
+
+    def set(self, plex_id, item, generation):
+        """
+        Caches item for plex_id unless the cache has been invalidated since
+        we obtained generation (before reading item from the DB)
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._items.pop(plex_id, None)
+            self._items[plex_id] = item
+            if len(self._items) > self.maxsize:
+                # Drop the least recently used item
+                self._items.popitem(last=False)
+
+    def invalidate(self, plex_id=None):
+        """
+        Drops the item for plex_id or all items if plex_id is None
+        """
+        with self._lock:
+            self.generation += 1
+            if plex_id is None:
+                self._items.clear()
+            else:
+                self._items.pop(plex_id, None)
+
+
+ITEM_CACHE = ItemCache(ITEM_CACHE_SIZE)
+
+
 class PlexDBBase(object):
     """
     Plex database methods used for all types of items.
@@ -28,22 +82,26 @@ class PlexDBBase(object):
         self.cursor = self.plexconn.cursor() if self.plexconn else None
         self.lock = lock
         self.copy = copy
+        # plex_ids we wrote to, see _invalidate()
+        self.touched = set()
 
     def __enter__(self):
         if self.lock:
             PLEXDB_LOCK.acquire()
-        self.plexconn = db.connect('plex-copy' if self.copy else 'plex')
+        self.plexconn = db.checkout('plex-copy' if self.copy else 'plex')
         self.cursor = self.plexconn.cursor()
         return self
 
     def __exit__(self, e_typ, e_val, trcbak):
         try:
+            db.checkin(self.plexconn,
+                       'plex-copy' if self.copy else 'plex',
+                       commit=e_typ is None)
+            self.invalidate_touched()
             if e_typ:
                 # re-raise any exception
                 return False
-            self.plexconn.commit()
         finally:
-            self.plexconn.close()
             if self.lock:
                 PLEXDB_LOCK.release()
 
@@ -79,18 +137,12 @@ class PlexDBBase(object):
             # Will never be synched to Kodi
             pass
         elif plex_type is None:
-            # SLOW - lookup plex_id in all our tables
-            for kind in (v.PLEX_TYPE_MOVIE,
-                         v.PLEX_TYPE_EPISODE,
-                         v.PLEX_TYPE_SHOW,
-                         v.PLEX_TYPE_SEASON,
-                         'song',  # darn
-                         v.PLEX_TYPE_ALBUM,
-                         v.PLEX_TYPE_ARTIST):
-                method = getattr(self, kind)
-                answ = method(plex_id)
-                if answ:
-                    break
+            # Look up the plex_type first
+            self.cursor.execute('SELECT plex_type FROM items WHERE plex_id = ?',
+                                (plex_id, ))
+            plex_type = self.cursor.fetchone()
+            if plex_type:
+                answ = self.item_by_id(plex_id, plex_type[0])
         return answ
 
     def item_by_kodi_id(self, kodi_id, kodi_type):
@@ -124,6 +176,26 @@ class PlexDBBase(object):
         except TypeError:
             pass
 
+    def count_by_sectionid(self, section_id, plex_type):
+        """
+        Returns the number of items of plex_type recorded for section_id
+        """
+        self.cursor.execute('SELECT COUNT(*) FROM %s WHERE section_id = ?' % plex_type,
+                            (section_id, ))
+        return self.cursor.fetchone()[0]
+
+    def checksums_by_sectionid(self, section_id, plex_type):
+        """
+        Returns an iterator of (plex_id, checksum) tuples for all items of
+        plex_type in section_id, sorted by plex_id. Uses a dedicated cursor so
+        that other lookups can be done while iterating
+        """
+        cursor = self.plexconn.cursor()
+        return cursor.execute(
+            'SELECT plex_id, checksum FROM %s WHERE section_id = ? ORDER BY plex_id'
+            % plex_type,
+            (section_id, ))
+
     def update_last_sync(self, plex_id, plex_type, last_sync):
         """
         Sets a new timestamp for plex_id
@@ -131,11 +203,43 @@ class PlexDBBase(object):
         self.cursor.execute('UPDATE %s SET last_sync = ? WHERE plex_id = ?' % plex_type,
                             (last_sync, plex_id))
 
+    def add_item(self, plex_id, plex_type):
+        """
+        Records the plex_type of plex_id in the table items. Call whenever an
+        item is added to one of the tables for Plex items
+        """
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO items(plex_id, plex_type)
+            VALUES (?, ?)
+        ''', (plex_id, plex_type))
+        self._invalidate(plex_id)
+
     def remove(self, plex_id, plex_type):
         """
         Removes the item from our Plex db
         """
         self.cursor.execute('DELETE FROM %s WHERE plex_id = ?' % plex_type, (plex_id, ))
+        self.cursor.execute('DELETE FROM items WHERE plex_id = ? AND plex_type = ?',
+                            (plex_id, plex_type))
+        self._invalidate(plex_id)
+
+    def _invalidate(self, plex_id):
+        """
+        Drops plex_id from ITEM_CACHE right away and once again after we
+        committed our transaction
+        """
+        ITEM_CACHE.invalidate(plex_id)
+        self.touched.add(plex_id)
+
+    def invalidate_touched(self):
+        """
+        Call right after committing (or rolling back) plexconn. Other
+        connections only see our changes now - invalidate again as they might
+        have cached what they read before
+        """
+        for plex_id in self.touched:
+            ITEM_CACHE.invalidate(plex_id)
+        self.touched.clear()
 
     def every_plex_id(self, plex_type, offset, limit):
         """
@@ -289,6 +393,13 @@ def initialize():
                     kodi_type TEXT,
                     kodi_hash TEXT)
             ''')
+            # plex_type of every synced plex_id - spares us a lookup in
+            # every single table if we don't know the plex_type
+            plexdb.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS items(
+                    plex_id INTEGER PRIMARY KEY,
+                    plex_type TEXT)
+            ''')
             # DB indicees for faster lookups
             commands = (
                 'CREATE INDEX IF NOT EXISTS ix_movie_1 ON movie (last_sync)',
@@ -305,6 +416,20 @@ def initialize():
                 'CREATE UNIQUE INDEX IF NOT EXISTS ix_album_2 ON album (kodi_id)',
                 'CREATE INDEX IF NOT EXISTS ix_track_1 ON track (last_sync)',
                 'CREATE UNIQUE INDEX IF NOT EXISTS ix_track_2 ON track (kodi_id)',
+                # Lookups by library section and by parent items
+                'CREATE INDEX IF NOT EXISTS ix_movie_3 ON movie (section_id)',
+                'CREATE INDEX IF NOT EXISTS ix_show_3 ON show (section_id)',
+                'CREATE INDEX IF NOT EXISTS ix_season_3 ON season (section_id)',
+                'CREATE INDEX IF NOT EXISTS ix_season_4 ON season (show_id)',
+                'CREATE INDEX IF NOT EXISTS ix_episode_3 ON episode (section_id)',
+                'CREATE INDEX IF NOT EXISTS ix_episode_4 ON episode (show_id)',
+                'CREATE INDEX IF NOT EXISTS ix_episode_5 ON episode (season_id)',
+                'CREATE INDEX IF NOT EXISTS ix_artist_3 ON artist (section_id)',
+                'CREATE INDEX IF NOT EXISTS ix_album_3 ON album (section_id)',
+                'CREATE INDEX IF NOT EXISTS ix_album_4 ON album (artist_id)',
+                'CREATE INDEX IF NOT EXISTS ix_track_3 ON track (section_id)',
+                'CREATE INDEX IF NOT EXISTS ix_track_4 ON track (artist_id)',
+                'CREATE INDEX IF NOT EXISTS ix_track_5 ON track (album_id)',
                 'CREATE UNIQUE INDEX IF NOT EXISTS ix_playlists_2 ON playlists (kodi_path)',
                 'CREATE INDEX IF NOT EXISTS ix_playlists_3 ON playlists (kodi_hash)',
             )
@@ -312,6 +437,36 @@ def initialize():
                 plexdb.cursor.execute(cmd)
 
 
+def fill_items():
+    """
+    Adds all the items we already synced to the table items, e.g. after
+    migrating from a PKC version without that table. Call from migration.py
+    only: also backfills items that an older PKC version synced after a
+    downgrade
+    """
+    with PlexDBBase() as plexdb:
+        for plex_type, table in ((v.PLEX_TYPE_MOVIE, 'movie'),
+                                 (v.PLEX_TYPE_SHOW, 'show'),
+                                 (v.PLEX_TYPE_SEASON, 'season'),
+                                 (v.PLEX_TYPE_EPISODE, 'episode'),
+                                 (v.PLEX_TYPE_ARTIST, 'artist'),
+                                 (v.PLEX_TYPE_ALBUM, 'album'),
+                                 (v.PLEX_TYPE_SONG, 'track')):
+            plexdb.cursor.execute('''
+                INSERT OR IGNORE INTO items(plex_id, plex_type)
+                SELECT plex_id, ? FROM %s
+            ''' % table, (plex_type, ))
+    ITEM_CACHE.invalidate()
+
+
+def analyze():
+    """
+    Updates the statistics that sqlite uses to choose the best index
+    """
+    with PlexDBBase() as plexdb:
+        plexdb.cursor.execute('ANALYZE')
+
+
 def wipe(table=None):
     """
     Completely resets the Plex database.
@@ -325,3 +480,4 @@ def wipe(table=None):
             tables = [i[0] for i in plexdb.cursor.fetchall()]
         for table in tables:
             plexdb.cursor.execute('DROP table IF EXISTS %s' % table)
+    ITEM_CACHE.invalidate()
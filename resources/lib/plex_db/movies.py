@@ -32,6 +32,7 @@ class Movies(object):
              kodi_pathid,
              0,
              last_sync))
+        self.add_item(plex_id, v.PLEX_TYPE_MOVIE)
 
     def movie(self, plex_id):
         """
@@ -4,16 +4,23 @@ from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
 from ast import literal_eval
 from copy import deepcopy
+from functools import partial
+from math import ceil
 from time import time
-from threading import Thread
+from threading import Thread, Condition
 
-from .downloadutils import DownloadUtils as DU, exceptions
+from .downloadutils import DownloadUtils as DU, exceptions, use_sync_session
 from . import backgroundthread, utils, plex_tv, variables as v, app
 
 ###############################################################################
 LOG = getLogger('PLEX.plex_functions')
 
 CONTAINERSIZE = int(utils.settings('limitindex'))
+# Number of chunks of CONTAINERSIZE items that DownloadGen downloads ahead of
+# the consumer. The window adapts between min and max
+PREFETCH_START = 10
+PREFETCH_MIN = 2
+PREFETCH_MAX = 20
 
 # For discovery of PMS in the local LAN
 PLEX_GDM_IP = '239.0.0.250'  # multicast to PMS
@@ -514,6 +521,26 @@ def GetPlexMetadata(key, reraise=False):
         return xml
 
 
+def get_metadata_batch(plex_ids):
+    """
+    Returns raw API metadata for several plex_ids [list of int] using one
+    single PMS request. Returns a dict plex_id: etree XML, every XML looking
+    like one returned by GetPlexMetadata. Items the PMS did not return are
+    missing from the dict.
+
+    Returns None or 401 if something went wrong
+    """
+    xml = GetPlexMetadata(','.join(unicode(x) for x in plex_ids))
+    if xml is None or xml == 401:
+        return xml
+    answ = {}
+    for child in xml:
+        container = utils.etree.Element(xml.tag, attrib=xml.attrib)
+        container.append(child)
+        answ[utils.cast(int, child.get('ratingKey'))] = container
+    return answ
+
+
 def get_playback_xml(url, server_name, authenticate=True, token=None):
     """
     Returns None if something went wrong
@@ -568,6 +595,8 @@ class ThreadedDownloadChunk(backgroundthread.Task):
     """
     This task will also be executed while library sync is suspended!
     """
+    lane = backgroundthread.LANE_SYNC
+
     def __init__(self, url, args, callback):
         self.url = url
         self.args = args
@@ -575,14 +604,12 @@ class ThreadedDownloadChunk(backgroundthread.Task):
         super(ThreadedDownloadChunk, self).__init__()
 
     def run(self):
-        xml = DU().downloadUrl(self.url, parameters=self.args)
+        use_sync_session(True)
         try:
-            xml.attrib
-        except AttributeError:
-            LOG.error('Error while downloading chunks: %s, args: %s',
-                      self.url, self.args)
-            xml = None
-        self.callback(xml)
+            children = _download_chunk_children(self.url, self.args)
+        finally:
+            use_sync_session(False)
+        self.callback(children)
 
 
 class DownloadGen(object):
@@ -590,13 +617,22 @@ class DownloadGen(object):
     Special iterator object that will yield all child xmls piece-wise. It also
     saves the original xml.attrib.
 
+    All chunks are parsed while they are being received, the first one even
+    while its children are already being yielded.
+
+    Chunks of CONTAINERSIZE items are downloaded ahead of time and yielded in
+    the order of their container start, no matter in which order the
+    downloads finish. The number of chunks buffered or being downloaded at
+    once (the prefetch window cache_factor) adapts to the measured download
+    latency and to how fast the items are consumed, but always stays between
+    PREFETCH_MIN and PREFETCH_MAX. Consumed chunks are discarded immediately.
+
     Yields XML etree children or raises RuntimeError at the end
     """
     def __init__(self, url, plex_type, last_viewed_at, updated_at, args,
                  downloader):
         self._downloader = downloader
         self.successful = True
-        self.xml = None
         self.args = args
         self.args.update({
             'X-Plex-Container-Start': 0,
@@ -610,28 +646,104 @@ class DownloadGen(object):
         if updated_at:
             url = '%supdatedAt>=%s&' % (url, updated_at)
         self.url = url[:-1]
-        _blocking_download_chunk(self.url, self.args, 0, self.set_xml)
-        self.attrib = self.xml.attrib
+        # The first chunk is parsed while we're already yielding its children
+        self._chunk = _stream_chunk(self.url, self.args, 0)
+        self._children = iter(self._chunk)
+        self.attrib = self._chunk.attrib
         self.current = 0
         self.total = int(self.attrib['totalSize'])
-        self.cache_factor = 10
-        # Will keep track whether we still have results incoming
-        self.pending_counter = []
-        end = min(self.cache_factor * CONTAINERSIZE,
-                  self.total + CONTAINERSIZE - self.total % CONTAINERSIZE)
-        for pos in range(CONTAINERSIZE, end, CONTAINERSIZE):
-            self.pending_counter.append(None)
-            self._downloader(self.url, self.args, pos, self.on_chunk_downloaded)
-
-    def set_xml(self, xml):
-        self.xml = xml
-
-    def on_chunk_downloaded(self, xml):
-        if xml is not None:
-            self.xml.extend(xml)
-        else:
-            self.successful = False
-        self.pending_counter.pop()
+        # Max. number of chunks buffered or being downloaded at any time
+        self.cache_factor = PREFETCH_START
+        self._cond = Condition()
+        # Downloaded chunks waiting to be consumed. Dict container start:
+        # chunk xml (or None if the download failed)
+        self._chunks = {}
+        # Dict container start: time the download was requested
+        self._requested = {}
+        # Container start for the next chunk to download
+        self._next_start = CONTAINERSIZE
+        # Container start of the next chunk to consume
+        self._next_consume = CONTAINERSIZE
+        # Moving averages in seconds: download latency for one chunk and time
+        # the consumer needs to work through one chunk
+        self._latency = None
+        self._consume_time = None
+        self._chunk_started = time()
+        # Total time the consumer had to wait for downloads
+        self.stall_time = 0.0
+        self._closed = False
+        self._fill_window()
+
+    def _fill_window(self):
+        """
+        Requests new chunks until cache_factor chunks are either buffered or
+        being downloaded
+        """
+        while self._next_start < self.total:
+            with self._cond:
+                if (self._next_start - self._next_consume >=
+                        self.cache_factor * CONTAINERSIZE):
+                    break
+                start = self._next_start
+                self._next_start += CONTAINERSIZE
+                self._requested[start] = time()
+            self._downloader(self.url, self.args, start,
+                             partial(self.on_chunk_downloaded, start))
+
+    def on_chunk_downloaded(self, start, xml):
+        with self._cond:
+            if self._closed:
+                return
+            if xml is None:
+                self.successful = False
+            self._chunks[start] = xml
+            self._latency = _moving_average(self._latency,
+                                            time() - self._requested.pop(start))
+            self._cond.notify()
+
+    def _adapt_window(self):
+        """
+        Sets the prefetch window so that downloads can keep up with the
+        consumer
+        """
+        if not self._latency or not self._consume_time:
+            return
+        window = int(ceil(self._latency / self._consume_time)) + 1
+        window = max(PREFETCH_MIN, min(PREFETCH_MAX, window))
+        if window != self.cache_factor:
+            LOG.debug('Prefetch window now %s chunks (latency %.3fs, '
+                      'consumer %.3fs per chunk, total stall time %.2fs)',
+                      window, self._latency, self._consume_time,
+                      self.stall_time)
+            self.cache_factor = window
+
+    def _next_chunk(self):
+        """
+        Blocks until the next chunk in line is available. Returns None if
+        there are no chunks left. Skips chunks that failed to download
+        """
+        chunk = None
+        while chunk is None and self._next_consume < self._next_start:
+            now = time()
+            with self._cond:
+                while self._next_consume not in self._chunks:
+                    self._cond.wait(0.1)
+                    if app.APP.monitor.abortRequested():
+                        raise StopIteration('PKC needs to exit now')
+                chunk = self._chunks.pop(self._next_consume)
+                self._next_consume += CONTAINERSIZE
+                stalled = time() - now
+                self.stall_time += stalled
+                self._consume_time = _moving_average(
+                    self._consume_time, now - self._chunk_started)
+                self._chunk_started = time()
+                self._adapt_window()
+            if stalled > 0.01:
+                LOG.debug('Waited %.2fs for chunk %s, prefetch window %s '
+                          'chunks', stalled, self._next_consume - CONTAINERSIZE,
+                          self.cache_factor)
+            self._fill_window()
+        return chunk
 
     def get(self, key, default=None):
         """
@@ -639,43 +751,61 @@ class DownloadGen(object):
         """
         return self.attrib.get(key, default)
 
+    def close(self):
+        """
+        Call from the thread iterating if you stop before the end, e.g. if
+        the sync has been cancelled. Closes the connection still streaming
+        the first chunk and discards all prefetched chunks. Iterating
+        afterwards yields nothing anymore
+        """
+        with self._cond:
+            self._closed = True
+            self._chunks.clear()
+        if self._chunk is not None and hasattr(self._chunk, 'close'):
+            self._chunk.close()
+        self._chunk = self._children = None
+
     def __iter__(self):
         return self
 
     def __next__(self):
-        while True:
+        while self._children is not None:
             try:
-                child = self.xml[0]
+                child = next(self._children)
+            except StopIteration:
+                if not getattr(self._chunk, 'successful', True):
+                    self.successful = False
+                # Release the consumed chunk before waiting for the next one
+                self._chunk = self._children = None
+                self._chunk = self._next_chunk()
+                if self._chunk is not None:
+                    self._children = iter(self._chunk)
+            else:
                 self.current += 1
-                self.xml.remove(child)
-                if (self.current % CONTAINERSIZE == 0 and
-                        self.current <= self.total - (self.cache_factor - 1) * CONTAINERSIZE):
-                    self.pending_counter.append(None)
-                    self._downloader(
-                        self.url,
-                        self.args,
-                        self.current + (self.cache_factor - 1) * CONTAINERSIZE,
-                        self.on_chunk_downloaded)
                 return child
-            except IndexError:
-                if not self.pending_counter and not len(self.xml):
-                    if not self.successful:
-                        raise RuntimeError('Could not download everything')
-                    else:
-                        raise StopIteration()
-            LOG.debug('Waiting for download to finish')
-            if app.APP.monitor.waitForAbort(0.1):
-                raise StopIteration('PKC needs to exit now')
+        LOG.debug('Done downloading %s items of %s, total stall time %.2fs',
+                  self.current, self.url, self.stall_time)
+        if not self.successful:
+            raise RuntimeError('Could not download everything')
+        raise StopIteration()
 
     next = __next__
 
 
-def _blocking_download_chunk(url, args, start, callback):
+def _moving_average(average, value, weight=0.3):
+    """
+    Exponential moving average
     """
-    callback will be called with the downloaded xml (fragment)
+    return value if average is None else (1 - weight) * average + weight * value
+
+
+def _stream_chunk(url, args, start):
+    """
+    Returns a StreamingXML for the chunk starting at start or raises
+    RuntimeError
     """
     args['X-Plex-Container-Start'] = start
-    xml = DU().downloadUrl(url, parameters=args)
+    xml = DU().downloadUrl(url, parameters=args, stream=True)
     try:
         xml.attrib
     except AttributeError:
@@ -683,7 +813,36 @@ def _blocking_download_chunk(url, args, start, callback):
                   url, args)
         raise RuntimeError('Error while downloading chunks for %s'
                            % url)
-    callback(xml)
+    return xml
+
+
+def _download_chunk_children(url, args):
+    """
+    Downloads one chunk, parsing it while receiving it. Returns a list of the
+    chunk's children or None if something went wrong
+    """
+    xml = DU().downloadUrl(url, parameters=args, stream=True)
+    try:
+        xml.attrib
+    except AttributeError:
+        xml = None
+    else:
+        children = list(xml)
+    if xml is None or not xml.successful:
+        LOG.error('Error while downloading chunks: %s, args: %s', url, args)
+        return
+    return children
+
+
+def _blocking_download_chunk(url, args, start, callback):
+    """
+    callback will be called with a list of the downloaded xml's children
+    """
+    args['X-Plex-Container-Start'] = start
+    children = _download_chunk_children(url, args)
+    if children is None:
+        raise RuntimeError('Error while downloading chunks for %s' % url)
+    callback(children)
 
 
 def _async_download_chunk(url, args, start, callback):
@@ -741,11 +900,17 @@ def DownloadChunks(url):
             'X-Plex-Container-Start': pos,
             'sort': 'id'
         }
-        xmlpart = DU().downloadUrl(utils.extend_url(url, args))
-        # If something went wrong - skip in the hope that it works next time
+        xmlpart = DU().downloadUrl(utils.extend_url(url, args), stream=True)
         try:
             xmlpart.attrib
         except AttributeError:
+            children = None
+        else:
+            children = list(xmlpart)
+            if not xmlpart.successful:
+                children = None
+        # If something went wrong - skip in the hope that it works next time
+        if children is None:
             LOG.error('Error while downloading chunks: %s, args: %s',
                       url, args)
             pos += CONTAINERSIZE
@@ -754,17 +919,11 @@ def DownloadChunks(url):
 
         # Very first run: starting xml (to retain data in xml's root!)
         if xml is None:
-            xml = deepcopy(xmlpart)
-            if len(xmlpart) < CONTAINERSIZE:
-                break
-            else:
-                pos += CONTAINERSIZE
-                continue
+            xml = utils.etree.Element(xmlpart.tag, attrib=dict(xmlpart.attrib))
         # Build answer xml - containing the entire library
-        for child in xmlpart:
-            xml.append(child)
+        xml.extend(children)
         # Done as soon as we don't receive a full complement of items
-        if len(xmlpart) < CONTAINERSIZE:
+        if len(children) < CONTAINERSIZE:
             break
         pos += CONTAINERSIZE
     if error_counter == 10:
@@ -6,29 +6,57 @@ import httplib
 import traceback
 import string
 import errno
-from socket import error as socket_error
+from socket import error as socket_error, timeout as socket_timeout
+from threading import Lock
 
 ###############################################################################
 
 LOG = getLogger('PLEX.httppersist')
 
+# Remote close and connection refused (e.g. shutdown PKC). The WSA-codes only
+# exist on Windows
+IGNORED_ERRNOS = tuple(getattr(errno, code) for code in ('WSAECONNABORTED',
+                                                         'WSAECONNREFUSED',
+                                                         'ECONNABORTED',
+                                                         'ECONNREFUSED')
+                       if hasattr(errno, code))
+# The host closed an idle keep-alive connection that we tried to re-use
+STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
 ###############################################################################
 
 
+class StaleConnection(Exception):
+    """
+    Raised if a re-used keep-alive connection turned out to be closed
+    """
+    pass
+
+
 class RequestMgr:
-    def __init__(self):
+    def __init__(self, timeout=None):
         self.conns = {}
+        # One lock per connection - httplib connections can only handle one
+        # request at a time
+        self.locks = {}
+        # Socket timeout in seconds for new connections, None to block
+        self.timeout = timeout
 
     def getConnection(self, protocol, host, port):
         conn = self.conns.get(protocol + host + str(port), False)
         if not conn:
             if protocol == "https":
-                conn = httplib.HTTPSConnection(host, port)
+                conn = httplib.HTTPSConnection(host, port,
+                                               timeout=self.timeout)
             else:
-                conn = httplib.HTTPConnection(host, port)
+                conn = httplib.HTTPConnection(host, port,
+                                              timeout=self.timeout)
             self.conns[protocol + host + str(port)] = conn
         return conn
 
+    def _lock(self, protocol, host, port):
+        return self.locks.setdefault(protocol + host + str(port), Lock())
+
     def closeConnection(self, protocol, host, port):
         conn = self.conns.get(protocol + host + str(port), False)
         if conn:
@@ -41,29 +69,58 @@ class RequestMgr:
         self.conns = {}
 
     def post(self, host, port, path, body, header={}, protocol="http"):
+        """
+        Returns the answer's body (or True if there is none), the HTTP status
+        code [int] for errors >= 400 or False if we could not reach host
+        """
+        with self._lock(protocol, host, port):
+            try:
+                return self._post(host, port, path, body, header, protocol)
+            except StaleConnection:
+                # Try once more using a new connection
+                LOG.debug('Connection to %s:%s went stale, reconnecting',
+                          host, port)
+                return self._post(host, port, path, body, header, protocol)
+
+    def _post(self, host, port, path, body, header, protocol):
         conn = None
+        reused = protocol + host + str(port) in self.conns
         try:
             conn = self.getConnection(protocol, host, port)
             header['Connection'] = "keep-alive"
             conn.request("POST", path, body, header)
             data = conn.getresponse()
+            if data.length is None and not data.chunked:
+                # Without Content-Length, the body only ends once host closes
+                # the connection - don't wait for that, reconnect next time
+                self.conns.pop(protocol + host + str(port), None)
+                conn.close()
+                answ = True
+            else:
+                answ = data.read() or True
             if int(data.status) >= 400:
                 LOG.error("HTTP response error: %s" % str(data.status))
-                # this should return false, but I'm hacking it since iOS
-                # returns 404 no matter what
-                return data.read() or True
-            else:
-                return data.read() or True
-        except socket_error as serr:
+                return int(data.status)
+            return answ
+        except socket_timeout:
+            LOG.warn('Timeout while posting to %s', host)
+            self.conns.pop(protocol + host + str(port), None)
+            if conn:
+                conn.close()
+            return False
+        except (socket_error, httplib.BadStatusLine) as serr:
+            self.conns.pop(protocol + host + str(port), None)
+            if conn:
+                conn.close()
+            if reused and (isinstance(serr, httplib.BadStatusLine) or
+                           serr.errno in STALE_ERRNOS):
+                raise StaleConnection()
             # Ignore remote close and connection refused (e.g. shutdown PKC)
-            if serr.errno in (errno.WSAECONNABORTED, errno.WSAECONNREFUSED):
+            if getattr(serr, 'errno', None) in IGNORED_ERRNOS:
                 pass
             else:
                 LOG.error("Unable to connect to %s\nReason:" % host)
                 LOG.error(traceback.print_exc())
-            self.conns.pop(protocol + host + str(port), None)
-            if conn:
-                conn.close()
             return False
         except Exception as e:
             LOG.error("Exception encountered: %s", e)
@@ -96,7 +153,7 @@ class RequestMgr:
                 return data.read() or True
         except socket_error as serr:
             # Ignore remote close and connection refused (e.g. shutdown PKC)
-            if serr.errno in (errno.WSAECONNABORTED, errno.WSAECONNREFUSED):
+            if serr.errno in IGNORED_ERRNOS:
                 pass
             else:
                 LOG.error("Unable to connect to %s\nReason:", host)
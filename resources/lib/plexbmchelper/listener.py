@@ -6,8 +6,9 @@ Plex Companion listener
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
 from re import sub
-from SocketServer import ThreadingMixIn
+from threading import Thread
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import Queue
 
 from .. import utils, companion, json_rpc as js, clientinfo, variables as v
 from .. import app
@@ -16,8 +17,12 @@ from .. import app
 
 LOG = getLogger('PLEX.listener')
 
-# Hack we need in order to keep track of the open connections from Plex Web
-CLIENT_DICT = {}
+# Number of threads answering Plex Companion requests
+REQUEST_THREADS = 12
+# Max. number of requests waiting for a free thread
+REQUEST_BACKLOG = 32
+# Seconds after which we let go of a long-polling connection (Plex Web)
+POLL_TIMEOUT = 30
 
 ###############################################################################
 
@@ -127,28 +132,16 @@ class MyHandler(BaseHTTPRequestHandler):
                     machineIdentifier=v.PKC_MACHINE_IDENTIFIER),
                 clientinfo.getXArgsDeviceInfo(include_token=False))
         elif request_path == 'player/timeline/poll':
-            # Plex web does polling if connected to PKC via Companion
-            # Only reply if there is indeed something playing
-            # Otherwise, all clients seem to keep connection open
-            if params.get('wait') == '1':
-                app.APP.monitor.waitForAbort(0.95)
-            if self.client_address[0] not in CLIENT_DICT:
-                CLIENT_DICT[self.client_address[0]] = []
-            tracker = CLIENT_DICT[self.client_address[0]]
-            tracker.append(self.client_address[1])
-            while (not app.APP.is_playing and
-                   not app.APP.monitor.abortRequested() and
-                   sub_mgr.stop_sent_to_web and not
-                   (len(tracker) >= 4 and
-                    tracker[0] == self.client_address[1])):
-                # Keep at most 3 connections open, then drop the first one
-                # Doesn't need to be thread-save
-                # Silly stuff really
-                app.APP.monitor.waitForAbort(1)
-            # Let PKC know that we're releasing this connection
-            tracker.pop(0)
-            msg = sub_mgr.msg(js.get_players()).format(
-                command_id=params.get('commandID', 0))
+            # Plex web does long-polling if connected to PKC via Companion
+            # Reply as soon as our timeline changes
+            if (params.get('wait') == '1' and
+                    sub_mgr.wait_for_timeline(POLL_TIMEOUT)):
+                # Use the timeline notify() just came up with
+                msg = sub_mgr.last_timeline
+            else:
+                with app.APP.lock_subscriber:
+                    msg = sub_mgr.msg(js.get_players())
+            msg = msg.format(command_id=params.get('commandID', 0))
             if sub_mgr.isplaying:
                 self.response(
                     msg,
@@ -201,7 +194,8 @@ class MyHandler(BaseHTTPRequestHandler):
                                    host,
                                    port,
                                    uuid,
-                                   command_id)
+                                   command_id,
+                                   self.headers.get('X-Plex-Platform'))
         elif "/unsubscribe" in request_path:
             self.response(v.COMPANION_OK_MESSAGE,
                           clientinfo.getXArgsDeviceInfo(include_token=False))
@@ -214,12 +208,78 @@ class MyHandler(BaseHTTPRequestHandler):
             self.response('', clientinfo.getXArgsDeviceInfo(include_token=False))
 
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+class ThreadPoolMixIn(object):
     """
-    Using ThreadingMixIn Thread magic
+    Like SocketServer.ThreadingMixIn, but answers requests with a fixed number
+    of threads instead of starting a new thread for every single request.
+    Requests are rejected if too many are waiting for a thread
     """
-    daemon_threads = True
+    pool_size = REQUEST_THREADS
+    backlog = REQUEST_BACKLOG
+    thread_name = 'PKC-Companion'
+
+    def _init_pool(self):
+        self.requests = Queue.Queue(self.backlog)
+        self.workers = []
+
+    def process_request_thread(self):
+        """
+        Answers requests until None is encountered
+        """
+        while True:
+            request, client_address = self.requests.get()
+            if request is None:
+                # Pass the sentinel on to the next thread
+                try:
+                    self.requests.put_nowait((None, None))
+                except Queue.Full:
+                    pass
+                break
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
 
+    def process_request(self, request, client_address):
+        if not self.workers:
+            for i in range(self.pool_size):
+                thread = Thread(target=self.process_request_thread,
+                                name='%s-%s' % (self.thread_name, i))
+                thread.daemon = True
+                thread.start()
+                self.workers.append(thread)
+        try:
+            self.requests.put_nowait((request, client_address))
+        except Queue.Full:
+            LOG.warn('Too many requests for %s, dropping one from %s',
+                     self.thread_name, client_address[0])
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super(ThreadPoolMixIn, self).server_close()
+        # Drop the requests still waiting for a thread to make room for our
+        # sentinel - never block
+        while True:
+            try:
+                request, _ = self.requests.get_nowait()
+            except Queue.Empty:
+                break
+            if request is not None:
+                self.shutdown_request(request)
+        if self.workers:
+            try:
+                self.requests.put_nowait((None, None))
+            except Queue.Full:
+                pass
+        self.workers = []
+
+
+class ThreadedHTTPServer(ThreadPoolMixIn, HTTPServer):
+    """
+    Answers requests using a pool of threads
+    """
     def __init__(self, client, subscription_manager, *args, **kwargs):
         """
         client: Class handle to plexgdm.plexgdm. We can thus ask for an up-to-
@@ -229,4 +289,5 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
         """
         self.client = client
         self.subscription_manager = subscription_manager
+        self._init_pool()
         HTTPServer.__init__(self, *args, **kwargs)
@@ -6,7 +6,9 @@ subscribed Plex Companion clients.
 """
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
-from threading import Thread
+from threading import Thread, Lock, Condition
+from time import time
+import Queue
 
 from ..downloadutils import DownloadUtils as DU
 from .. import timing
@@ -19,6 +21,21 @@ from .. import playqueue as PQ
 LOG = getLogger('PLEX.subscribers')
 ###############################################################################
 
+# Number of threads POSTing timelines to Plex Companion subscribers
+TIMELINE_WORKERS = 2
+# Socket timeout in seconds for timeline POSTs to subscribers
+TIMELINE_TIMEOUT = 10.0
+# Max. number of long-polling connections (Plex Web) we keep open at once
+MAX_PARKED_POLLS = 8
+# Seconds after which we answer long-polls exceeding MAX_PARKED_POLLS - an
+# immediate answer would only make Plex Web poll again right away
+OVERFLOW_POLL_DELAY = 3
+# Seconds after which we send an unchanged timeline again during playback
+TIMELINE_HEARTBEAT = 10
+# Milliseconds the playback time may deviate from what we expect before we
+# send a new timeline
+TIME_DRIFT = 2000
+
 # What is Companion controllable?
 CONTROLLABLE = {
     v.PLEX_PLAYLIST_TYPE_VIDEO: 'playPause,stop,volume,shuffle,audioStream,'
@@ -89,13 +106,111 @@ def headers_companion_client():
     }
 
 
-def update_player_info(playerid):
+def update_player_info(playerid, volume, muted):
     """
-    Updates all player info for playerid [int] in state.py.
+    Updates all player info for playerid [int] in state.py. Pass in Kodi's
+    volume and muted state, see js.get_volume_muted()
     """
     app.PLAYSTATE.player_states[playerid].update(js.get_player_props(playerid))
-    app.PLAYSTATE.player_states[playerid]['volume'] = js.get_volume()
-    app.PLAYSTATE.player_states[playerid]['muted'] = js.get_muted()
+    app.PLAYSTATE.player_states[playerid]['volume'] = volume
+    app.PLAYSTATE.player_states[playerid]['muted'] = muted
+
+
+def differs(old, new, elapsed):
+    """
+    Returns True if the timeline or PMS parameters dict new differs from the
+    dict old that we sent elapsed seconds ago. Playback time that progressed
+    just as expected is not a difference - unless TIMELINE_HEARTBEAT is due
+    during playback
+    """
+    if old is None or len(old) != len(new):
+        return True
+    if (elapsed >= TIMELINE_HEARTBEAT and
+            new.get('state') in ('playing', 'paused')):
+        return True
+    for key, value in new.iteritems():
+        if key != 'time' and old.get(key) != value:
+            return True
+    expected = old.get('time', 0)
+    if new.get('state') == 'playing':
+        expected += elapsed * 1000
+    return abs(new.get('time', 0) - expected) > TIME_DRIFT
+
+
+class TimelinePool(object):
+    """
+    Small pool of threads that POST timelines to our Plex Companion
+    subscribers. Keeps track of how many timelines were sent, coalesced (an
+    older timeline was replaced by a newer one before it could be sent) and
+    dropped (the subscriber failed or is gone)
+    """
+    def __init__(self, worker_count=TIMELINE_WORKERS):
+        self.worker_count = worker_count
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.lock = Lock()
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def schedule(self, subscriber):
+        """
+        Let one of our threads call subscriber.send_pending()
+        """
+        with self.lock:
+            if not self.workers:
+                for i in range(self.worker_count):
+                    thread = Thread(target=self._work,
+                                    name='PKC-Timeline-%s' % i)
+                    thread.daemon = True
+                    thread.start()
+                    self.workers.append(thread)
+        self.queue.put(subscriber)
+
+    def _work(self):
+        while True:
+            subscriber = self.queue.get()
+            try:
+                if subscriber is None:
+                    break
+                subscriber.send_pending()
+            except Exception:
+                LOG.error('Error sending timeline to subscriber %s',
+                          subscriber.uuid)
+                import traceback
+                LOG.error(traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+    def count(self, sent=0, coalesced=0, dropped=0):
+        """
+        Thread-safe update of our metrics
+        """
+        with self.lock:
+            self.sent += sent
+            self.coalesced += coalesced
+            self.dropped += dropped
+
+    def stats(self):
+        """
+        Returns a dict with the number of sent, coalesced and dropped timelines
+        """
+        with self.lock:
+            return {
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped
+            }
+
+    def shutdown(self):
+        """
+        Stops our threads once they've sent what they're currently sending
+        """
+        with self.lock:
+            for _ in self.workers:
+                self.queue.put(None)
+            self.workers = []
+        LOG.info('Subscriber timelines: %s', self.stats())
 
 
 class SubscriptionMgr(object):
@@ -117,6 +232,17 @@ class SubscriptionMgr(object):
         # In order to signal a stop to Plex Web ONCE on playback stop
         self.stop_sent_to_web = True
         self.request_mgr = request_mgr
+        self.timeline_pool = TimelinePool()
+        # Signalled whenever our timeline changes, for long-polling clients
+        self.timeline_changed = Condition()
+        self.timeline_version = 0
+        self.last_timeline = None
+        self.parked_polls = 0
+        # Timeline dicts per Plex playlist type we last sent, and when
+        self.sent_timelines = {}
+        self.sent_timelines_at = 0
+        # PMS parameters we last sent per Kodi playerid: (params, timestamp)
+        self.sent_params = {}
 
     def _server_by_host(self, host):
         if len(self.serverlist) == 1:
@@ -144,39 +270,45 @@ class SubscriptionMgr(object):
         Returns a timeline xml as str
         (xml containing video, audio, photo player state)
         """
+        return self._msg(self._timelines(players))
+
+    def _timelines(self, players):
+        """
+        Returns a dict with the timeline dict for every Plex playlist type
+        """
         self.isplaying = False
         self.location = 'navigation'
-        answ = str(XML)
-        timelines = {
-            v.PLEX_PLAYLIST_TYPE_VIDEO: None,
-            v.PLEX_PLAYLIST_TYPE_AUDIO: None,
-            v.PLEX_PLAYLIST_TYPE_PHOTO: None
-        }
-        for typus in timelines:
-            if players.get(v.KODI_PLAYLIST_TYPE_FROM_PLEX_PLAYLIST_TYPE[typus]) is None:
-                timeline = {
+        timelines = {}
+        for typus in (v.PLEX_PLAYLIST_TYPE_VIDEO,
+                      v.PLEX_PLAYLIST_TYPE_AUDIO,
+                      v.PLEX_PLAYLIST_TYPE_PHOTO):
+            player = players.get(
+                v.KODI_PLAYLIST_TYPE_FROM_PLEX_PLAYLIST_TYPE[typus])
+            if player is None:
+                timelines[typus] = {
                     'controllable': CONTROLLABLE[typus],
                     'type': typus,
                     'state': 'stopped'
                 }
             else:
-                timeline = self._timeline_dict(players[
-                        v.KODI_PLAYLIST_TYPE_FROM_PLEX_PLAYLIST_TYPE[typus]],
-                    typus)
-            timelines[typus] = self._dict_to_xml(timeline)
-        timelines.update({'command_id': '{command_id}',
-                         'location': self.location})
-        return answ.format(**timelines)
+                timelines[typus] = self._timeline_dict(player, typus)
+        return timelines
+
+    def _msg(self, timelines):
+        """
+        Fills our XML template with the timeline dicts from _timelines()
+        """
+        fields = {'command_id': '{command_id}', 'location': self.location}
+        for typus, timeline in timelines.iteritems():
+            fields[typus] = self._dict_to_xml(timeline)
+        return XML.format(**fields)
 
     @staticmethod
     def _dict_to_xml(dictionary):
         """
         Returns the string 'key1="value1" key2="value2" ...' for dictionary
         """
-        answ = ''
-        for key, value in dictionary.iteritems():
-            answ += '%s="%s" ' % (key, value)
-        return answ
+        return ' '.join('%s="%s"' % item for item in dictionary.iteritems())
 
     def _timeline_dict(self, player, ptype):
         with app.APP.lock_playqueues:
@@ -285,6 +417,10 @@ class SubscriptionMgr(object):
             self._send_pms_notification(playerid,
                                         self.last_params,
                                         timeout=0.0001)
+        self.timeline_pool.shutdown()
+        # Release all long-polling connections
+        with self.timeline_changed:
+            self.timeline_changed.notify_all()
 
     def _plex_stream_index(self, playerid, stream_type):
         """
@@ -342,24 +478,84 @@ class SubscriptionMgr(object):
             # Get all the active/playing Kodi players (video, audio, pictures)
             players = js.get_players()
             # Update the PKC info with what's playing on the Kodi side
-            for player in players.values():
-                update_player_info(player['playerid'])
+            if players:
+                volume, muted = js.get_volume_muted()
+                for player in players.values():
+                    update_player_info(player['playerid'], volume, muted)
             # Check whether we can use the CURRENT info or whether PKC is still
             # initializing
             if self._playqueue_init_done(players) is False:
                 LOG.debug('PKC playqueue is still initializing - skip update')
                 return
             self._notify_server(players)
-            if self.subscribers:
-                msg = self.msg(players)
-                for subscriber in self.subscribers.values():
-                    subscriber.send_update(msg)
+            if self.subscribers or self.parked_polls:
+                timelines = self._timelines(players)
+                if self._timelines_differ(timelines):
+                    msg = self._msg(timelines)
+                    for subscriber in self.subscribers.values():
+                        subscriber.send_update(msg)
+                    self._signal_timeline(msg)
             self.lastplayers = players
 
+    def _timelines_differ(self, timelines):
+        """
+        Returns True if we need to send timelines to our subscribers, i.e. if
+        they differ from what we sent last time
+        """
+        now = time()
+        elapsed = now - self.sent_timelines_at
+        for typus, timeline in timelines.iteritems():
+            if differs(self.sent_timelines.get(typus), timeline, elapsed):
+                break
+        else:
+            return False
+        self.sent_timelines = timelines
+        self.sent_timelines_at = now
+        return True
+
+    def _signal_timeline(self, msg):
+        """
+        Wakes up all long-polling connections with the new timeline msg
+        """
+        with self.timeline_changed:
+            self.last_timeline = msg
+            self.timeline_version += 1
+            self.timeline_changed.notify_all()
+
+    def wait_for_timeline(self, timeout):
+        """
+        Long-polling: blocks until notify() comes up with a new timeline, for
+        at most timeout [seconds] or until PKC shuts down. Returns True if the
+        timeline changed. Waits at most OVERFLOW_POLL_DELAY if too many
+        connections are already waiting
+        """
+        with self.timeline_changed:
+            if self.parked_polls >= MAX_PARKED_POLLS:
+                LOG.debug('Too many long-polling connections')
+                timeout = min(timeout, OVERFLOW_POLL_DELAY)
+            version = self.timeline_version
+            deadline = time() + timeout
+            self.parked_polls += 1
+            try:
+                while (self.timeline_version == version and
+                       not app.APP.stop_pkc):
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    self.timeline_changed.wait(remaining)
+            finally:
+                self.parked_polls -= 1
+            return self.timeline_version != version
+
     def _notify_server(self, players):
+        now = time()
         for typus, player in players.iteritems():
-            self._send_pms_notification(
-                player['playerid'], self._get_pms_params(player['playerid']))
+            playerid = player['playerid']
+            params = self._get_pms_params(playerid)
+            old, timestamp = self.sent_params.get(playerid, (None, 0))
+            if differs(old, params, now - timestamp):
+                self._send_pms_notification(playerid, params)
+                self.sent_params[playerid] = (dict(params), now)
             try:
                 del self.lastplayers[typus]
             except KeyError:
@@ -368,6 +564,7 @@ class SubscriptionMgr(object):
         for player in self.lastplayers.values():
             self.last_params['state'] = 'stopped'
             self._send_pms_notification(player['playerid'], self.last_params)
+            self.sent_params.pop(player['playerid'], None)
 
     def _get_pms_params(self, playerid):
         info = app.PLAYSTATE.player_states[playerid]
@@ -420,7 +617,8 @@ class SubscriptionMgr(object):
         LOG.debug("Sent server notification with parameters: %s to %s",
                   xargs, url)
 
-    def add_subscriber(self, protocol, host, port, uuid, command_id):
+    def add_subscriber(self, protocol, host, port, uuid, command_id,
+                       platform=None):
         """
         Adds a new Plex Companion subscriber to PKC.
         """
@@ -430,9 +628,13 @@ class SubscriptionMgr(object):
                                 uuid,
                                 command_id,
                                 self,
-                                self.request_mgr)
+                                self.request_mgr,
+                                self.timeline_pool,
+                                platform)
         with app.APP.lock_subscriber:
             self.subscribers[subscriber.uuid] = subscriber
+            # Make sure our new subscriber gets a timeline asap
+            self.sent_timelines = {}
         return subscriber
 
     def remove_subscriber(self, uuid):
@@ -459,15 +661,24 @@ class Subscriber(object):
     Plex Companion subscribing device
     """
     def __init__(self, protocol, host, port, uuid, command_id, sub_mgr,
-                 request_mgr):
+                 request_mgr, timeline_pool, platform=None):
         self.protocol = protocol or "http"
         self.host = host
         self.port = port or 32400
         self.uuid = uuid or host
         self.command_id = int(command_id) or 0
+        # X-Plex-Platform of the subscriber, e.g. 'iOS'
+        self.platform = platform
         self.age = 0
         self.sub_mgr = sub_mgr
         self.request_mgr = request_mgr
+        self.timeline_pool = timeline_pool
+        # Latest timeline that has not yet been sent
+        self.pending = None
+        # Are we queued in the timeline_pool or currently sending?
+        self.scheduled = False
+        self.removed = False
+        self.lock = Lock()
 
     def __eq__(self, other):
         return self.uuid == other.uuid
@@ -476,29 +687,62 @@ class Subscriber(object):
         """
         Closes the connection to the Plex Companion client
         """
+        with self.lock:
+            self.removed = True
+            if self.pending is not None:
+                self.pending = None
+                self.timeline_pool.count(dropped=1)
         self.request_mgr.closeConnection(self.protocol, self.host, self.port)
 
     def send_update(self, msg):
         """
-        Sends msg to the Plex Companion client (via .../:/timeline)
+        Sends msg to the Plex Companion client (via .../:/timeline). If an
+        older msg has not yet been sent, only the newer msg will be sent
         """
         self.age += 1
         msg = msg.format(command_id=self.command_id)
         LOG.debug("sending xml to subscriber uuid=%s,commandID=%i:\n%s",
                   self.uuid, self.command_id, msg)
-        url = '%s://%s:%s/:/timeline' % (self.protocol, self.host, self.port)
-        thread = Thread(target=self._threaded_send, args=(url, msg))
-        thread.start()
+        with self.lock:
+            if self.removed:
+                return
+            if self.pending is not None:
+                self.timeline_pool.count(coalesced=1)
+            self.pending = msg
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.timeline_pool.schedule(self)
 
-    def _threaded_send(self, url, msg):
+    def send_pending(self):
         """
-        Threaded POST request, because they stall due to response missing
-        the Content-Length header :-(
+        Called by the timeline_pool's threads. POST requests via persistent
+        connections, because they stall due to response missing the
+        Content-Length header :-(
         """
-        response = DU().downloadUrl(url,
-                                    action_type="POST",
-                                    postBody=msg,
-                                    authenticate=False,
-                                    headerOverride=headers_companion_client())
-        if response in (False, None, 401):
+        with self.lock:
+            msg, self.pending = self.pending, None
+            if msg is None:
+                self.scheduled = False
+                return
+        response = self.request_mgr.post(self.host,
+                                         self.port,
+                                         '/:/timeline',
+                                         msg,
+                                         headers_companion_client(),
+                                         self.protocol)
+        if (response in (False, 401) or
+                (response == 404 and self.platform != 'iOS')):
+            # iOS answers with 404 no matter what
+            self.timeline_pool.count(dropped=1)
             self.sub_mgr.remove_subscriber(self.uuid)
+        else:
+            self.timeline_pool.count(sent=1)
+        with self.lock:
+            # A newer timeline might have arrived in the meantime
+            if self.pending is not None and not self.removed:
+                reschedule = True
+            else:
+                reschedule = self.scheduled = False
+        if reschedule:
+            self.timeline_pool.schedule(self)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local request broker of PKC's service. Other PKC Python instances (e.g.
+widgets via default.py) download from the PMS through the service and thus
+reuse its warm, pooled HTTP session instead of starting a cold requests
+session and TLS handshake every single time. See transfer.pms_request() for
+the client side
+"""
+from __future__ import absolute_import, division, unicode_literals
+from logging import getLogger
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import urlparse
+import uuid
+
+from .plexbmchelper.listener import ThreadPoolMixIn
+from .downloadutils import DownloadUtils as DU
+from . import backgroundthread, transfer, utils, app
+
+LOG = getLogger('PLEX.request_broker')
+
+# Number of threads answering requests of other PKC Python instances
+BROKER_THREADS = 4
+# Max. number of requests waiting for a free thread
+BROKER_BACKLOG = 16
+# Seconds after which we check whether we should exit or suspend
+POLL_INTERVAL = 1.0
+
+
+class BrokerServer(ThreadPoolMixIn, HTTPServer):
+    """
+    Answers requests on localhost only, using a pool of threads. Requests
+    need to carry our secret, published via a window variable
+    """
+    pool_size = BROKER_THREADS
+    backlog = BROKER_BACKLOG
+    thread_name = 'PKC-Broker'
+
+    def __init__(self, secret, *args, **kwargs):
+        self.secret = secret
+        self._init_pool()
+        HTTPServer.__init__(self, *args, **kwargs)
+
+
+class BrokerHandler(BaseHTTPRequestHandler):
+    """
+    GET /pms?url=<url starting with {server}>
+    Relays an If-None-Match header to the PMS. Answers with the PMS' status
+    code, its ETag and its content, or with 502 if we could not reach the PMS
+    """
+    def log_message(self, format, *args):
+        """
+        Mute all requests, don't log them
+        """
+        pass
+
+    def do_GET(self):
+        if self.headers.get(transfer.BROKER_SECRET_HEADER) != self.server.secret:
+            LOG.warn('Rejecting request without a valid secret')
+            return self._answer(403)
+        request = urlparse.urlparse(self.path)
+        url = dict(urlparse.parse_qsl(request.query)).get('url', b'')
+        url = url.decode('utf-8')
+        if request.path != '/pms' or not url.startswith('{server}'):
+            return self._answer(400)
+        etag = self.headers.get('If-None-Match')
+        answ = DU().downloadUrl(
+            url,
+            headerOptions={'If-None-Match': etag} if etag else None,
+            return_response=True)
+        try:
+            content = answ.content
+        except AttributeError:
+            # 304, 401, ... - or True or None if something went wrong
+            if isinstance(answ, bool) or not isinstance(answ, int):
+                answ = 502
+            return self._answer(answ)
+        self._answer(200, content, answ.headers.get('ETag'))
+
+    def _answer(self, code, content=b'', etag=None):
+        self.send_response(code)
+        self.send_header(b'Content-Length', str(len(content)))
+        if etag:
+            self.send_header(b'ETag', utils.try_encode(etag))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class RequestBroker(backgroundthread.KillableThread):
+    """
+    Runs the BrokerServer as long as PKC is not suspended, e.g. while the
+    user is being switched
+    """
+    def __init__(self):
+        self.httpd = None
+        super(RequestBroker, self).__init__()
+
+    def _publish(self):
+        transfer.kodi_window(
+            transfer.WINDOW_BROKER,
+            value=b'%s %s' % (self.httpd.server_address[1],
+                              utils.try_encode(self.httpd.secret)))
+
+    def run(self):
+        LOG.info("----===## Starting request broker ##===----")
+        app.APP.register_thread(self)
+        try:
+            self._run()
+        except Exception:
+            utils.ERROR(notify=True)
+        finally:
+            transfer.kodi_window(transfer.WINDOW_BROKER, clear=True)
+            if self.httpd:
+                self.httpd.server_close()
+            app.APP.deregister_thread(self)
+            LOG.info("----===## Request broker stopped ##===----")
+
+    def _run(self):
+        self.httpd = BrokerServer(uuid.uuid4().hex,
+                                  ('127.0.0.1', 0),
+                                  BrokerHandler)
+        self.httpd.timeout = POLL_INTERVAL
+        self._publish()
+        LOG.info('Request broker listening on port %s',
+                 self.httpd.server_address[1])
+        while not self.should_cancel():
+            if self.should_suspend():
+                # Let other PKC instances talk to the PMS themselves
+                transfer.kodi_window(transfer.WINDOW_BROKER, clear=True)
+                if self.wait_while_suspended():
+                    break
+                self._publish()
+                continue
+            self.httpd.handle_request()
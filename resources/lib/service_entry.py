@@ -17,7 +17,7 @@ from . import playqueue
 from . import variables as v
 from . import app
 from . import loghandler
-from . import backgroundthread
+from . import backgroundthread, widget_cache, request_broker
 from .windows import userselect
 
 ###############################################################################
@@ -25,6 +25,10 @@ loghandler.config()
 LOG = logging.getLogger("PLEX.service")
 ###############################################################################
 
+# Max number of seconds the main loop waits for new work once PKC is up and
+# running. Other PKC Python instances wake us up on sending a command
+IDLE_TIMEOUT = 1
+
 WINDOW_PROPERTIES = (
     "pms_token", "plex_token", "plex_authenticated", "plex_restricteduser",
     "plex_allows_mediaDeletion", "plexkodiconnect.command", "plex_result")
@@ -89,6 +93,9 @@ class Service(object):
         # Reset window props
         for prop in WINDOW_PROPERTIES:
             utils.window(prop, clear=True)
+        # Don't use widget listings we cached before Kodi restarted
+        widget_cache.invalidate()
+        widget_cache.prune()
 
         clientinfo.getDeviceId()
 
@@ -99,6 +106,7 @@ class Service(object):
         self.setup = None
         self.alexa = None
         self.playqueue = None
+        self.broker = None
         # Flags for other threads
         self.connection_check_running = False
         self.auth_running = False
@@ -164,6 +172,7 @@ class Service(object):
                 app.CONN.online = True
         finally:
             self.connection_check_running = False
+            app.APP.service_wakeup.set()
 
     @staticmethod
     def log_out():
@@ -257,6 +266,7 @@ class Service(object):
             app.reload()
             app.APP.resume_threads()
         self.auth_running = False
+        app.APP.service_wakeup.set()
 
     def enter_new_pms_address(self):
         server = self.setup.enter_new_pms_address()
@@ -450,6 +460,7 @@ class Service(object):
         self.sync = sync.Sync()
         self.plexcompanion = plex_companion.PlexCompanion()
         self.playqueue = playqueue.PlayqueueMonitor()
+        self.broker = request_broker.RequestBroker()
 
         # Main PKC program loop
         while not self.should_cancel():
@@ -551,6 +562,11 @@ class Service(object):
                 self.plexcompanion.start()
                 self.playqueue.start()
                 self.alexa.start()
+                self.broker.start()
+            elif not app.APP.update_widgets:
+                # Nothing to poll for - block until we get new work
+                app.APP.service_wakeup.wait(IDLE_TIMEOUT)
+                continue
 
             xbmc.sleep(100)
 
@@ -14,6 +14,15 @@ if library_sync.PLAYLIST_SYNC_ENABLED:
 
 LOG = getLogger('PLEX.sync')
 
+# Max number of PMS websocket messages to store in one go
+WEBSOCKET_DRAIN_LIMIT = 1000
+# Process stored websocket messages at most every x seconds (otherwise,
+# potentially many screen refreshes lead to flickering)
+WEBSOCKET_PROCESSING_INTERVAL = 5
+# Max number of seconds to wait for new work before checking back whether
+# e.g. a scheduled full sync is due
+IDLE_TIMEOUT = 5
+
 
 class Sync(backgroundthread.KillableThread):
     """
@@ -27,6 +36,8 @@ class Sync(backgroundthread.KillableThread):
         # Lock used to wait on a full sync, e.g. on initial sync
         # self.lock = backgroundthread.threading.Lock()
         super(Sync, self).__init__()
+        # Producers wake us up, e.g. the websocket or a requested lib scan
+        self.wakeup = app.APP.sync_wakeup
 
     def triage_lib_scans(self):
         """
@@ -136,6 +147,36 @@ class Sync(backgroundthread.KillableThread):
                 pass
             LOG.info("###===--- Sync Thread Stopped ---===###")
 
+    @staticmethod
+    def drain_websocket_queue(queue):
+        """
+        Stores up to WEBSOCKET_DRAIN_LIMIT messages from the PMS websocket
+        queue without blocking. Returns the number of messages we got
+        """
+        for i in range(WEBSOCKET_DRAIN_LIMIT):
+            try:
+                message = queue.get(block=False)
+            except backgroundthread.Queue.Empty:
+                return i
+            try:
+                library_sync.store_websocket_message(message)
+            finally:
+                queue.task_done()
+        return WEBSOCKET_DRAIN_LIMIT
+
+    @staticmethod
+    def seconds_to_websocket_processing(last_websocket_processing):
+        """
+        Returns the number of seconds [float] until we need to process the
+        next stored websocket message, at most IDLE_TIMEOUT
+        """
+        due = library_sync.WEBSOCKET_MESSAGES.next_due()
+        if due is None:
+            return IDLE_TIMEOUT
+        due = max(due + app.SYNC.backgroundsync_saftymargin,
+                  last_websocket_processing + WEBSOCKET_PROCESSING_INTERVAL + 1)
+        return min(max(due - timing.unix_timestamp(), 0.1), IDLE_TIMEOUT)
+
     def _run_internal(self):
         install_sync_done = utils.settings('SyncInstallRunDone') == 'true'
         playlist_monitor = None
@@ -222,6 +263,7 @@ class Sync(backgroundthread.KillableThread):
                     continue
 
                 # Standard syncs - don't force-show dialogs
+                timeout = IDLE_TIMEOUT
                 now = timing.unix_timestamp()
                 if (now - self.last_full_sync > app.SYNC.full_sync_intervall and
                         not app.APP.is_playing_video):
@@ -232,21 +274,17 @@ class Sync(backgroundthread.KillableThread):
                     # this once a while (otherwise, potentially many screen
                     # refreshes lead to flickering)
                     if (library_sync.WEBSOCKET_MESSAGES and
-                            now - last_websocket_processing > 5):
+                            now - last_websocket_processing > WEBSOCKET_PROCESSING_INTERVAL):
                         last_websocket_processing = now
                         library_sync.process_websocket_messages()
-                    # See if there is a PMS message we need to handle
-                    try:
-                        message = queue.get(block=False)
-                    except backgroundthread.Queue.Empty:
-                        pass
-                    # Got a message from PMS; process it
-                    else:
-                        library_sync.store_websocket_message(message)
-                        queue.task_done()
-                        # Sleep just a bit
-                        self.sleep(0.01)
+                    # Store all PMS messages that piled up in the meantime
+                    if self.drain_websocket_queue(queue):
                         continue
+                    timeout = self.seconds_to_websocket_processing(
+                        last_websocket_processing)
+                # Block until we get new work or something else is due
+                self.wait_for_work(timeout)
+                continue
             self.sleep(0.1)
         # Shut down playlist monitoring
         if playlist_monitor:
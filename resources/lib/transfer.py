@@ -7,6 +7,9 @@ and vice versa.
 from __future__ import absolute_import, division, unicode_literals
 from logging import getLogger
 import json
+import httplib
+import socket
+import urllib
 
 import xbmc
 import xbmcgui
@@ -16,6 +19,13 @@ WINDOW = xbmcgui.Window(10000)
 WINDOW_UPSTREAM = 'plexkodiconnect.result.upstream'.encode('utf-8')
 WINDOW_DOWNSTREAM = 'plexkodiconnect.result.downstream'.encode('utf-8')
 WINDOW_COMMAND = 'plexkodiconnect.command'.encode('utf-8')
+# Sent via NotifyAll to wake up PKC's main thread, see kodimonitor.py
+NOTIFY_COMMAND = 'plexkodiconnect.command'.encode('utf-8')
+# "<port> <secret>" of the service's request broker, see request_broker.py
+WINDOW_BROKER = 'plexkodiconnect.broker'.encode('utf-8')
+BROKER_SECRET_HEADER = 'X-PKC-Secret'
+# Needs to be longer than the PMS timeout of downloadutils
+BROKER_TIMEOUT = 35.0
 KODIVERSION = int(xbmc.getInfoLabel("System.BuildVersion")[:2])
 
 
@@ -84,6 +94,47 @@ def plex_command(value):
     while kodi_window(WINDOW_COMMAND):
         xbmc.sleep(50)
     kodi_window(WINDOW_COMMAND, value=value)
+    # Let the main thread know right away instead of letting it poll
+    xbmc.executebuiltin('NotifyAll(plugin.video.plexkodiconnect, %s)'
+                        % NOTIFY_COMMAND)
+
+
+def pms_request(url, etag=None):
+    """
+    Downloads url [unicode, starting with '{server}'] via the request broker
+    of PKC's service, reusing the service's warm connections to the PMS.
+    Pass the etag [unicode] of a cached answer to let the PMS answer with 304
+    if nothing changed. Returns the tuple
+        (status [int], etag [unicode], content [str])
+    or None if we could not use the broker - download yourself then
+    """
+    broker = kodi_window(WINDOW_BROKER)
+    if not broker:
+        return
+    port, secret = broker.split(b' ', 1)
+    headers = {BROKER_SECRET_HEADER.encode('utf-8'): secret}
+    if etag:
+        headers[b'If-None-Match'] = etag.encode('utf-8')
+    conn = httplib.HTTPConnection(b'127.0.0.1', int(port),
+                                  timeout=BROKER_TIMEOUT)
+    try:
+        conn.request(b'GET',
+                     b'/pms?%s' % urllib.urlencode({'url': url.encode('utf-8')}),
+                     headers=headers)
+        answ = conn.getresponse()
+        content = answ.read()
+    except (httplib.HTTPException, socket.error) as err:
+        LOG.warn('Could not reach the request broker: %s', err)
+        return
+    finally:
+        conn.close()
+    if answ.status in (400, 403):
+        LOG.warn('The request broker rejected our request: %s', answ.status)
+        return
+    etag = answ.getheader('ETag')
+    return (answ.status,
+            etag.decode('utf-8') if etag else None,
+            content)
 
 
 def serialize(obj):
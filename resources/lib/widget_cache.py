@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for the listings PKC returns for plugin:// paths, e.g. widgets.
+
+Every widget refresh starts a new Python instance. We thus store the finished
+items (the dicts after widgets.prepare_listitem) on disk and can return a
+listing without any network I/O as long as the entry is still valid.
+
+An entry is valid if
+    - it is younger than TTL seconds
+    - no library sync or websocket event touched the entry's section since we
+      stored it. PKC's service bumps "generations" stored in window variables,
+      the only thing we can share with other Python instances
+
+Stale entries are revalidated using the PMS' ETag (or, if the PMS does not
+send one, a digest of the PMS answer); if nothing changed, we only skip
+processing the xml again.
+"""
+from __future__ import absolute_import, division, unicode_literals
+from logging import getLogger
+from threading import Lock
+from time import time
+import cPickle as pickle
+import hashlib
+import uuid
+import os
+
+from . import path_ops, timing, utils, variables as v, app
+
+LOG = getLogger('PLEX.widget_cache')
+
+# Seconds after which we ask the PMS again whether a listing changed
+TTL = 300
+# Cached listings not written to for this many seconds are deleted on startup
+MAX_AGE = 3 * 24 * 60 * 60
+# Max. total size of all cached listings [bytes], enforced on startup
+MAX_SIZE = 50 * 1024 * 1024
+# Bump to invalidate all cached listings after a change to the file format
+CACHE_VERSION = 1
+CACHE_DIR = path_ops.path.join(v.ADDON_PROFILE, 'widgets', '')
+# Window variables holding the generations of our cached listings
+GENERATION_ALL = 'plex_widgets.all'
+GENERATION_MIXED = 'plex_widgets.mixed'
+GENERATION_SECTION = 'plex_widgets.section.%s'
+# PKC settings that change the finished items, see entrypoint.show_listing
+SETTINGS = ('OnDeckTvAppendShow', 'OnDeckTvAppendSeason',
+            'RecentTvAppendShow', 'RecentTvAppendSeason')
+
+LOCK = Lock()
+
+
+def _generations(section_id):
+    """
+    Returns the current generations that a listing for the Plex section
+    section_id depends on. Listings spanning several sections (e.g. hubs)
+    should pass section_id=None
+    """
+    if section_id:
+        section = utils.window(GENERATION_SECTION % section_id)
+    else:
+        section = utils.window(GENERATION_MIXED)
+    return (utils.window(GENERATION_ALL), section)
+
+
+def _bump(prop):
+    utils.window(prop,
+                 value=unicode((utils.cast(int, utils.window(prop)) or 0) + 1))
+
+
+def invalidate(section_id=None):
+    """
+    Call from PKC's service only. Invalidates all cached listings that might
+    show items of the Plex section section_id, or every cached listing if
+    section_id is None
+    """
+    with LOCK:
+        if section_id is None:
+            LOG.debug('Invalidating all cached listings')
+            # Unique across Kodi restarts, unlike a counter
+            utils.window(GENERATION_ALL, value=uuid.uuid4().hex)
+        else:
+            LOG.debug('Invalidating cached listings for section %s',
+                      section_id)
+            _bump(GENERATION_SECTION % section_id)
+            _bump(GENERATION_MIXED)
+
+
+def prune():
+    """
+    Call from PKC's service on startup. Deletes cached listings older than
+    MAX_AGE, then the oldest ones until the rest takes up at most MAX_SIZE
+    bytes. Also deletes leftovers of interrupted writes older than TTL
+    """
+    try:
+        names = os.listdir(path_ops.encode_path(CACHE_DIR))
+    except OSError:
+        # Nothing cached yet
+        return
+    now = time()
+    entries = []
+    for name in names:
+        path = os.path.join(path_ops.encode_path(CACHE_DIR), name)
+        try:
+            stat = os.stat(path)
+            max_age = MAX_AGE if name.endswith(b'.pickle') else TTL
+            if now - stat.st_mtime > max_age:
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            pass
+    size = sum(x[1] for x in entries)
+    deleted = len(names) - len(entries)
+    for _, entry_size, path in sorted(entries):
+        if size <= MAX_SIZE:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        size -= entry_size
+        deleted += 1
+    LOG.debug('Deleted %s cached listings, keeping %s bytes', deleted, size)
+
+
+class Listing(object):
+    """
+    A cached listing for a PMS key plus its arguments and the PKC SETTINGS.
+    Pass section_id if the listing only shows items of this one Plex section
+    """
+    def __init__(self, key, args=None, section_id=None, **kwargs):
+        hashed = hashlib.md5()
+        for value in (app.CONN.machine_identifier,
+                      app.ACCOUNT.plex_user_id,
+                      key,
+                      section_id,
+                      sorted((args or {}).items()),
+                      sorted(kwargs.items()),
+                      [utils.settings(x) for x in SETTINGS]):
+            hashed.update(utils.try_encode(repr(value)))
+        self.path = path_ops.path.join(CACHE_DIR,
+                                       '%s.pickle' % hashed.hexdigest())
+        self.key = key
+        self.generations = _generations(section_id)
+        self.entry = self._load()
+
+    def __repr__(self):
+        return ('{{'
+                '\'key\': \'{self.key}\', '
+                '\'generations\': {self.generations}, '
+                '\'path\': \'{self.path}\''
+                '}}').format(self=self)
+
+    def _load(self):
+        try:
+            with open(path_ops.encode_path(self.path), 'rb') as f:
+                entry = pickle.load(f)
+        except (IOError, OSError):
+            return
+        except Exception as err:
+            # E.g. we got interrupted while writing the file
+            LOG.warn('Could not read cached listing %s: %s', self, err)
+            return
+        if (entry.get('version') != CACHE_VERSION or
+                entry.get('generations') != self.generations):
+            return
+        return entry
+
+    @property
+    def fresh(self):
+        """
+        True if we can use this listing without contacting the PMS
+        """
+        return (self.entry is not None and
+                timing.unix_timestamp() - self.entry['created'] < TTL)
+
+    @property
+    def etag(self):
+        return self.entry['etag'] if self.entry else None
+
+    @property
+    def content_type(self):
+        return self.entry['content_type']
+
+    @property
+    def items(self):
+        return self.entry['items']
+
+    def unchanged(self, etag, digest):
+        """
+        Returns True if the PMS answered with the same listing as the one
+        we've cached. Also resets the entry's TTL if so
+        """
+        if self.entry is None:
+            return False
+        if not ((etag and etag == self.entry['etag']) or
+                (digest and digest == self.entry['digest'])):
+            return False
+        self.entry['created'] = timing.unix_timestamp()
+        self._save()
+        return True
+
+    def store(self, content_type, items, etag=None, digest=None):
+        """
+        Stores the finished items (after widgets.prepare_listitem). Call
+        before widgets.create_listitem as the latter changes the items
+        """
+        self.entry = {
+            'version': CACHE_VERSION,
+            'generations': self.generations,
+            'created': timing.unix_timestamp(),
+            'etag': etag,
+            'digest': digest,
+            'content_type': content_type,
+            'items': items
+        }
+        self._save()
+
+    def _save(self):
+        if not path_ops.exists(CACHE_DIR):
+            try:
+                path_ops.makedirs(CACHE_DIR)
+            except OSError:
+                # Another widget might have been faster
+                pass
+        # Write to a temporary file first as other Python instances might be
+        # reading our cached listing at the same time
+        tmp = '%s.%s' % (self.path, uuid.uuid4().hex)
+        try:
+            with open(path_ops.encode_path(tmp), 'wb') as f:
+                pickle.dump(self.entry, f, pickle.HIGHEST_PROTOCOL)
+            try:
+                path_ops.rename(tmp, self.path)
+            except OSError:
+                # Windows won't replace an existing file
+                path_ops.remove(self.path)
+                path_ops.rename(tmp, self.path)
+        except Exception as err:
+            LOG.warn('Could not cache listing %s: %s', self, err)
+            try:
+                path_ops.remove(tmp)
+            except OSError:
+                pass
@@ -25,6 +25,9 @@ APPEND_SXXEXX = None
 SYNCHED = True
 # Need to chain the PMS keys
 KEY = None
+# Kodi item dicts fetched in advance by get_kodi_details(), key is the tuple
+# (kodi_id, kodi_type)
+KODI_DETAILS = {}
 
 
 def get_clean_image(image):
@@ -54,6 +57,25 @@ def get_clean_image(image):
         return image.decode('utf-8')
 
 
+def get_kodi_details(apis):
+    """
+    Fetches the Kodi item dicts for all synched items of the API list apis
+    using JSON-RPC batches - much faster than asking Kodi for every single
+    item in generate_item()
+    """
+    items = []
+    for api in apis:
+        if (api.kodi_id and api.kodi_type in js.JSON_FROM_KODITYPE and
+                (api.tag not in ('Directory', 'Playlist', 'Hub') or
+                 api.plex_type in (v.PLEX_TYPE_SHOW, v.PLEX_TYPE_SEASON,
+                                   v.PLEX_TYPE_ARTIST, v.PLEX_TYPE_ALBUM))):
+            items.append((api.kodi_id, api.kodi_type))
+    if not items:
+        return
+    KODI_DETAILS.update(zip(items, js.items_details(items)))
+    LOG.debug('Fetched Kodi details for %s items', len(items))
+
+
 def generate_item(api):
     """
     Meant to be consumed by metadatautils.kodidb.prepare_listitem(), and then
@@ -130,7 +152,9 @@ def _generate_content(api):
     if api.kodi_id:
         # Item is synched to the Kodi db - let's use that info
         # (will thus e.g. include additional artwork or metadata)
-        item = js.item_details(api.kodi_id, api.kodi_type)
+        item = KODI_DETAILS.pop((api.kodi_id, api.kodi_type), None)
+        if item is None:
+            item = js.item_details(api.kodi_id, api.kodi_type)
 
     # In rare cases, Kodi's JSON reply does not provide 'title' plus potentially
     # other fields - let's use the PMS answer to be safe